@@ -1 +1,14 @@
-from .client import KlaviyoClient, KlaviyoClientException  # noqa
+from .exceptions import KlaviyoClientException  # noqa
+from .page import Page  # noqa
+from .page_cache import PageCache, PAGE_CACHE_RECORD, PAGE_CACHE_REPLAY  # noqa
+from .sync_action_client import SyncActionClient  # noqa
+from .transport import HttpTransport, TransportStats  # noqa
+from .telemetry import Telemetry  # noqa
+
+
+def __getattr__(name: str):
+    # the client imports the Klaviyo SDK, which takes seconds, so it is imported only by the actions using it
+    if name == "KlaviyoClient":
+        from .client import KlaviyoClient
+        return KlaviyoClient
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
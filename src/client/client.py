@@ -1,112 +1,433 @@
-import backoff
+import functools
 import json
-import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import islice
 from typing import Iterator, Callable, Dict, List, Tuple
-from datetime import datetime
+from datetime import date, datetime, timedelta, timezone
 
 from keboola.component.exceptions import UserException
 
 from klaviyo_api import KlaviyoAPI
-from openapi_client.exceptions import OpenApiException
+from openapi_client.exceptions import ApiException, OpenApiException
 from openapi_client.models import MetricAggregateQuery
 from openapi_client.api_arg_options import USE_DICTIONARY_FOR_RESPONSE_DATA
+from openapi_client.rest import RESTResponse
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+from .exceptions import KlaviyoClientException, format_error_message
+from .page import Page
+from .page_cache import PageCache, PageCacheMiss
+from .rate_limiter import RequestScheduler, ENDPOINT_RATE_LIMIT_TIERS
+from .telemetry import Telemetry
+from .time_slicing import TimeWindow, TimeWindowPlanner
+from .transport import HttpTransport
 
 MAX_DELAY = 60
-MAX_RETRIES = 5
+# retries are handled by the RequestScheduler, the SDK sends every request only once
+SDK_MAX_RETRIES = 1
+
+# how often a thread blocked on a full page queue checks whether the consumer stopped reading pages
+QUEUE_POLL_INTERVAL = 1
+
+# a window of events returning more pages than this is split and its remainder is fetched concurrently
+MAX_PAGES_PER_EVENT_WINDOW = 50
+
+# largest page[size] accepted by the endpoints, endpoints not listed here have a fixed page size
+MAX_PAGE_SIZES = {
+    "Flows.get_flows": 50,
+    "Lists.get_list_profiles": 100,
+    "Lists.get_profile_ids_for_list": 1000,
+    "Profiles.get_profiles": 100,
+    "Segments.get_profile_ids_for_segment": 1000,
+    "Segments.get_segment_profiles": 100,
+}
+
+# longest date range requested by a single metric aggregates query of the interval, longer time ranges are split
+# into several queries, so hourly aggregates of long time ranges do not return a huge response at once
+MAX_METRIC_AGGREGATE_DAYS = {
+    "hour": 31,
+    "day": 365,
+    "week": 364,
+    "month": 365,
+}
+DEFAULT_MAX_METRIC_AGGREGATE_DAYS = 365
+# number of normalized metric aggregate records passed to the consumer at once
+METRIC_AGGREGATE_PAGE_ROWS = 1000
+
+_END_OF_PAGES = object()
+
+
+def _put_until_stopped(buffer: queue.Queue, item, stopped: threading.Event) -> bool:
+    """
+    Puts the item into a bounded queue, giving up once the consumer of the queue stopped reading from it.
+    """
+    while not stopped.is_set():
+        try:
+            buffer.put(item, timeout=QUEUE_POLL_INTERVAL)
+            return True
+        except queue.Full:
+            continue
+    return False
 
 
-class KlaviyoClientException(Exception):
-    pass
+def _get_interval_start(day: date, interval: str) -> date:
+    """
+    Start of the week (Monday) or month the day belongs to, other intervals start at the day itself.
+    """
+    if interval == "month":
+        return day.replace(day=1)
+    if interval == "week":
+        return day - timedelta(days=day.weekday())
+    return day
 
 
 class KlaviyoClient:
-    def __init__(self, api_token: str):
+    def __init__(self, api_token: str, prefetch_pages: int = 0, page_cache: PageCache = None,
+                 transport: HttpTransport = None, raw_responses: bool = False, telemetry: Telemetry = None):
+        """
+        Args:
+            api_token: Klaviyo private API key
+            prefetch_pages: Maximum number of pages fetched ahead of the consumer in a background thread.
+                            0 disables the read-ahead and pages are fetched only when requested.
+            page_cache: Cache the API responses are recorded into or replayed from.
+            transport: Settings of the HTTP connection pool, the default settings are used if not set.
+            raw_responses: Decode the response bodies directly instead of deserializing them by the SDK.
+            telemetry: Telemetry the requests are recorded into, a new one is created if not set.
+        """
         self.client = KlaviyoAPI(
             api_token,
             max_delay=MAX_DELAY,
-            max_retries=MAX_RETRIES,
+            max_retries=SDK_MAX_RETRIES,
             options={USE_DICTIONARY_FOR_RESPONSE_DATA: True})
+        self.prefetch_pages = prefetch_pages
+        self.page_cache = page_cache
+        self.transport = transport or HttpTransport()
+        self.transport.install(self.client.api_client)
+
+        self.telemetry = telemetry or Telemetry()
+        self.scheduler = RequestScheduler(telemetry=self.telemetry)
+        self.raw_responses = raw_responses
+        self._endpoint_names = {}
+        self._raw_endpoints = {}
+        for endpoint_name in ENDPOINT_RATE_LIMIT_TIERS:
+            api_name, func_name = endpoint_name.split(".")
+            api = getattr(self.client, api_name)
+            endpoint_func = getattr(api, func_name)
+            self._endpoint_names[endpoint_func] = endpoint_name
+            self._raw_endpoints[endpoint_func] = self.client._page_cursor_update(
+                getattr(api, f"{func_name}_without_preload_content"))
+        self._observe_responses()
+
+    def _observe_responses(self) -> None:
+        """
+        Hooks into the SDK transport so the scheduler sees the rate limit headers of every response and
+        the telemetry records its latency and size.
+        """
+        rest_client = self.client.api_client.rest_client
+        send_request = rest_client.request
+
+        def request(*args, **kwargs):
+            start = time.perf_counter()
+            response = send_request(*args, **kwargs)
+            # the body is read here so the latency includes its download, the SDK reads the cached body later
+            body = response.read()
+            self.telemetry.record_request(self.scheduler.current_endpoint_name() or "other",
+                                          time.perf_counter() - start, response.response.tell(), len(body or b""))
+            self.scheduler.observe_response_headers(response.getheaders())
+            self.transport.observe_response(response)
+            return response
+
+        rest_client.request = request
+
+    def _call(self, endpoint_func: Callable, **kwargs):
+        endpoint_name = self._endpoint_names.get(endpoint_func, getattr(endpoint_func, "__name__", ""))
+        if self.raw_responses and endpoint_func in self._raw_endpoints:
+            endpoint_func = functools.partial(self._call_raw, self._raw_endpoints[endpoint_func])
+        if self.page_cache is None:
+            return self.scheduler.call(endpoint_name, endpoint_func, **kwargs)
+
+        if self.page_cache.replaying:
+            try:
+                return self.page_cache.get(endpoint_name, kwargs)
+            except PageCacheMiss as miss:
+                raise KlaviyoClientException(f"The response of {endpoint_name} is not in the page cache, the request "
+                                             f"was not made by the recorded run: {miss}") from miss
+        response = self.scheduler.call(endpoint_name, endpoint_func, **kwargs)
+        self.page_cache.put(endpoint_name, kwargs, response)
+        return response
 
-    def get_metrics(self) -> Iterator[List[Dict]]:
-        return self._paginate_cursor_endpoint(self.client.Metrics.get_metrics)
-
-    def get_catalog_items(self) -> Iterator[List[Dict]]:
-        return self._paginate_cursor_endpoint(self.client.Catalogs.get_catalog_items)
-
-    def get_catalog_categories(self) -> Iterator[List[Dict]]:
-        return self._paginate_cursor_endpoint(self.client.Catalogs.get_catalog_categories)
-
-    def get_events(self, from_timestamp_value: int, to_timestamp_value: int) -> Iterator[List[Dict]]:
+    @staticmethod
+    def _call_raw(raw_endpoint_func: Callable, **kwargs) -> Dict:
+        """
+        Sends the request of the endpoint and decodes the JSON body of the response, skipping the deserialization
+        by the SDK, which walks the whole decoded response again.
+        """
+        response = RESTResponse(raw_endpoint_func(**kwargs))
+        body = response.read()
+        if not 200 <= response.status <= 299:
+            raise ApiException.from_response(http_resp=response, body=body.decode("utf-8"), data=None)
+        return json_loads(body)
+
+    def get_metrics(self, fields: List[str] = None) -> Iterator[List[Dict]]:
+        return self._paginate_cursor_endpoint(self.client.Metrics.get_metrics,
+                                              **self._sparse_fieldset("fields_metric", fields))
+
+    def get_catalog_items(self, fields: List[str] = None) -> Iterator[List[Dict]]:
+        return self._paginate_cursor_endpoint(self.client.Catalogs.get_catalog_items,
+                                              **self._sparse_fieldset("fields_catalog_item", fields))
+
+    def get_catalog_categories(self, fields: List[str] = None) -> Iterator[List[Dict]]:
+        return self._paginate_cursor_endpoint(self.client.Catalogs.get_catalog_categories,
+                                              **self._sparse_fieldset("fields_catalog_category", fields))
+
+    def get_events(self, from_timestamp_value: int, to_timestamp_value: int, fields: List[str] = None,
+                   include: List[str] = None, metric_fields: List[str] = None,
+                   profile_fields: List[str] = None) -> Iterator[List[Dict]]:
+        """
+        Events are sorted by timestamp, so the checkpoint of each page is the timestamp of its last event.
+        """
         request_filter = f"greater-or-equal(timestamp,{from_timestamp_value})," \
                          f"less-or-equal(timestamp,{to_timestamp_value})"
-        return self._paginate_cursor_endpoint(self.client.Events.get_events, filter=request_filter)
+        parameters = self._events_parameters(fields, include, metric_fields, profile_fields)
+        for page in self._paginate_cursor_endpoint(self.client.Events.get_events, filter=request_filter,
+                                                   sort="timestamp", **parameters):
+            last_timestamp = page[-1]["attributes"].get("timestamp") if page else None
+            page.checkpoint = {"from_timestamp_value": last_timestamp} if last_timestamp is not None else None
+            yield page
+
+    def get_events_time_sliced(self, from_timestamp_value: int, to_timestamp_value: int, workers: int,
+                               fields: List[str] = None, include: List[str] = None, metric_fields: List[str] = None,
+                               profile_fields: List[str] = None) -> Iterator[List[Dict]]:
+        """
+        Fetches the events of the time range split into windows that are fetched concurrently by `workers` threads.
+        Pages are yielded in the order they arrive, not in the order of the events. The checkpoint of each page
+        is the start of the earliest window that is not finished yet, including the split windows waiting to run.
+        """
+        planner = TimeWindowPlanner(from_timestamp_value, to_timestamp_value, workers, MAX_PAGES_PER_EVENT_WINDOW)
+        parameters = self._events_parameters(fields, include, metric_fields, profile_fields)
+        pages = queue.Queue(maxsize=workers * 2)
+        consumer_stopped = threading.Event()
+
+        def fetch_window(window: TimeWindow):
+            try:
+                fetched_pages = self._fetch_event_window(window, planner, pages, consumer_stopped, parameters)
+                planner.report_finished(fetched_pages)
+                _put_until_stopped(pages, (window, None, None), consumer_stopped)
+            except Exception as exc:
+                _put_until_stopped(pages, (window, None, exc), consumer_stopped)
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="event-window") as executor:
+            running_windows = 0
+            try:
+                while True:
+                    while running_windows < workers and (window := planner.next_window()):
+                        executor.submit(fetch_window, window)
+                        running_windows += 1
+                    if not running_windows:
+                        return
+
+                    window, page, exc = pages.get()
+                    if exc is not None:
+                        raise exc
+                    if page is None:
+                        # the window is finished once all its pages were yielded
+                        planner.mark_finished(window)
+                        running_windows -= 1
+                    else:
+                        page.checkpoint = {"from_timestamp_value": planner.earliest_unfinished_start()}
+                        yield page
+            finally:
+                consumer_stopped.set()
+
+    def _fetch_event_window(self, window: TimeWindow, planner: TimeWindowPlanner, pages: queue.Queue,
+                            consumer_stopped: threading.Event, parameters: Dict) -> int:
+        """
+        Fetches the events of one window sorted by timestamp. After too many pages the rest of the window is
+        handed back to the planner to be split, starting at the last timestamp seen. Events of that second that
+        were already fetched are skipped by the remainder.
+
+        Returns:
+            Number of pages fetched
+        """
+        fetched_pages = 0
+        last_timestamp = None
+        ids_at_last_timestamp = set()
+
+        for page in self._iterate_cursor_pages(self.client.Events.get_events, filter=window.to_filter(),
+                                               sort="timestamp", **parameters):
+            fetched_pages += 1
+            if window.skip_ids:
+                page = Page([item for item in page if item["id"] not in window.skip_ids], page.included,
+                            page.next_cursor)
+
+            for item in page:
+                timestamp = item.get("attributes", {}).get("timestamp")
+                if timestamp != last_timestamp:
+                    last_timestamp = timestamp
+                    ids_at_last_timestamp = set()
+                ids_at_last_timestamp.add(item["id"])
+
+            if not _put_until_stopped(pages, (window, page, None), consumer_stopped):
+                break
+
+            if (page.next_cursor and fetched_pages >= planner.max_pages_per_window
+                    and last_timestamp is not None and last_timestamp > window.start):
+                planner.split(TimeWindow(last_timestamp, window.end, window.include_end,
+                                         frozenset(ids_at_last_timestamp)))
+                break
+
+        return fetched_pages
+
+    def _events_parameters(self, fields: List[str] = None, include: List[str] = None,
+                           metric_fields: List[str] = None, profile_fields: List[str] = None) -> Dict:
+        """
+        Returns the request parameters of the events. The included metrics and profiles are sideloaded
+        and returned in the `included` attribute of each page.
+        """
+        parameters = self._sparse_fieldset("fields_event", fields)
+        if include:
+            parameters.update(include=include, **self._sparse_fieldset("fields_metric", metric_fields),
+                              **self._sparse_fieldset("fields_profile", profile_fields))
+        return parameters
 
-    def get_lists(self) -> Iterator[List[Dict]]:
-        return self._paginate_cursor_endpoint(self.client.Lists.get_lists)
+    def get_lists(self, fields: List[str] = None) -> Iterator[List[Dict]]:
+        return self._paginate_cursor_endpoint(self.client.Lists.get_lists,
+                                              **self._sparse_fieldset("fields_list", fields))
 
     def get_list(self, list_id: str) -> Dict:
         try:
-            return self.client.Lists.get_list(list_id)
+            return self._call(self.client.Lists.get_list, id=list_id)
         except OpenApiException as api_exc:
             error_message = self._process_error(api_exc)
-            raise KlaviyoClientException(error_message) from api_exc
-
-    def get_list_ids(self) -> List[Dict]:
-        all_list_ids = []
-        for page in self._paginate_cursor_endpoint(self.client.Lists.get_lists):
-            all_list_ids.extend({"id": row.get("id"), "name": row.get("attributes").get("name")} for row in page)
-        return all_list_ids
-
-    def get_segment_ids(self) -> List[Dict]:
-        all_segment_ids = []
-        for page in self._paginate_cursor_endpoint(self.client.Segments.get_segments):
-            all_segment_ids.extend({"id": row.get("id"), "name": row.get("attributes").get("name")} for row in page)
-        return all_segment_ids
+            raise KlaviyoClientException(error_message, status=getattr(api_exc, "status", None)) from api_exc
 
-    def get_metric_ids(self) -> List[Dict]:
-        all_metric_ids = []
-        for page in self._paginate_cursor_endpoint(self.client.Metrics.get_metrics):
-            all_metric_ids.extend({"id": row.get("id"), "name": row.get("attributes").get("name")} for row in page)
-        return all_metric_ids
+    def get_lists_by_ids(self, list_ids: List[str]) -> Iterator[List[Dict]]:
+        """
+        Fetches the names of the lists with the given IDs, IDs that do not exist are not returned.
+        """
+        return self._paginate_cursor_endpoint(self.client.Lists.get_lists, filter=self._any_id_filter(list_ids),
+                                              fields_list=["name"])
+
+    def get_list_profiles(self, list_id: str, page_cursor: str = None, fields: List[str] = None,
+                          page_size: int = None) -> Iterator[List[Dict]]:
+        return self._paginate_cursor_endpoint(self.client.Lists.get_list_profiles, page_cursor=page_cursor,
+                                              id=list_id, page_size=self._get_page_size("Lists.get_list_profiles",
+                                                                                        page_size),
+                                              **self._sparse_fieldset("fields_profile", fields))
+
+    def get_profiles(self, page_cursor: str = None, fields: List[str] = None, page_size: int = None,
+                     updated_since: int = None) -> Iterator[List[Dict]]:
+        """
+        If updated_since is set, only profiles updated after that timestamp are returned.
+        """
+        kwargs = {}
+        if updated_since:
+            updated = datetime.fromtimestamp(updated_since, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+            kwargs["filter"] = f"greater-than(updated,{updated})"
+        return self._paginate_cursor_endpoint(self.client.Profiles.get_profiles, page_cursor=page_cursor,
+                                              page_size=self._get_page_size("Profiles.get_profiles", page_size),
+                                              **self._sparse_fieldset("fields_profile", fields), **kwargs)
+
+    def get_profiles_by_ids(self, profile_ids: List[str], fields: List[str] = None) -> Iterator[List[Dict]]:
+        """
+        Fetches the profiles with the given IDs, at most a page of IDs should be requested at once.
+        """
+        return self._paginate_cursor_endpoint(self.client.Profiles.get_profiles,
+                                              filter=self._any_id_filter(profile_ids),
+                                              page_size=self._get_page_size("Profiles.get_profiles"),
+                                              **self._sparse_fieldset("fields_profile", fields))
 
-    def get_list_profiles(self, list_id: str) -> Iterator[List[Dict]]:
-        return self._paginate_cursor_endpoint(self.client.Lists.get_list_profiles, list_id=list_id)
+    def get_list_profile_ids(self, list_id: str) -> Iterator[List[Dict]]:
+        return self._paginate_cursor_endpoint(self.client.Lists.get_profile_ids_for_list, id=list_id,
+                                              page_size=self._get_page_size("Lists.get_profile_ids_for_list"))
 
-    def get_profiles(self) -> Iterator[List[Dict]]:
-        return self._paginate_cursor_endpoint(self.client.Profiles.get_profiles)
+    def get_segment_profile_ids(self, segment_id: str) -> Iterator[List[Dict]]:
+        return self._paginate_cursor_endpoint(self.client.Segments.get_profile_ids_for_segment, id=segment_id,
+                                              page_size=self._get_page_size("Segments.get_profile_ids_for_segment"))
 
     def get_segments(self, fields_segment: list[str]) -> Iterator[List[Dict]]:
         return self._paginate_cursor_endpoint(self.client.Segments.get_segments, fields_segment=fields_segment)
 
+    def get_segments_by_ids(self, segment_ids: List[str]) -> Iterator[List[Dict]]:
+        """
+        Fetches the names of the segments with the given IDs, IDs that do not exist are not returned.
+        """
+        return self._paginate_cursor_endpoint(self.client.Segments.get_segments,
+                                              filter=self._any_id_filter(segment_ids), fields_segment=["name"])
+
     def get_segment(self, segment_id):
         try:
-            return self.client.Segments.get_segment(segment_id)
+            return self._call(self.client.Segments.get_segment, id=segment_id)
         except OpenApiException as api_exc:
             error_message = self._process_error(api_exc)
-            raise KlaviyoClientException(error_message) from api_exc
-
-    def get_segment_profiles(self, segment_id: str) -> Iterator[List[Dict]]:
-        return self._paginate_cursor_endpoint(self.client.Segments.get_segment_profiles, id=segment_id)
+            raise KlaviyoClientException(error_message, status=getattr(api_exc, "status", None)) from api_exc
+
+    def get_segment_profiles(self, segment_id: str, page_cursor: str = None, fields: List[str] = None,
+                             page_size: int = None) -> Iterator[List[Dict]]:
+        return self._paginate_cursor_endpoint(self.client.Segments.get_segment_profiles, page_cursor=page_cursor,
+                                              id=segment_id,
+                                              page_size=self._get_page_size("Segments.get_segment_profiles",
+                                                                            page_size),
+                                              **self._sparse_fieldset("fields_profile", fields))
+
+    def get_flows(self, fields: List[str] = None, page_size: int = None) -> Iterator[List[Dict]]:
+        return self._paginate_cursor_endpoint(self.client.Flows.get_flows,
+                                              page_size=self._get_page_size("Flows.get_flows", page_size),
+                                              **self._sparse_fieldset("fields_flow", fields))
+
+    def get_templates(self, fields: List[str] = None) -> Iterator[List[Dict]]:
+        return self._paginate_cursor_endpoint(self.client.Templates.get_templates,
+                                              **self._sparse_fieldset("fields_template", fields))
+
+    def get_campaigns(self, channel: str, include_messages: bool = False, fields: List[str] = None,
+                      message_fields: List[str] = None) -> Iterator[List[Dict]]:
+        """
+        If include_messages is set, the campaign messages are sideloaded and returned in the `included`
+        attribute of each page.
+        """
+        kwargs = {**self._sparse_fieldset("fields_campaign", fields)}
+        if include_messages:
+            kwargs.update(include=["campaign-messages"], **self._sparse_fieldset("fields_campaign_message",
+                                                                                 message_fields))
+        return self._paginate_cursor_endpoint(self.client.Campaigns.get_campaigns,
+                                              filter=f"equals(messages.channel,'{channel}')", **kwargs)
 
-    def get_flows(self) -> Iterator[List[Dict]]:
-        return self._paginate_cursor_endpoint(self.client.Flows.get_flows)
+    def get_campaign_messages(self, campaign_id: str, fields: List[str] = None) -> Iterator[List[Dict]]:
+        return self._paginate_cursor_endpoint(self.client.Campaigns.get_campaign_campaign_messages, id=campaign_id,
+                                              **self._sparse_fieldset("fields_campaign_message", fields))
 
-    def get_templates(self) -> Iterator[List[Dict]]:
-        return self._paginate_cursor_endpoint(self.client.Templates.get_templates)
+    @staticmethod
+    def _get_page_size(endpoint_name: str, page_size: int = None) -> int:
+        """
+        Returns the requested page size limited to the maximum of the endpoint, the maximum if none is requested.
+        """
+        max_page_size = MAX_PAGE_SIZES[endpoint_name]
+        return min(page_size, max_page_size) if page_size else max_page_size
 
-    def get_campaigns(self, channel: str) -> Iterator[List[Dict]]:
-        return self._paginate_cursor_endpoint(self.client.Campaigns.get_campaigns,
-                                              filter=f"equals(messages.channel,'{channel}')")
+    @staticmethod
+    def _any_id_filter(ids: List[str]) -> str:
+        return f"any(id,{json.dumps(ids, separators=(',', ':'))})"
 
-    def get_campaign_messages(self, campaign_id: str) -> Iterator[List[Dict]]:
-        return self._paginate_cursor_endpoint(self.client.Campaigns.get_campaign_campaign_messages, id=campaign_id)
+    @staticmethod
+    def _sparse_fieldset(parameter_name: str, fields: List[str] = None) -> Dict:
+        """
+        Returns the sparse fieldset request parameter, only the listed attributes are then returned by the API.
+        """
+        return {parameter_name: fields} if fields else {}
 
     def get_metric(self, metric_id: str):
         try:
-            return self.client.Metrics.get_metric(metric_id)
+            return self._call(self.client.Metrics.get_metric, id=metric_id)
         except OpenApiException as api_exc:
             error_message = self._process_error(api_exc)
-            raise KlaviyoClientException(error_message) from api_exc
+            raise KlaviyoClientException(error_message, status=getattr(api_exc, "status", None)) from api_exc
 
     def query_metric_aggregates(self,
                                 metric_id: str,
@@ -114,6 +435,55 @@ class KlaviyoClient:
                                 from_timestamp: int,
                                 to_timestamp: int,
                                 by: list) -> Iterator[List[Dict]]:
+        for start_date, end_date in self._metric_aggregate_date_ranges(interval, from_timestamp, to_timestamp):
+            for response in self._query_metric_aggregate_range(metric_id, interval, start_date, end_date, by):
+                yield from self._batch_records(self._normalize_aggregated_response(response, metric_id))
+
+    def query_metric_aggregates_concurrently(self, metrics: List[str], interval: str, from_timestamp: int,
+                                             to_timestamp: int, by: list, workers: int) -> Iterator[List[Dict]]:
+        """
+        Queries the aggregates of all metrics with the time range split into date ranges accepted by a single query.
+        Each metric and date range is queried by one of `workers` threads, the responses are normalized in the
+        consumer thread in the order the queries finish.
+        """
+        date_ranges = self._metric_aggregate_date_ranges(interval, from_timestamp, to_timestamp)
+
+        def query(metric_id: str, start_date: date, end_date: date) -> List[Dict]:
+            return list(self._query_metric_aggregate_range(metric_id, interval, start_date, end_date, by))
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="metric-aggregates") as executor:
+            futures = {executor.submit(query, metric_id, start_date, end_date): metric_id
+                       for metric_id in metrics for start_date, end_date in date_ranges}
+            try:
+                for future in as_completed(futures):
+                    for response in future.result():
+                        yield from self._batch_records(self._normalize_aggregated_response(response,
+                                                                                           futures[future]))
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    @staticmethod
+    def _metric_aggregate_date_ranges(interval: str, from_timestamp: int,
+                                      to_timestamp: int) -> List[Tuple[date, date]]:
+        """
+        Splits the time range into [start, end) date ranges no longer than a single query of the interval accepts.
+        Weekly and monthly aggregates are split only at the start of a week (Monday) or a month, so no week or
+        month is aggregated partly by one query and partly by the next one.
+        """
+        start_date = datetime.fromtimestamp(from_timestamp).date()
+        end_date = datetime.fromtimestamp(to_timestamp).date()
+        max_days = timedelta(days=MAX_METRIC_AGGREGATE_DAYS.get(interval, DEFAULT_MAX_METRIC_AGGREGATE_DAYS))
+
+        date_ranges = []
+        while start_date < end_date:
+            range_end = min(_get_interval_start(start_date + max_days, interval), end_date)
+            date_ranges.append((start_date, range_end))
+            start_date = range_end
+        return date_ranges or [(start_date, end_date)]
+
+    def _query_metric_aggregate_range(self, metric_id: str, interval: str, start_date: date, end_date: date,
+                                      by: list) -> Iterator[Dict]:
         metric_aggregate_query = {
             "data": {
                 "type": "metric-aggregate",
@@ -129,54 +499,55 @@ class KlaviyoClient:
                     "by": by,
                     "return_fields": None,
                     "filter": [
-                        f"greater-or-equal(datetime,{datetime.fromtimestamp(from_timestamp).date()}T00:00:00)",
-                        f"less-than(datetime,{datetime.fromtimestamp(to_timestamp).date()}T00:00:00)"
+                        f"greater-or-equal(datetime,{start_date}T00:00:00)",
+                        f"less-than(datetime,{end_date}T00:00:00)"
                     ],
                     "metric_id": metric_id,
                     "sort": None
                 }
             }
         }
-        for page in self._paginate_cursor_endpoint(
-                self.client.Metrics.query_metric_aggregates,
-                metric_aggregate_query=MetricAggregateQuery.from_dict(metric_aggregate_query)):
-            yield self._normalize_aggregated_response(page, metric_id)
+        return self._iterate_cursor_pages(self.client.Metrics.query_metric_aggregates,
+                                          metric_aggregate_query=MetricAggregateQuery.from_dict(metric_aggregate_query))
+
+    @staticmethod
+    def _batch_records(records: Iterator[Dict], batch_size: int = METRIC_AGGREGATE_PAGE_ROWS) -> Iterator[List[Dict]]:
+        while batch := list(islice(records, batch_size)):
+            yield batch
 
-    def _normalize_aggregated_response(self, json_data: Dict, metric_id: str) -> Dict:
+    def _normalize_aggregated_response(self, json_data: Dict, metric_id: str) -> Iterator[Dict]:
         """
         This method normalizes the response data from the Query Metric Aggregates endpoint,
-        transforming it into a structure compatible with the default parser.
+        transforming it into records compatible with the default parser. The records are generated
+        one by one from the measurement columns of each partition, so only the records being written are in memory.
         """
 
         json_data = self._repair_metric_aggregates_response(json_data)
-        transformed_data = []
         try:
             dates = json_data["attributes"]["dates"]
             data = json_data["attributes"]["data"]
             for partitioned_data in data:
-                counts = partitioned_data["measurements"]["count"]
-                uniques = partitioned_data["measurements"]["unique"]
-                sum_value = partitioned_data["measurements"]["sum_value"]
+                measurements = partitioned_data["measurements"]
                 dimensions = partitioned_data["dimensions"]
-                for idx, date in enumerate(dates):
-                    record = {
+                id_suffix = f"_{metric_id}{self._join_list_to_string(dimensions)}"
+                filled_dimensions = self._fill_empty_dimension(dimensions)
+                for date_value, count, unique, sum_value in zip(dates, measurements["count"], measurements["unique"],
+                                                                measurements["sum_value"]):
+                    yield {
                         "type": "metric_aggregate",
-                        "id": f"{date}_{metric_id}{self._join_list_to_string(dimensions)}",
+                        "id": date_value + id_suffix,
                         "attributes": {
                             "metric_id": metric_id,
-                            "date": date,
-                            "count": counts[idx],
-                            "unique": uniques[idx],
-                            "sum_value": sum_value[idx],
-                            "dimensions": self._fill_empty_dimension(dimensions)
+                            "date": date_value,
+                            "count": count,
+                            "unique": unique,
+                            "sum_value": sum_value,
+                            "dimensions": filled_dimensions
                         }
                     }
-                    transformed_data.append(record)
         except (IndexError, TypeError, AttributeError) as err:
             raise UserException(err) from err
 
-        return transformed_data
-
     def _fill_empty_dimension(self, dimensions: list) -> List[str]:
         filled_dimensions = []
         if len(dimensions) == 0:
@@ -213,26 +584,67 @@ class KlaviyoClient:
                 joined_list += f"_{item}"
         return joined_list
 
-    def _paginate_cursor_endpoint(self, endpoint_func: Callable, **kwargs) -> Iterator[List[Dict]]:
+    def _paginate_cursor_endpoint(self, endpoint_func: Callable, page_cursor: str = None,
+                                  **kwargs) -> Iterator[List[Dict]]:
+        """
+        Iterates the pages of the endpoint, starting at page_cursor if it is set.
+        """
+        pages = self._iterate_cursor_pages(endpoint_func, page_cursor=page_cursor, **kwargs)
+        if self.prefetch_pages > 0:
+            return self._read_ahead(pages, self.prefetch_pages)
+        return pages
+
+    def _iterate_cursor_pages(self, endpoint_func: Callable, page_cursor: str = None,
+                              **kwargs) -> Iterator[List[Dict]]:
+        next_page = page_cursor
+        while True:
+            try:
+                if next_page:
+                    current_page = self._call(endpoint_func, **kwargs, page_cursor=next_page)
+                else:
+                    current_page = self._call(endpoint_func, **kwargs)
+            except OpenApiException as api_exc:
+                error_message = self._process_error(api_exc)
+                raise KlaviyoClientException(error_message, status=getattr(api_exc, "status", None)) from api_exc
 
-        @backoff.on_exception(backoff.expo, OpenApiException, max_tries=5, factor=5)
-        def fetch_page(**kwargs):
-            return endpoint_func(**kwargs)
+            next_page = current_page.get("links").get("next")
+            data = current_page.get("data")
+            # single resource responses, e.g. of metric aggregates, are yielded as they are
+            yield Page(data, current_page.get("included"), next_page) if isinstance(data, list) else data
+            if not next_page:
+                return
 
-        try:
-            current_page = fetch_page(**kwargs)
-        except OpenApiException as api_exc:
-            error_message = self._process_error(api_exc)
-            raise KlaviyoClientException(error_message) from api_exc
-        yield current_page.get("data")
+    @staticmethod
+    def _read_ahead(pages: Iterator[List[Dict]], depth: int) -> Iterator[List[Dict]]:
+        """
+        Follows the page cursors in a background thread while the consumer processes the already fetched pages.
+        At most `depth` pages wait in the queue, so the memory used by the read-ahead stays bounded.
+        Exceptions raised while fetching are re-raised in the consumer thread.
+        """
+        buffer = queue.Queue(maxsize=depth)
+        consumer_stopped = threading.Event()
 
-        while next_page := current_page.get("links").get("next"):
+        def fetch_pages():
             try:
-                current_page = fetch_page(**kwargs, page_cursor=next_page)
-            except OpenApiException as api_exc:
-                error_message = self._process_error(api_exc)
-                raise KlaviyoClientException(error_message) from api_exc
-            yield current_page.get("data")
+                for page in pages:
+                    if not _put_until_stopped(buffer, (page, None), consumer_stopped):
+                        return
+                _put_until_stopped(buffer, (_END_OF_PAGES, None), consumer_stopped)
+            except Exception as exc:
+                _put_until_stopped(buffer, (None, exc), consumer_stopped)
+
+        fetcher = threading.Thread(target=fetch_pages, name="page-prefetch", daemon=True)
+        fetcher.start()
+        try:
+            while True:
+                page, exc = buffer.get()
+                if exc is not None:
+                    raise exc
+                if page is _END_OF_PAGES:
+                    return
+                yield page
+        finally:
+            consumer_stopped.set()
 
     def _process_error(self, api_exc: Exception) -> str:
         try:
@@ -242,62 +654,4 @@ class KlaviyoClient:
         if len(error_data.get('errors', [])) == 0:
             return error_data
         error = error_data.get('errors')[0]
-        return self._generate_error_message_v2_client(error)
-
-    @staticmethod
-    def _generate_error_message_v2_client(error_data: Dict) -> str:
-        error_detail = f"{error_data.get('title')} {error_data.get('detail')}"
-        if error_data.get('status') == 401:
-            error_name = f"Not Authorized Error ({error_data.get('status')})"
-        elif error_data.get('status') == 403:
-            error_name = f"Forbidden Error ({error_data.get('status')})"
-        elif error_data.get('status') == 404:
-            error_name = f"Not Found Error ({error_data.get('status')})"
-        else:
-            error_name = f"{error_data.get('code')} ({error_data.get('status')})"
-        return f"{error_name} : {error_detail}"
-
-    def test_credentials(self) -> Tuple[bool, Dict, Exception]:
-        """
-        Test credentials. Returns list of unauthorized scopes if present,
-
-        Returns:
-
-        """
-        missing_scopes = dict()
-        valid_token = False
-        last_exception = None
-        test_scopes = {"campaigns": self.client.Campaigns.get_campaigns,
-                       "catalogs": self.client.Catalogs.get_catalog_items,
-                       "events": self.client.Events.get_events,
-                       "lists": self.client.Lists.get_lists,
-                       "metrics": self.client.Metrics.get_metrics,
-                       "profiles": self.client.Profiles.get_profiles,
-                       "segments": self.client.Segments.get_segments
-                       }
-
-        # test scopes
-        for scope in test_scopes:
-            try:
-                if scope == "campaigns":
-                    test_scopes[scope](filter="equals(messages.channel,'email')")
-                else:
-                    test_scopes[scope]()
-
-                valid_token = True
-            except OpenApiException as e:
-                json_resp = json.loads(e.body)
-                detail = ''
-                reason = e.reason
-                if json_resp.get('errors'):
-                    detail = json_resp['errors'][0]["detail"]
-
-                logging.debug(f"Test {scope} scope failed with {e}")
-                missing_scopes[scope] = f'{reason}: {detail}'
-                # token is valid when unauthorized error received
-                if e.status == 403:
-                    valid_token = True
-                else:
-                    last_exception = e
-
-        return valid_token, missing_scopes, last_exception
+        return format_error_message(error)
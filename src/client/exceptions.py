@@ -0,0 +1,33 @@
+from typing import Dict, Optional
+
+STATUS_TOO_MANY_REQUESTS = 429
+
+
+class KlaviyoClientException(Exception):
+    def __init__(self, message: str = "", status: Optional[int] = None):
+        super().__init__(message)
+        # HTTP status of the failed request, None if the request did not get a response
+        self.status = status
+
+    @property
+    def is_permanent(self) -> bool:
+        """
+        Client errors other than throttling, e.g. a missing scope of the API token, fail again when repeated.
+        """
+        return self.status is not None and 400 <= self.status < 500 and self.status != STATUS_TOO_MANY_REQUESTS
+
+
+def format_error_message(error_data: Dict) -> str:
+    """
+    Returns the message of an error object of the API response.
+    """
+    error_detail = f"{error_data.get('title')} {error_data.get('detail')}"
+    if error_data.get('status') == 401:
+        error_name = f"Not Authorized Error ({error_data.get('status')})"
+    elif error_data.get('status') == 403:
+        error_name = f"Forbidden Error ({error_data.get('status')})"
+    elif error_data.get('status') == 404:
+        error_name = f"Not Found Error ({error_data.get('status')})"
+    else:
+        error_name = f"{error_data.get('code')} ({error_data.get('status')})"
+    return f"{error_name} : {error_detail}"
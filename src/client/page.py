@@ -0,0 +1,20 @@
+from typing import Dict, List
+
+
+class Page(list):
+    """
+    Resources of a single API page. Resources sideloaded through the `include` request parameter
+    are available in the `included` attribute, the link to the following page in `next_cursor`.
+
+    The `checkpoint` holds the arguments of the getter that continue the extraction after this page,
+    by default the cursor of the following page.
+    """
+
+    def __init__(self, data: List[Dict], included: List[Dict] = None, next_cursor: str = None,
+                 checkpoint: Dict = None):
+        super().__init__(data)
+        self.included = included or []
+        self.next_cursor = next_cursor
+        if checkpoint is None and next_cursor:
+            checkpoint = {"page_cursor": next_cursor}
+        self.checkpoint = checkpoint
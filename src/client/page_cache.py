@@ -0,0 +1,92 @@
+import gzip
+import json
+import threading
+from typing import Dict, Iterator, Optional
+
+PAGE_CACHE_RECORD = "record"
+PAGE_CACHE_REPLAY = "replay"
+
+# every line of the cache is an object with the key followed by the response
+_KEY_PREFIX = '{"key":'
+_RESPONSE_PREFIX = ',"response":'
+
+
+class PageCacheMiss(KeyError):
+    pass
+
+
+class PageCache:
+    """
+    Gzip compressed NDJSON file of raw API responses keyed by the endpoint and the parameters of the request,
+    including the filter and the page cursor. The first line holds the metadata of the run that recorded the cache.
+
+    In the record mode every response is appended to the file as it arrives, in the replay mode the responses are
+    served from the file instead of calling the API. The responses are kept as JSON strings until requested,
+    so a replayed cache takes roughly its uncompressed size in memory.
+    """
+
+    def __init__(self, path: str, mode: str, metadata: Dict = None):
+        self.path = path
+        self.mode = mode
+        self._lock = threading.Lock()
+        self._file = None
+        self._responses: Dict[str, str] = {}
+
+        if mode == PAGE_CACHE_RECORD:
+            self.metadata = metadata or {}
+            self._file = gzip.open(path, "wt", encoding="utf-8", compresslevel=6)
+            self._file.write(json.dumps({"metadata": self.metadata}) + "\n")
+        elif mode == PAGE_CACHE_REPLAY:
+            self.metadata = {}
+            self._load()
+        else:
+            raise ValueError(f"Unknown page cache mode '{mode}'")
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode == PAGE_CACHE_REPLAY
+
+    @staticmethod
+    def make_key(endpoint_name: str, request_parameters: Dict) -> str:
+        parameters = json.dumps(request_parameters, sort_keys=True, separators=(",", ":"),
+                                default=PageCache._serialize_parameter)
+        return f"{endpoint_name}:{parameters}"
+
+    def get(self, endpoint_name: str, request_parameters: Dict) -> Dict:
+        key = self.make_key(endpoint_name, request_parameters)
+        response = self._responses.get(key)
+        if response is None:
+            raise PageCacheMiss(key)
+        return json.loads(response)
+
+    def put(self, endpoint_name: str, request_parameters: Dict, response: Dict) -> None:
+        line = "".join([_KEY_PREFIX, json.dumps(self.make_key(endpoint_name, request_parameters)), _RESPONSE_PREFIX,
+                        json.dumps(response, separators=(",", ":"), default=str), "}"])
+        with self._lock:
+            self._file.write(line + "\n")
+
+    def responses(self) -> Iterator[Dict]:
+        for response in self._responses.values():
+            yield json.loads(response)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _load(self) -> None:
+        decoder = json.JSONDecoder()
+        with gzip.open(self.path, "rt", encoding="utf-8") as cache_file:
+            self.metadata = json.loads(next(cache_file, "{}")).get("metadata", {})
+            for line in cache_file:
+                # only the key is decoded, the response stays a string until it is requested
+                key, key_end = decoder.raw_decode(line, len(_KEY_PREFIX))
+                self._responses[key] = line[key_end + len(_RESPONSE_PREFIX):line.rindex("}")]
+
+    @staticmethod
+    def _serialize_parameter(value) -> Optional[object]:
+        # request bodies such as the metric aggregates query are SDK models
+        if hasattr(value, "to_dict"):
+            return value.to_dict()
+        return str(value)
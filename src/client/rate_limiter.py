@@ -0,0 +1,201 @@
+import logging
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from openapi_client.exceptions import OpenApiException
+from urllib3.exceptions import HTTPError
+
+from .exceptions import STATUS_TOO_MANY_REQUESTS
+from .telemetry import Telemetry
+
+MAX_ATTEMPTS = 5
+BACKOFF_FACTOR = 5
+MAX_BACKOFF = 60
+
+# Klaviyo rate limit tiers as (burst requests per second, steady requests per minute)
+# https://developers.klaviyo.com/en/docs/rate_limits_and_error_handling
+RATE_LIMIT_TIERS = {
+    "XS": (1, 15),
+    "S": (3, 60),
+    "M": (10, 150),
+    "L": (75, 700),
+    "XL": (350, 3500),
+}
+DEFAULT_RATE_LIMIT_TIER = "M"
+
+ENDPOINT_RATE_LIMIT_TIERS = {
+    "Campaigns.get_campaigns": "M",
+    "Campaigns.get_campaign_campaign_messages": "M",
+    "Catalogs.get_catalog_items": "L",
+    "Catalogs.get_catalog_categories": "L",
+    "Events.get_events": "XL",
+    "Flows.get_flows": "M",
+    "Lists.get_lists": "L",
+    "Lists.get_list": "L",
+    "Lists.get_list_profiles": "L",
+    "Lists.get_profile_ids_for_list": "L",
+    "Metrics.get_metrics": "M",
+    "Metrics.get_metric": "M",
+    "Metrics.query_metric_aggregates": "S",
+    "Profiles.get_profiles": "L",
+    "Segments.get_segments": "L",
+    "Segments.get_segment": "L",
+    "Segments.get_segment_profiles": "L",
+    "Segments.get_profile_ids_for_segment": "L",
+    "Templates.get_templates": "M",
+}
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket allowing `capacity` requests per `period` seconds.
+    """
+
+    def __init__(self, capacity: int, period: float):
+        self.capacity = capacity
+        self.refill_rate = capacity / period
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """
+        Takes a token and returns the number of seconds the caller has to wait before using it.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.refill_rate)
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.refill_rate
+
+    def drain(self) -> None:
+        with self._lock:
+            self._tokens = min(self._tokens, 0)
+            self._updated = time.monotonic()
+
+
+class EndpointFamily:
+    """
+    Rate limit budget of one endpoint, Klaviyo limits every endpoint separately with the rates of its tier:
+    a burst and a steady token bucket and a pause set when the API asks to slow down.
+    """
+
+    def __init__(self, tier: str):
+        burst, steady = RATE_LIMIT_TIERS[tier]
+        self.tier = tier
+        self._buckets = (TokenBucket(burst, 1), TokenBucket(steady, 60))
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """
+        Blocks until a request may be sent. Returns the number of seconds waited.
+        """
+        with self._lock:
+            pause = max(self._paused_until - time.monotonic(), 0)
+        wait = max(pause, *(bucket.reserve() for bucket in self._buckets))
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def pause(self, seconds: float) -> None:
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        for bucket in self._buckets:
+            bucket.drain()
+
+
+class RequestScheduler:
+    """
+    Sends all requests of a client through per endpoint token buckets and retries the failed ones according to
+    the response status: 429 waits for the time given by Retry-After, 5xx and connection errors back off
+    exponentially and other 4xx errors are raised immediately.
+    """
+
+    def __init__(self, endpoint_tiers: Dict[str, str] = None, max_attempts: int = MAX_ATTEMPTS,
+                 telemetry: Telemetry = None):
+        self.endpoint_tiers = endpoint_tiers or ENDPOINT_RATE_LIMIT_TIERS
+        self.max_attempts = max_attempts
+        self.telemetry = telemetry or Telemetry()
+        self._families: Dict[str, EndpointFamily] = {}
+        self._families_lock = threading.Lock()
+        self._current = threading.local()
+
+    def call(self, endpoint_name: str, endpoint_func: Callable, **kwargs):
+        family = self._get_family(endpoint_name)
+
+        for attempt in range(1, self.max_attempts + 1):
+            self.telemetry.record_rate_limit_wait(endpoint_name, family.acquire())
+            self._current.family = family
+            self._current.endpoint_name = endpoint_name
+            try:
+                return endpoint_func(**kwargs)
+            except OpenApiException as exc:
+                status = getattr(exc, "status", None)
+                if status == STATUS_TOO_MANY_REQUESTS:
+                    delay = self._get_retry_after(exc) or self._get_backoff(attempt)
+                    family.pause(delay)
+                elif status and 400 <= status < 500:
+                    raise
+                else:
+                    delay = self._get_backoff(attempt)
+                if attempt == self.max_attempts:
+                    raise
+                logging.warning(f"Request to {endpoint_name} failed with status {status}, "
+                                f"retrying in {delay:.1f} seconds")
+                self.telemetry.record_retry(endpoint_name, status, delay,
+                                            throttled=status == STATUS_TOO_MANY_REQUESTS)
+            except HTTPError as exc:
+                if attempt == self.max_attempts:
+                    raise
+                delay = self._get_backoff(attempt)
+                logging.warning(f"Request to {endpoint_name} failed with {exc}, retrying in {delay:.1f} seconds")
+                self.telemetry.record_retry(endpoint_name, None, delay)
+            finally:
+                self._current.family = None
+                self._current.endpoint_name = None
+            time.sleep(delay)
+
+    def _get_family(self, endpoint_name: str) -> EndpointFamily:
+        with self._families_lock:
+            if endpoint_name not in self._families:
+                tier = self.endpoint_tiers.get(endpoint_name, DEFAULT_RATE_LIMIT_TIER)
+                self._families[endpoint_name] = EndpointFamily(tier)
+            return self._families[endpoint_name]
+
+    def current_endpoint_name(self) -> Optional[str]:
+        """
+        Name of the endpoint the current thread is sending a request to.
+        """
+        return getattr(self._current, "endpoint_name", None)
+
+    def observe_response_headers(self, headers: Dict) -> None:
+        """
+        Pauses the endpoint of the request being sent by the current thread when its rate limit window is used up.
+        """
+        family = getattr(self._current, "family", None)
+        if family is None or headers is None:
+            return
+        remaining = self._get_int_header(headers, "RateLimit-Remaining")
+        reset = self._get_int_header(headers, "RateLimit-Reset")
+        if remaining == 0 and reset:
+            family.pause(reset)
+
+    def _get_retry_after(self, exc: OpenApiException) -> Optional[int]:
+        return self._get_int_header(getattr(exc, "headers", None) or {}, "Retry-After")
+
+    @staticmethod
+    def _get_int_header(headers: Dict, name: str) -> Optional[int]:
+        value = headers.get(name)
+        try:
+            return int(value) if value is not None else None
+        except ValueError:
+            return None
+
+    @staticmethod
+    def _get_backoff(attempt: int) -> float:
+        return min(BACKOFF_FACTOR * 2 ** (attempt - 1), MAX_BACKOFF)
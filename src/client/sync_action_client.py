@@ -0,0 +1,102 @@
+from typing import Dict, List, Optional, Tuple
+
+import urllib3
+from urllib3.util import Retry, make_headers
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+from .exceptions import KlaviyoClientException, format_error_message
+
+API_HOST = "https://a.klaviyo.com"
+# revision of the API used by the Klaviyo SDK, requests of both clients return the same resources
+API_REVISION = "2024-10-15"
+
+REQUEST_TIMEOUT = 30
+MAX_RETRIES = 5
+
+# endpoint requested to check each scope of the API token and its request parameters
+SCOPE_ENDPOINTS = {
+    "campaigns": ("/api/campaigns", {"filter": "equals(messages.channel,'email')"}),
+    "catalogs": ("/api/catalog-items", {}),
+    "events": ("/api/events", {}),
+    "lists": ("/api/lists", {}),
+    "metrics": ("/api/metrics", {}),
+    "profiles": ("/api/profiles", {}),
+    "segments": ("/api/segments", {}),
+}
+
+
+class SyncActionClient:
+    """
+    Minimal client of the Klaviyo API used by the sync actions backing the configuration UI. It makes plain GET
+    requests without the Klaviyo SDK, whose import alone takes seconds, so the UI gets its response quickly.
+    Throttled and failed requests are retried by urllib3, respecting the Retry-After header of the API.
+    """
+
+    def __init__(self, api_token: str, host: str = API_HOST):
+        self.host = host
+        retries = Retry(total=MAX_RETRIES, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504],
+                        raise_on_status=False)
+        self._pool_manager = urllib3.PoolManager(retries=retries, timeout=REQUEST_TIMEOUT)
+        self._headers = {"Authorization": f"Klaviyo-API-Key {api_token}", "revision": API_REVISION,
+                         "Accept": "application/vnd.api+json", **make_headers(accept_encoding=True)}
+
+    def get_list_ids(self) -> List[Dict]:
+        return self._get_names("/api/lists", "list")
+
+    def get_segment_ids(self) -> List[Dict]:
+        return self._get_names("/api/segments", "segment")
+
+    def get_metric_ids(self) -> List[Dict]:
+        return self._get_names("/api/metrics", "metric")
+
+    def test_credentials(self) -> Tuple[bool, Dict, Optional[Exception]]:
+        """
+        Requests an endpoint of every scope. Returns whether the token is valid, the reason of each scope
+        that can not be read and the last error that does not mean a missing scope.
+        """
+        missing_scopes = {}
+        valid_token = False
+        last_exception = None
+        for scope, (path, fields) in SCOPE_ENDPOINTS.items():
+            response = self._request(self.host + path, fields)
+            if response.status < 400:
+                valid_token = True
+                continue
+
+            errors = self._decode(response).get("errors") or [{}]
+            missing_scopes[scope] = f"{response.reason}: {errors[0].get('detail', '')}"
+            # token is valid when unauthorized error received
+            if response.status == 403:
+                valid_token = True
+            else:
+                last_exception = KlaviyoClientException(format_error_message(errors[0]), status=response.status)
+        return valid_token, missing_scopes, last_exception
+
+    def _get_names(self, path: str, resource_type: str) -> List[Dict]:
+        names = []
+        url, fields = self.host + path, {f"fields[{resource_type}]": "name"}
+        while url:
+            response = self._request(url, fields)
+            body = self._decode(response)
+            if response.status >= 400:
+                errors = body.get("errors") or [{"status": response.status, "detail": response.reason}]
+                raise KlaviyoClientException(format_error_message(errors[0]), status=response.status)
+            names.extend({"id": row.get("id"), "name": row.get("attributes", {}).get("name")}
+                         for row in body.get("data", []))
+            # the link to the next page contains all request parameters
+            url, fields = (body.get("links") or {}).get("next"), None
+        return names
+
+    def _request(self, url: str, fields: Optional[Dict]) -> urllib3.BaseHTTPResponse:
+        return self._pool_manager.request("GET", url, fields=fields, headers=self._headers)
+
+    @staticmethod
+    def _decode(response: urllib3.BaseHTTPResponse) -> Dict:
+        try:
+            return json_loads(response.data) if response.data else {}
+        except ValueError as exc:
+            raise KlaviyoClientException(f"Error Occurred. Failed to decode response : {response.data}") from exc
@@ -0,0 +1,124 @@
+import bisect
+import threading
+from dataclasses import dataclass, field, asdict
+from typing import Dict, List, Optional
+
+# upper bounds in seconds of the request latency histogram buckets, the last bucket holds the slower requests
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+
+@dataclass
+class EndpointStats:
+    requests: int = 0
+    bytes_received: int = 0
+    bytes_decoded: int = 0
+    request_seconds: float = 0.0
+    max_request_seconds: float = 0.0
+    latency_histogram: List[int] = field(default_factory=lambda: [0] * (len(LATENCY_BUCKETS) + 1))
+    retries: int = 0
+    throttled: int = 0
+    # retries by the status of the failed response, failed connections are counted as "connection"
+    retry_statuses: Dict[str, int] = field(default_factory=dict)
+    backoff_seconds: float = 0.0
+    rate_limit_wait_seconds: float = 0.0
+
+
+@dataclass
+class ObjectStats:
+    pages: int = 0
+    rows: int = 0
+    fetch_seconds: float = 0.0
+    flatten_seconds: float = 0.0
+    write_seconds: float = 0.0
+
+
+class Telemetry:
+    """
+    Thread safe counters of a run. The client records the requests of each endpoint, the time spent waiting for
+    the rate limits and the retries, the component records the pages and rows of each object and the time spent
+    fetching, flattening and writing them.
+    """
+
+    def __init__(self):
+        self.endpoints: Dict[str, EndpointStats] = {}
+        self.objects: Dict[str, ObjectStats] = {}
+        self.finalize_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record_request(self, endpoint_name: str, seconds: float, bytes_received: int, bytes_decoded: int) -> None:
+        with self._lock:
+            stats = self._endpoint(endpoint_name)
+            stats.requests += 1
+            stats.bytes_received += bytes_received
+            stats.bytes_decoded += bytes_decoded
+            stats.request_seconds += seconds
+            stats.max_request_seconds = max(stats.max_request_seconds, seconds)
+            stats.latency_histogram[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def record_rate_limit_wait(self, endpoint_name: str, seconds: float) -> None:
+        if seconds <= 0:
+            return
+        with self._lock:
+            self._endpoint(endpoint_name).rate_limit_wait_seconds += seconds
+
+    def record_retry(self, endpoint_name: str, status: Optional[int], backoff_seconds: float,
+                     throttled: bool = False) -> None:
+        with self._lock:
+            stats = self._endpoint(endpoint_name)
+            stats.retries += 1
+            stats.throttled += 1 if throttled else 0
+            status_key = str(status) if status is not None else "connection"
+            stats.retry_statuses[status_key] = stats.retry_statuses.get(status_key, 0) + 1
+            stats.backoff_seconds += backoff_seconds
+
+    def record_object(self, object_name: str, pages: int, rows: int, fetch_seconds: float, flatten_seconds: float,
+                      write_seconds: float) -> None:
+        with self._lock:
+            stats = self.objects.setdefault(object_name, ObjectStats())
+            stats.pages += pages
+            stats.rows += rows
+            stats.fetch_seconds += fetch_seconds
+            stats.flatten_seconds += flatten_seconds
+            stats.write_seconds += write_seconds
+
+    def record_finalize(self, seconds: float) -> None:
+        with self._lock:
+            self.finalize_seconds += seconds
+
+    def report(self) -> Dict:
+        with self._lock:
+            endpoints = {}
+            for endpoint_name, stats in self.endpoints.items():
+                endpoint = asdict(stats)
+                endpoint["latency_histogram"] = dict(zip(self._bucket_labels(), stats.latency_histogram))
+                endpoints[endpoint_name] = endpoint
+            return {"endpoints": endpoints, "objects": {name: asdict(stats) for name, stats in self.objects.items()},
+                    "finalize_seconds": self.finalize_seconds}
+
+    def summary(self) -> List[str]:
+        """
+        Returns a line per object and per endpoint and the time spent finalizing the output tables.
+        """
+        with self._lock:
+            lines = [f"{name}: {stats.pages} pages, {stats.rows} rows, fetching {stats.fetch_seconds:.1f} s, "
+                     f"flattening {stats.flatten_seconds:.1f} s, writing {stats.write_seconds:.1f} s"
+                     for name, stats in self.objects.items()]
+            for name, stats in self.endpoints.items():
+                mean_latency = stats.request_seconds / stats.requests if stats.requests else 0
+                lines.append(f"{name}: {stats.requests} requests, {stats.bytes_received / 1024 ** 2:.1f} MB received, "
+                             f"mean latency {mean_latency:.2f} s (max {stats.max_request_seconds:.2f} s), "
+                             f"{stats.retries} retries ({stats.throttled} throttled), "
+                             f"backoff {stats.backoff_seconds:.1f} s, rate limit wait "
+                             f"{stats.rate_limit_wait_seconds:.1f} s")
+            lines.append(f"Finalizing the output tables took {self.finalize_seconds:.1f} s")
+            return lines
+
+    def _endpoint(self, endpoint_name: str) -> EndpointStats:
+        stats = self.endpoints.get(endpoint_name)
+        if stats is None:
+            stats = self.endpoints[endpoint_name] = EndpointStats()
+        return stats
+
+    @staticmethod
+    def _bucket_labels() -> List[str]:
+        return [f"<={bound}s" for bound in LATENCY_BUCKETS] + [f">{LATENCY_BUCKETS[-1]}s"]
@@ -0,0 +1,89 @@
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Optional, FrozenSet
+
+MIN_WINDOW_SECONDS = 60
+INITIAL_WINDOWS_PER_WORKER = 2
+
+
+@dataclass(frozen=True)
+class TimeWindow:
+    """
+    Range of timestamps [start, end) fetched by a single cursor chain. The last window of a range also includes
+    its end. IDs in skip_ids were already returned by the window this one was split from.
+    """
+    start: int
+    end: int
+    include_end: bool = False
+    skip_ids: FrozenSet[str] = field(default_factory=frozenset)
+
+    def to_filter(self, field_name: str = "timestamp") -> str:
+        end_operator = "less-or-equal" if self.include_end else "less-than"
+        return f"greater-or-equal({field_name},{self.start}),{end_operator}({field_name},{self.end})"
+
+
+class TimeWindowPlanner:
+    """
+    Hands out time windows of a timestamp range to concurrent fetchers, adapting the window size to the data
+    density: windows that return too many pages are split and make the following windows smaller, sparse windows
+    make the following windows larger. Windows handed out stay unfinished until the consumer marks them finished.
+    """
+
+    def __init__(self, start: int, end: int, workers: int, max_pages_per_window: int):
+        self._cursor = start
+        self._end = end
+        self.max_pages_per_window = max_pages_per_window
+        self._window_size = max((end - start) // max(workers * INITIAL_WINDOWS_PER_WORKER, 1), MIN_WINDOW_SECONDS)
+        self._split_windows = deque()
+        self._unfinished_windows = []
+        self._lock = threading.Lock()
+
+    def next_window(self) -> Optional[TimeWindow]:
+        with self._lock:
+            if self._split_windows:
+                window = self._split_windows.popleft()
+            elif self._cursor > self._end:
+                return None
+            elif self._cursor + self._window_size >= self._end:
+                window = TimeWindow(self._cursor, self._end, include_end=True)
+                self._cursor = self._end + 1
+            else:
+                window = TimeWindow(self._cursor, self._cursor + self._window_size)
+                self._cursor = window.end
+            self._unfinished_windows.append(window)
+            return window
+
+    def mark_finished(self, window: TimeWindow) -> None:
+        with self._lock:
+            self._unfinished_windows.remove(window)
+
+    def earliest_unfinished_start(self) -> Optional[int]:
+        """
+        Start of the earliest window that is not finished, either handed out or waiting in the queue of split
+        windows, or of the range not handed out yet. None once the whole range is finished.
+        """
+        with self._lock:
+            starts = [window.start for window in (*self._unfinished_windows, *self._split_windows)]
+            if self._cursor <= self._end:
+                starts.append(self._cursor)
+            return min(starts, default=None)
+
+    def split(self, remainder: TimeWindow) -> None:
+        """
+        Queues the unfetched remainder of a dense window, halved if it is large enough. The skip_ids of the
+        remainder only apply to its start second, so they are kept only in the first half.
+        """
+        with self._lock:
+            self._window_size = max(self._window_size // 2, MIN_WINDOW_SECONDS)
+            middle = remainder.start + (remainder.end - remainder.start) // 2
+            if middle - remainder.start < MIN_WINDOW_SECONDS:
+                self._split_windows.append(remainder)
+                return
+            self._split_windows.append(TimeWindow(remainder.start, middle, skip_ids=remainder.skip_ids))
+            self._split_windows.append(TimeWindow(middle, remainder.end, include_end=remainder.include_end))
+
+    def report_finished(self, pages: int) -> None:
+        if pages <= self.max_pages_per_window // 4:
+            with self._lock:
+                self._window_size *= 2
@@ -0,0 +1,72 @@
+import socket
+import threading
+from dataclasses import dataclass
+from typing import List
+
+from urllib3.connection import HTTPConnection
+from urllib3.util import make_headers
+
+DEFAULT_POOL_SIZE = 10
+
+# TCP keep-alive probes keep idle pooled connections open between the pages of slow consumers
+KEEP_ALIVE_SOCKET_OPTIONS = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+
+
+@dataclass
+class TransportStats:
+    requests: int
+    connections: int
+    compressed_responses: int
+
+    @property
+    def reused_connection_ratio(self) -> float:
+        if not self.requests:
+            return 0.0
+        return max(self.requests - self.connections, 0) / self.requests
+
+    @classmethod
+    def total(cls, stats: List["TransportStats"]) -> "TransportStats":
+        return cls(sum(item.requests for item in stats), sum(item.connections for item in stats),
+                   sum(item.compressed_responses for item in stats))
+
+
+class HttpTransport:
+    """
+    Settings of the HTTP connection pool used by the SDK. Every concurrent request holds one connection of the pool,
+    so the pool is sized to the number of threads making requests, otherwise connections over the pool size
+    are closed after each request and opened again by the next one.
+    """
+
+    def __init__(self, pool_size: int = DEFAULT_POOL_SIZE, compress_responses: bool = True):
+        self.pool_size = max(pool_size, 1)
+        self.compress_responses = compress_responses
+        self._pool_manager = None
+        self._compressed_responses = 0
+        self._lock = threading.Lock()
+
+    def install(self, api_client) -> None:
+        """
+        Applies the settings to the API client of the SDK. Pools of the pool manager are created with the first
+        request to a host, so the settings apply to all connections.
+        """
+        self._pool_manager = api_client.rest_client.pool_manager
+        self._pool_manager.connection_pool_kw.update(maxsize=self.pool_size, socket_options=KEEP_ALIVE_SOCKET_OPTIONS)
+        if self.compress_responses:
+            # urllib3 decompresses the responses, brotli is requested only when its decoder is installed
+            api_client.default_headers.update(make_headers(accept_encoding=True))
+
+    def observe_response(self, response) -> None:
+        if response.getheader("content-encoding"):
+            with self._lock:
+                self._compressed_responses += 1
+
+    def stats(self) -> TransportStats:
+        requests = connections = 0
+        if self._pool_manager is not None:
+            pools = self._pool_manager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    requests += pool.num_requests
+                    connections += pool.num_connections
+        return TransportStats(requests, connections, self._compressed_responses)
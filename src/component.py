@@ -1,22 +1,36 @@
 import copy
+import glob
 import json
 import logging
+import os
+import re
+import threading
+import time
 import warnings
-from typing import List, Callable, Dict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import asdict
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING, List, Callable, Dict, Optional
 
-import dateparser
 from keboola.component.base import ComponentBase, sync_action
 from keboola.component.dao import TableDefinition
 from keboola.component.exceptions import UserException
 from keboola.component.sync_actions import ValidationResult, MessageType, SelectElement
-from keboola.csvwriter import ElasticDictWriter
-from keboola.utils import header_normalizer
+from keboola.component.table_schema import FieldSchema
 
-from client import KlaviyoClient, KlaviyoClientException
+from client import (KlaviyoClientException, Page, PageCache, HttpTransport, SyncActionClient, Telemetry,
+                    TransportStats, PAGE_CACHE_RECORD, PAGE_CACHE_REPLAY)
 from json_parser import FlattenJsonParser
+from table_writers import SlicedCsvWriter, SharedRowWriter, ParquetWriter, parquet_available
+
+if TYPE_CHECKING:
+    from client import KlaviyoClient
 
 KEY_API_TOKEN = "#api_token"
 
+KEY_ACCOUNTS = "accounts"
+KEY_ACCOUNT_ID = "account_id"
+
 KEY_OBJECTS = "objects"
 
 KEY_TIME_RANGE_SETTINGS = "time_range_settings"
@@ -30,11 +44,15 @@ KEY_CAMPAIGNS_SETTINGS = "campaigns_settings"
 KEY_CAMPAIGNS_SETTINGS_FETCH_CAMPAIGN_CHANNELS = "fetch_campaign_channels"
 
 KEY_EVENTS_SETTINGS = "events_settings"
+KEY_EVENTS_SETTINGS_INCLUDE_METRICS = "include_metrics"
+KEY_EVENTS_SETTINGS_INCLUDE_PROFILES = "include_profiles"
 
 KEY_PROFILES_SETTINGS = "profiles_settings"
 KEY_PROFILES_SETTINGS_FETCH_PROFILES_MODE = "fetch_profiles_mode"
 KEY_PROFILES_SETTINGS_FETCH_BY_LIST = "fetch_profiles_by_list"
 KEY_PROFILES_SETTINGS_FETCH_BY_SEGMENT = "fetch_profiles_by_segment"
+KEY_PROFILES_SETTINGS_DEDUPLICATE = "deduplicate_profiles"
+KEY_PROFILES_SETTINGS_INCREMENTAL = "incremental_profiles"
 
 KEY_METRIC_AGGREGATES_SETTINGS = "metric_aggregates_settings"
 KEY_METRIC_AGGREGATES_SETTINGS_METRIC_IDS = "metric_aggregates_ids"
@@ -43,7 +61,33 @@ KEY_METRIC_AGGREGATES_SETTING_BY = 'metric_aggregates_partitioning_by'
 
 KEY_STORE_NESTED_ATTRIBUTES = "store_nested_attributes"
 
-REQUIRED_PARAMETERS = [KEY_API_TOKEN, KEY_OBJECTS]
+KEY_FLATTEN_SETTINGS = "flatten_settings"
+KEY_FLATTEN_SETTINGS_MAX_DEPTH = "max_depth"
+KEY_FLATTEN_SETTINGS_FLATTEN_COLUMNS = "flatten_columns"
+
+KEY_OUTPUT_FORMAT = "output_format"
+KEY_PAGE_CACHE_MODE = "page_cache_mode"
+
+KEY_PERFORMANCE_SETTINGS = "performance_settings"
+KEY_PERFORMANCE_SETTINGS_MAX_WORKERS = "max_workers"
+KEY_PERFORMANCE_SETTINGS_PREFETCH_PAGES = "prefetch_pages"
+KEY_PERFORMANCE_SETTINGS_EVENT_WINDOW_WORKERS = "event_window_workers"
+KEY_PERFORMANCE_SETTINGS_RESUME_FROM_CHECKPOINT = "resume_from_checkpoint"
+KEY_PERFORMANCE_SETTINGS_PAGE_SIZES = "page_sizes"
+KEY_PERFORMANCE_SETTINGS_CONNECTION_POOL_SIZE = "connection_pool_size"
+KEY_PERFORMANCE_SETTINGS_COMPRESS_RESPONSES = "compress_responses"
+KEY_PERFORMANCE_SETTINGS_RAW_RESPONSES = "raw_responses"
+KEY_PERFORMANCE_SETTINGS_TELEMETRY_REPORT = "telemetry_report"
+KEY_PERFORMANCE_SETTINGS_ACCOUNT_WORKERS = "account_workers"
+KEY_PERFORMANCE_SETTINGS_SLICE_MAX_ROWS = "slice_max_rows"
+KEY_PERFORMANCE_SETTINGS_SLICE_MAX_MEGABYTES = "slice_max_megabytes"
+KEY_PERFORMANCE_SETTINGS_COMPRESSION_WORKERS = "compression_workers"
+
+KEY_FIELDS_SETTINGS = "fields_settings"
+KEY_FIELDS_SETTINGS_PRESET = "fields_preset"
+
+# the API token is required unless the accounts are configured, see _get_accounts
+REQUIRED_PARAMETERS = [KEY_OBJECTS]
 REQUIRED_IMAGE_PARS = []
 
 OBJECT_ENDPOINTS = ["campaigns", "flows", "templates", "catalogs", "events", "metrics",
@@ -56,6 +100,67 @@ warnings.filterwarnings(
 )
 
 DEFAULT_DATE_FROM = "1990-01-01"
+# dates parsed without dateparser, dateparser reads 10 digits as an epoch timestamp in seconds
+EPOCH_TIMESTAMP_PATTERN = re.compile(r"\d{10}")
+ISO_DATE_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2}")
+
+OUTPUT_FORMAT_CSV = "csv"
+OUTPUT_FORMAT_CSV_GZIP = "csv_gzip"
+OUTPUT_FORMAT_PARQUET = "parquet"
+
+PAGE_CACHE_OFF = "off"
+PAGE_CACHE_FILE_NAME = "klaviyo_page_cache.ndjson.gz"
+TELEMETRY_REPORT_FILE_NAME = "klaviyo_telemetry.json"
+
+DEFAULT_MAX_WORKERS = 1
+DEFAULT_PREFETCH_PAGES = 2
+DEFAULT_EVENT_WINDOW_WORKERS = 1
+DEFAULT_ACCOUNT_WORKERS = 4
+DEFAULT_COMPRESSION_WORKERS = 2
+
+# column with the ID of the account added to every table when several accounts are extracted
+ACCOUNT_ID_COLUMN = "account_id"
+
+CAMPAIGN_MESSAGES_MAX_WORKERS = 4
+METRIC_AGGREGATES_MAX_WORKERS = 4
+
+# number of profile IDs requested at once when deduplicated profiles are fetched, equal to the profiles page size
+PROFILES_BY_ID_BATCH_SIZE = 100
+PROFILES_BY_ID_MAX_WORKERS = 4
+
+# number of segment or list IDs validated by a single request filtering the IDs
+VALIDATION_ID_BATCH_SIZE = 100
+# metrics can not be filtered by ID, each metric is requested separately by this many workers
+VALIDATION_METRIC_MAX_WORKERS = 4
+
+# attributes requested from the API when the lean fields preset is selected, objects not listed here
+# are always fetched with all their attributes
+LEAN_FIELDSETS = {
+    "campaign": ["name", "status", "archived", "audiences", "send_options", "tracking_options", "send_strategy",
+                 "created_at", "scheduled_at", "updated_at", "send_time"],
+    "campaign_message": ["label", "channel", "created_at", "updated_at"],
+    "catalog_item": ["external_id", "title", "url", "published", "created", "updated"],
+    "event": ["timestamp", "datetime", "uuid"],
+    "flow": ["name", "status", "archived", "created", "updated", "trigger_type"],
+    "profile": ["external_id", "email", "phone_number", "first_name", "last_name", "organization", "title",
+                "image", "location", "created", "updated", "last_event_date"],
+    "template": ["name", "editor_type", "created", "updated"],
+}
+# attributes the component relies on, they are added to every sparse fieldset of the object
+REQUIRED_FIELDS = {
+    "campaign": ["audiences"],
+    "event": ["timestamp"],
+}
+
+# tables of the resources sideloaded with the events, keyed by the resource type
+SIDELOADED_EVENT_TABLES = {"metric": "event_metric", "profile": "event_profile"}
+
+STATE_CHECKPOINTS = "checkpoints"
+# start of the last run that extracted all profiles, the incremental profiles are updated after it
+STATE_PROFILES_LAST_RUN = "profiles_last_run"
+# the time ranges following the last run start 1 hour earlier, so objects inserted or updated while the data
+# was being downloaded are not missed
+LAST_RUN_OVERLAP_SECONDS = 3600
 
 
 class Component(ComponentBase):
@@ -74,70 +179,448 @@ class Component(ComponentBase):
             "metric_aggregates": self.get_metric_aggregates
         }
         self.client = None
+        # ID of the account extracted by this component, set only when several accounts are extracted
+        self.account_id = None
+        self._account_clients = []
+        self._account_writers = {}
         self.result_writers = {}
+        self._result_writers_lock = threading.Lock()
         self.state = {}
         self.new_state = {}
+        self._state_lock = threading.Lock()
+        self.resume_mode = False
+        self._incomplete_endpoints = []
         self.store_nested_attributes = False
+        self.output_format = OUTPUT_FORMAT_CSV
+        # compresses the blocks of the gzip compressed CSV tables, created with the first compressed table
+        self._compression_executor = None
+        self.page_cache = None
+        self.telemetry = Telemetry()
+        # relative dates are resolved against this time instead of the current time when set
+        self._relative_base = None
         super().__init__()
 
     def run(self):
         self.validate_configuration_parameters(REQUIRED_PARAMETERS)
         self.validate_image_parameters(REQUIRED_IMAGE_PARS)
 
-        self.state = self.get_state_file()
+        input_state = self.get_state_file()
+        self.state = copy.deepcopy(input_state)
+        params = self.configuration.parameters
+        accounts = self._get_accounts()
+        self.page_cache = self._init_page_cache(params.get(KEY_PAGE_CACHE_MODE, PAGE_CACHE_OFF))
         self.new_state = copy.deepcopy(self.state)
         self.new_state["last_run"] = self._parse_date("now")
 
-        params = self.configuration.parameters
         self.store_nested_attributes = params.get(KEY_STORE_NESTED_ATTRIBUTES, False)
+        self.output_format = params.get(KEY_OUTPUT_FORMAT, OUTPUT_FORMAT_CSV)
+        if self.output_format == OUTPUT_FORMAT_PARQUET and not parquet_available():
+            logging.warning("Parquet output is not available, the tables are stored as gzip compressed CSV files")
+            self.output_format = OUTPUT_FORMAT_CSV_GZIP
+        performance_settings = params.get(KEY_PERFORMANCE_SETTINGS, {})
+        self.resume_mode = performance_settings.get(KEY_PERFORMANCE_SETTINGS_RESUME_FROM_CHECKPOINT, False)
+
+        try:
+            if accounts:
+                self._fetch_accounts(accounts, performance_settings.get(KEY_PERFORMANCE_SETTINGS_ACCOUNT_WORKERS,
+                                                                        DEFAULT_ACCOUNT_WORKERS))
+            else:
+                self._init_client()
+                self._fetch_objects()
+        finally:
+            if self.page_cache:
+                self.page_cache.close()
+
+        finalize_start = time.perf_counter()
+        self._close_all_result_writers()
+        self.telemetry.record_finalize(time.perf_counter() - finalize_start)
+        self._report_telemetry(performance_settings.get(KEY_PERFORMANCE_SETTINGS_TELEMETRY_REPORT, False))
+        if self.page_cache and self.page_cache.replaying:
+            # replayed data is not newer than the state, the next run continues from where the input state ended
+            self.write_state_file(input_state)
+            return
+        if self.page_cache:
+            self.write_manifest(self.create_out_file_definition(PAGE_CACHE_FILE_NAME, tags=["klaviyo", "page_cache"]))
+
+        if self._incomplete_endpoints:
+            logging.warning(f"Fetching of {', '.join(self._incomplete_endpoints)} did not finish. The data fetched so "
+                            f"far is stored and the next run resumes from the last checkpoint.")
+            self.new_state = self._get_incomplete_run_state()
+        else:
+            self.new_state.pop(STATE_CHECKPOINTS, None)
+        self.write_state_file(self.new_state)
 
-        self._init_client()
+    def _fetch_objects(self) -> None:
+        params = self.configuration.parameters
         self._validate_user_parameters()
 
         objects = params.get(KEY_OBJECTS)
+        enabled_endpoints = [object_name for object_name in OBJECT_ENDPOINTS if objects.get(object_name)]
 
-        for object_name in OBJECT_ENDPOINTS:
-            if objects.get(object_name):
-                logging.info(f"Fetching data of {object_name}")
-                self.endpoint_func_mapping[object_name]()
+        performance_settings = params.get(KEY_PERFORMANCE_SETTINGS, {})
+        max_workers = performance_settings.get(KEY_PERFORMANCE_SETTINGS_MAX_WORKERS, DEFAULT_MAX_WORKERS)
 
-        self._close_all_result_writers()
-        self.write_state_file(self.new_state)
+        if max_workers > 1 and len(enabled_endpoints) > 1:
+            self._fetch_endpoints_concurrently(enabled_endpoints, max_workers)
+        else:
+            for object_name in enabled_endpoints:
+                self._fetch_endpoint(object_name)
+
+    def _fetch_endpoint(self, object_name: str) -> None:
+        endpoint_label = object_name if self.account_id is None else f"{object_name} of account {self.account_id}"
+        logging.info(f"Fetching data of {endpoint_label}")
+        try:
+            self.endpoint_func_mapping[object_name]()
+        except KlaviyoClientException as e:
+            # only the endpoints saving checkpoints continue in the next run, permanent errors would fail again
+            if not self.resume_mode or not self._is_checkpointed(object_name) or e.is_permanent:
+                raise
+            logging.warning(f"Fetching data of {endpoint_label} failed: {e}")
+            self._incomplete_endpoints.append(endpoint_label)
+
+    def _is_checkpointed(self, object_name: str) -> bool:
+        if object_name == "events":
+            return True
+        if object_name == "profiles":
+            # the deduplicated profiles of segments and lists are fetched without checkpoints
+            profile_settings = self.configuration.parameters.get(KEY_PROFILES_SETTINGS) or {}
+            return (profile_settings.get(KEY_PROFILES_SETTINGS_FETCH_PROFILES_MODE) == "fetch_all"
+                    or not profile_settings.get(KEY_PROFILES_SETTINGS_DEDUPLICATE))
+        return False
+
+    def _fetch_endpoints_concurrently(self, endpoints: List[str], max_workers: int) -> None:
+        """
+        Runs the endpoints in a thread pool. Every endpoint writes only into its own result writers, so the writers
+        are not shared between threads. The first failure cancels the endpoints that have not started yet.
+        """
+        logging.info(f"Fetching {len(endpoints)} endpoints concurrently using {max_workers} workers")
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="endpoint") as executor:
+            futures = {executor.submit(self._fetch_endpoint, object_name): object_name for object_name in endpoints}
+            try:
+                for future in as_completed(futures):
+                    future.result()
+                    logging.info(f"Finished fetching data of {futures[future]}")
+            except Exception:
+                for future in futures:
+                    future.cancel()
+                raise
+
+    def _get_accounts(self) -> List[Dict]:
+        """
+        Returns the accounts to extract, empty when a single account is extracted with the API token.
+        """
+        params = self.configuration.parameters
+        accounts = params.get(KEY_ACCOUNTS) or []
+        if not accounts:
+            if not params.get(KEY_API_TOKEN):
+                raise UserException(f"Missing required parameter {KEY_API_TOKEN} or {KEY_ACCOUNTS}.")
+            return []
+
+        account_ids = [account.get(KEY_ACCOUNT_ID) for account in accounts]
+        if not all(account_ids) or not all(account.get(KEY_API_TOKEN) for account in accounts):
+            raise UserException(f"Every account must have the {KEY_ACCOUNT_ID} and the {KEY_API_TOKEN} set.")
+        if len(set(account_ids)) != len(account_ids):
+            raise UserException(f"The {KEY_ACCOUNT_ID} of every account must be unique.")
+        if params.get(KEY_PAGE_CACHE_MODE, PAGE_CACHE_OFF) != PAGE_CACHE_OFF:
+            raise UserException("The page cache can not be used when several accounts are extracted.")
+        return accounts
+
+    def _fetch_accounts(self, accounts: List[Dict], account_workers: int) -> None:
+        """
+        Extracts the accounts in a thread pool. Every account has its own client, so it is throttled only by its
+        own rate limits, and writes into the tables shared by all accounts. The first failure cancels the accounts
+        that have not started yet.
+        """
+        if self.output_format == OUTPUT_FORMAT_CSV_GZIP:
+            # created before the accounts are copied, so they share the executor shut down with the result writers
+            self._get_compression_executor()
+        account_components = [self._for_account(account[KEY_ACCOUNT_ID], account[KEY_API_TOKEN])
+                              for account in accounts]
+        self._account_clients = [account_component.client for account_component in account_components]
+
+        logging.info(f"Fetching {len(accounts)} accounts using {account_workers} workers")
+        with ThreadPoolExecutor(max_workers=account_workers, thread_name_prefix="account") as executor:
+            futures = {executor.submit(account_component._fetch_objects): account_component.account_id
+                       for account_component in account_components}
+            try:
+                for future in as_completed(futures):
+                    future.result()
+                    logging.info(f"Finished fetching data of account {futures[future]}")
+            except Exception:
+                for future in futures:
+                    future.cancel()
+                raise
+
+    def _for_account(self, account_id: str, api_token: str) -> "Component":
+        """
+        Returns a copy of the component extracting a single account. The copy shares the result writers, the state
+        and the telemetry of the run, it has its own client and adds the account ID to every written row.
+        """
+        account_component = copy.copy(self)
+        account_component.account_id = account_id
+        account_component.client = self._create_client(api_token)
+        account_component.endpoint_func_mapping = {
+            object_name: getattr(account_component, endpoint_func.__name__)
+            for object_name, endpoint_func in self.endpoint_func_mapping.items()}
+        account_component._account_writers = {}
+        return account_component
 
     def _init_client(self):
+        self.client = self._create_client(self._get_api_token())
+
+    def _get_api_token(self) -> str:
         params = self.configuration.parameters
-        api_token = params.get(KEY_API_TOKEN)
-        self.client = KlaviyoClient(api_token=api_token)
+        accounts = params.get(KEY_ACCOUNTS) or [{}]
+        # the sync actions use the first account when several accounts are configured
+        return params.get(KEY_API_TOKEN) or accounts[0].get(KEY_API_TOKEN)
+
+    def _create_client(self, api_token: str) -> "KlaviyoClient":
+        # imported here, the Klaviyo SDK takes seconds to import and the sync actions do not need it
+        from client import KlaviyoClient
+
+        params = self.configuration.parameters
+        performance_settings = params.get(KEY_PERFORMANCE_SETTINGS, {})
+        prefetch_pages = performance_settings.get(KEY_PERFORMANCE_SETTINGS_PREFETCH_PAGES, DEFAULT_PREFETCH_PAGES)
+        pool_size = performance_settings.get(KEY_PERFORMANCE_SETTINGS_CONNECTION_POOL_SIZE,
+                                             self._get_concurrent_requests(performance_settings, prefetch_pages))
+        transport = HttpTransport(pool_size=pool_size,
+                                  compress_responses=performance_settings.get(
+                                      KEY_PERFORMANCE_SETTINGS_COMPRESS_RESPONSES, True))
+        return KlaviyoClient(api_token=api_token, prefetch_pages=prefetch_pages, page_cache=self.page_cache,
+                             transport=transport, telemetry=self.telemetry,
+                             raw_responses=performance_settings.get(KEY_PERFORMANCE_SETTINGS_RAW_RESPONSES, False))
+
+    @staticmethod
+    def _get_concurrent_requests(performance_settings: Dict, prefetch_pages: int) -> int:
+        """
+        Largest number of requests the run can make at once, every concurrent endpoint can fetch with its own
+        workers and a read-ahead thread.
+        """
+        max_workers = performance_settings.get(KEY_PERFORMANCE_SETTINGS_MAX_WORKERS, DEFAULT_MAX_WORKERS)
+        window_workers = performance_settings.get(KEY_PERFORMANCE_SETTINGS_EVENT_WINDOW_WORKERS,
+                                                  DEFAULT_EVENT_WINDOW_WORKERS)
+        endpoint_workers = max(window_workers, CAMPAIGN_MESSAGES_MAX_WORKERS, PROFILES_BY_ID_MAX_WORKERS,
+                               METRIC_AGGREGATES_MAX_WORKERS)
+        return max_workers * (endpoint_workers + (1 if prefetch_pages > 0 else 0))
+
+    def _report_telemetry(self, write_report: bool) -> None:
+        """
+        Logs the summary of the requests and of the time spent on each object, the report with all counters
+        is stored in the output files if requested.
+        """
+        clients = self._account_clients or [self.client]
+        transport_stats = TransportStats.total([client.transport.stats() for client in clients])
+        if transport_stats.requests:
+            logging.info(f"Made {transport_stats.requests} HTTP requests over {transport_stats.connections} "
+                         f"connections ({transport_stats.reused_connection_ratio:.0%} of requests reused "
+                         f"a connection), {transport_stats.compressed_responses} responses were compressed")
+        for line in self.telemetry.summary():
+            logging.info(line)
+
+        if write_report:
+            report = {**self.telemetry.report(), "transport": asdict(transport_stats)}
+            with open(os.path.join(self.files_out_path, TELEMETRY_REPORT_FILE_NAME), "w") as report_file:
+                json.dump(report, report_file, indent=2)
+            self.write_manifest(self.create_out_file_definition(TELEMETRY_REPORT_FILE_NAME,
+                                                                tags=["klaviyo", "telemetry"]))
+
+    def _init_page_cache(self, mode: str) -> Optional[PageCache]:
+        """
+        Opens the page cache of the run. A recorded cache is stored in the output files together with the time of
+        the run and its last run, a replaying run uses both, so its requests have the same filters as the recorded
+        ones even with relative dates.
+        """
+        performance_settings = self.configuration.parameters.get(KEY_PERFORMANCE_SETTINGS, {})
+        window_workers = performance_settings.get(KEY_PERFORMANCE_SETTINGS_EVENT_WINDOW_WORKERS,
+                                                  DEFAULT_EVENT_WINDOW_WORKERS)
+        if mode != PAGE_CACHE_OFF and window_workers > 1 and self.configuration.parameters[KEY_OBJECTS].get("events"):
+            # the sizes of the event windows depend on the order the requests finish, a replay would not repeat them
+            raise UserException("The page cache can not be used when events are fetched in several concurrent "
+                                "time windows, set the event window workers to 1.")
+
+        if mode == PAGE_CACHE_RECORD:
+            self._relative_base = datetime.now()
+            metadata = {"run_timestamp": self._relative_base.timestamp(), "last_run": self.state.get("last_run"),
+                        STATE_PROFILES_LAST_RUN: self.state.get(STATE_PROFILES_LAST_RUN)}
+            logging.info("Recording the API responses into the page cache")
+            return PageCache(os.path.join(self.files_out_path, PAGE_CACHE_FILE_NAME), PAGE_CACHE_RECORD, metadata)
+
+        if mode == PAGE_CACHE_REPLAY:
+            cache_paths = sorted(glob.glob(os.path.join(self.files_in_path, f"*{PAGE_CACHE_FILE_NAME}")))
+            if not cache_paths:
+                raise UserException(f"The page cache replay requires the {PAGE_CACHE_FILE_NAME} file recorded by "
+                                    f"a previous run in the input mapping of the component.")
+            logging.info(f"Replaying the API responses from the page cache {os.path.basename(cache_paths[-1])}")
+            page_cache = PageCache(cache_paths[-1], PAGE_CACHE_REPLAY)
+            self._relative_base = datetime.fromtimestamp(page_cache.metadata["run_timestamp"])
+            for state_key in ("last_run", STATE_PROFILES_LAST_RUN):
+                if page_cache.metadata.get(state_key) is not None:
+                    self.state[state_key] = page_cache.metadata[state_key]
+                else:
+                    self.state.pop(state_key, None)
+            return page_cache
+
+        return None
 
-    def fetch_and_write_object_data(self, object_name: str, data_generator: Callable, **data_generator_kwargs) -> None:
+    def fetch_and_write_object_data(self, object_name: str, data_generator: Callable, checkpoint_key: str = None,
+                                    sideloaded_tables: Dict[str, str] = None, **data_generator_kwargs) -> None:
+        """
+        Writes all pages of the data generator into the result writer of the object. If checkpoint_key is set and
+        the resume mode is on, the checkpoint of each written page is saved in the state under that key.
+
+        Resources sideloaded with the pages are written into the tables of their types in sideloaded_tables,
+        each resource only once, and the ID of the related resource is added to every row.
+        """
         self._initialize_result_writer(object_name)
-        parser = FlattenJsonParser()
+        parser = self._create_parser()
+        sideloaded_tables = sideloaded_tables or {}
+        sideloaded_ids = {resource_type: set() for resource_type in sideloaded_tables}
+        for table_name in sideloaded_tables.values():
+            self._initialize_result_writer(table_name)
 
         extra_data = {}
         for arg_name in data_generator_kwargs:
             if "_id" in arg_name:
                 extra_data = {arg_name: data_generator_kwargs[arg_name]}
 
+        page_count = 0
+        row_count = 0
+        fetch_seconds = flatten_seconds = write_seconds = 0.0
+        writer = self._get_result_writer(object_name)
+        fetch_start = time.perf_counter()
         for i, page in enumerate(data_generator(**data_generator_kwargs)):
+            fetch_seconds += time.perf_counter() - fetch_start
             if i > 0 and i % 100 == 0:
                 logging.info(f"Already fetched {i} pages of data of object {object_name}")
+            page_count += 1
+            row_count += len(page)
 
             for item in page:
-
-                if self.store_nested_attributes:
-                    parsed_attributes = item["attributes"]
-                else:
-                    parsed_attributes = parser.parse_row(item["attributes"])
+                flatten_start = time.perf_counter()
+                parsed_attributes = parser.parse_row(item["attributes"])
 
                 # Extract metric_id from relationships for events
                 if "relationships" in item and "metric" in item.get("relationships", {}):
                     metric_data = item["relationships"]["metric"].get("data")
                     if metric_data and "id" in metric_data:
                         parsed_attributes["metric_id"] = metric_data["id"]
+                for resource_type in sideloaded_ids:
+                    related_data = item.get("relationships", {}).get(resource_type, {}).get("data")
+                    if related_data:
+                        parsed_attributes[f"{resource_type}_id"] = related_data["id"]
 
                 row = {"id": item["id"], **parsed_attributes, **extra_data}
+                write_start = time.perf_counter()
+                flatten_seconds += write_start - flatten_start
+
+                writer.writerow(row)
+                write_seconds += time.perf_counter() - write_start
+
+            if sideloaded_ids:
+                self._write_sideloaded_resources(page, sideloaded_tables, sideloaded_ids, parser)
+
+            if checkpoint_key and getattr(page, "checkpoint", None):
+                self._save_checkpoint(checkpoint_key, resume_from=page.checkpoint)
+            fetch_start = time.perf_counter()
+
+        rows_per_page = row_count / page_count if page_count else 0
+        logging.info(f"Fetched {row_count} rows in {page_count} pages of object {object_name} "
+                     f"({rows_per_page:.1f} rows per page)")
+        self.telemetry.record_object(object_name, page_count, row_count, fetch_seconds, flatten_seconds, write_seconds)
+        for resource_type, resource_ids in sideloaded_ids.items():
+            logging.info(f"Fetched {len(resource_ids)} unique {resource_type}s sideloaded with object {object_name}")
+
+        if checkpoint_key:
+            self._save_checkpoint(checkpoint_key, completed=True)
+
+    def _write_sideloaded_resources(self, page: Page, sideloaded_tables: Dict[str, str],
+                                    sideloaded_ids: Dict[str, set], parser: FlattenJsonParser) -> None:
+        for resource in getattr(page, "included", []):
+            resource_ids = sideloaded_ids.get(resource.get("type"))
+            if resource_ids is None or resource["id"] in resource_ids:
+                continue
+            resource_ids.add(resource["id"])
+            self._get_result_writer(sideloaded_tables[resource["type"]]).writerow(
+                {"id": resource["id"], **parser.parse_row(resource.get("attributes") or {})})
+
+    def _create_parser(self, store_nested_attributes: bool = True) -> FlattenJsonParser:
+        """
+        Returns the parser of the object attributes. Stored nested attributes are serialized as JSON into
+        the column of each attribute, the flatten settings limit the flattened depth the same way. The campaign
+        tables never stored nested attributes, their parser is created with store_nested_attributes False.
+        """
+        flatten_settings = self.configuration.parameters.get(KEY_FLATTEN_SETTINGS, {})
+        max_depth = flatten_settings.get(KEY_FLATTEN_SETTINGS_MAX_DEPTH)
+        if max_depth is None and store_nested_attributes and self.store_nested_attributes:
+            max_depth = 0
+        return FlattenJsonParser(max_depth=max_depth,
+                                 flatten_columns=flatten_settings.get(KEY_FLATTEN_SETTINGS_FLATTEN_COLUMNS))
+
+    def _fetch_resumable_object_data(self, object_name: str, checkpoint_key: str, data_generator: Callable,
+                                     **data_generator_kwargs) -> bool:
+        """
+        Fetches the object data continuing from the checkpoint saved by a previous incomplete run.
+        Data completed by that run is skipped, if the checkpoint can not be resumed the data is fetched again.
 
-                self._get_result_writer(object_name).writerow(row)
+        Returns:
+            False if the data was skipped
+        """
+        checkpoint = self._get_checkpoint(checkpoint_key)
+        if checkpoint.get("completed"):
+            logging.info(f"Skipping {checkpoint_key}, it was completed by the previous run")
+            return False
+
+        resume_from = checkpoint.get("resume_from")
+        if resume_from:
+            logging.info(f"Resuming {checkpoint_key} from the checkpoint of the previous run")
+            try:
+                self.fetch_and_write_object_data(object_name, data_generator, checkpoint_key=checkpoint_key,
+                                                 **data_generator_kwargs, **resume_from)
+                return True
+            except KlaviyoClientException as e:
+                if self._get_checkpoint(checkpoint_key, self.new_state).get("resume_from") != resume_from:
+                    raise
+                logging.warning(f"Failed to resume {checkpoint_key} from the checkpoint: {e}. "
+                                f"Fetching it from the beginning.")
+
+        self.fetch_and_write_object_data(object_name, data_generator, checkpoint_key=checkpoint_key,
+                                         **data_generator_kwargs)
+        return True
+
+    def _get_checkpoint(self, checkpoint_key: str, state: Dict = None) -> Dict:
+        if not self.resume_mode:
+            return {}
+        checkpoint_key = self._get_account_checkpoint_key(checkpoint_key)
+        state = self.state if state is None else state
+        return state.get(STATE_CHECKPOINTS, {}).get(checkpoint_key, {})
+
+    def _save_checkpoint(self, checkpoint_key: str, resume_from: Dict = None, completed: bool = False) -> None:
+        if not self.resume_mode:
+            return
+        checkpoint_key = self._get_account_checkpoint_key(checkpoint_key)
+        with self._state_lock:
+            checkpoint = self.new_state.setdefault(STATE_CHECKPOINTS, {}).setdefault(checkpoint_key, {})
+            if resume_from:
+                checkpoint["resume_from"] = resume_from
+            if completed:
+                checkpoint["completed"] = True
+
+    def _get_account_checkpoint_key(self, checkpoint_key: str) -> str:
+        if self.account_id is None:
+            return checkpoint_key
+        return f"{self.account_id}:{checkpoint_key}"
+
+    def _get_incomplete_run_state(self) -> Dict:
+        """
+        State of a run that did not fetch all data. It keeps the checkpoints and the last run of the previous
+        state, so the time ranges relative to the last run are fetched again.
+        """
+        state = copy.deepcopy(self.new_state)
+        if "last_run" in self.state:
+            state["last_run"] = self.state["last_run"]
+        else:
+            state.pop("last_run", None)
+        return state
 
     def _add_columns_from_state_to_table_definition(self, object_name: str,
                                                     table_definition: TableDefinition) -> TableDefinition:
@@ -149,11 +632,31 @@ class Component(ComponentBase):
             table_definition.schema = all_columns
         return table_definition
 
+    def _get_sparse_fieldset(self, object_name: str) -> Optional[List[str]]:
+        """
+        Returns the attributes of the object to request from the API, None if all attributes should be fetched.
+        Attributes configured for the object take precedence over the fields preset.
+        """
+        fields_settings = self.configuration.parameters.get(KEY_FIELDS_SETTINGS, {})
+        fields = fields_settings.get(object_name)
+        if not fields and fields_settings.get(KEY_FIELDS_SETTINGS_PRESET) == "lean":
+            fields = LEAN_FIELDSETS.get(object_name)
+        if not fields:
+            return None
+        return list(dict.fromkeys([*fields, *REQUIRED_FIELDS.get(object_name, [])]))
+
+    def _get_page_size(self, object_name: str) -> Optional[int]:
+        """
+        Returns the page size configured for the object, None to use the largest page size of the endpoint.
+        """
+        performance_settings = self.configuration.parameters.get(KEY_PERFORMANCE_SETTINGS, {})
+        return performance_settings.get(KEY_PERFORMANCE_SETTINGS_PAGE_SIZES, {}).get(object_name)
+
     def get_metrics(self) -> None:
-        self.fetch_and_write_object_data("metric", self.client.get_metrics)
+        self.fetch_and_write_object_data("metric", self.client.get_metrics, fields=self._get_sparse_fieldset("metric"))
 
     def get_lists(self) -> None:
-        self.fetch_and_write_object_data("list", self.client.get_lists)
+        self.fetch_and_write_object_data("list", self.client.get_lists, fields=self._get_sparse_fieldset("list"))
 
     def get_segments(self) -> None:
         self._initialize_result_writer("segment")
@@ -165,11 +668,13 @@ class Component(ComponentBase):
                 self._get_result_writer("segment").writerow({"id": item["id"], "name": name, "definition": definition})
 
     def get_catalogs(self) -> None:
-        self.fetch_and_write_object_data("catalog_item", self.client.get_catalog_items)
+        self.fetch_and_write_object_data("catalog_item", self.client.get_catalog_items,
+                                         fields=self._get_sparse_fieldset("catalog_item"))
 
         catalog_settings = self.configuration.parameters.get(KEY_CATALOGS_SETTINGS)
         if catalog_settings.get(KEY_CATALOGS_SETTINGS_FETCH_CATALOG_CATEGORIES):
-            self.fetch_and_write_object_data("catalog_categories", self.client.get_catalog_categories)
+            self.fetch_and_write_object_data("catalog_categories", self.client.get_catalog_categories,
+                                             fields=self._get_sparse_fieldset("catalog_category"))
 
     def get_campaigns(self) -> None:
         channels = self.configuration.parameters.get(KEY_CAMPAIGNS_SETTINGS, ["email", "sms"])
@@ -177,16 +682,21 @@ class Component(ComponentBase):
         self._initialize_result_writer("campaign")
         self._initialize_result_writer("campaign_audience")
         self._initialize_result_writer("campaign_excluded_audience")
-        parser = FlattenJsonParser()
+        parser = self._create_parser(store_nested_attributes=False)
+        fields = self._get_sparse_fieldset("campaign")
+        message_fields = self._get_sparse_fieldset("campaign_message")
 
         for channel in channels:
-            for batch in self.client.get_campaigns(channel=channel):
+            for batch in self.client.get_campaigns(channel=channel, include_messages=True, fields=fields,
+                                                   message_fields=message_fields):
+                campaign_messages = self._get_sideloaded_campaign_messages(batch)
+
                 for item in batch:
                     audiences = item.get("attributes").pop("audiences")
                     included_audiences = audiences.get("included")
                     excluded_audiences = audiences.get("excluded")
 
-                    self.get_campaign_messages(campaign_id=item["id"])
+                    self._write_campaign_messages(campaign_id=item["id"], messages=campaign_messages[item["id"]])
 
                     for included_audience in included_audiences:
                         self._get_result_writer("campaign_audience").writerow(
@@ -198,14 +708,44 @@ class Component(ComponentBase):
                     parsed_attributes = parser.parse_row(item["attributes"])
                     self._get_result_writer("campaign").writerow({"id": item["id"], **parsed_attributes})
 
-    def get_campaign_messages(self, campaign_id: str) -> None:
+    def _get_sideloaded_campaign_messages(self, campaigns: Page) -> Dict[str, List[Dict]]:
+        """
+        Returns the messages of each campaign of the page, keyed by the campaign ID. Messages are taken from the
+        resources sideloaded with the campaigns, campaigns whose messages are not all sideloaded fall back to
+        fetching their messages separately, concurrently.
+        """
+        included_messages = {resource["id"]: resource for resource in campaigns.included
+                             if resource.get("type") == "campaign-message"}
+
+        campaign_messages = {}
+        not_sideloaded = []
+        for campaign in campaigns:
+            related = campaign.get("relationships", {}).get("campaign-messages", {}).get("data")
+            if related is not None and all(message["id"] in included_messages for message in related):
+                campaign_messages[campaign["id"]] = [included_messages[message["id"]] for message in related]
+            else:
+                not_sideloaded.append(campaign["id"])
+
+        if not_sideloaded:
+            with ThreadPoolExecutor(max_workers=CAMPAIGN_MESSAGES_MAX_WORKERS,
+                                    thread_name_prefix="campaign-messages") as executor:
+                fetched_messages = executor.map(self._fetch_campaign_messages, not_sideloaded)
+                campaign_messages.update(zip(not_sideloaded, fetched_messages))
+
+        return campaign_messages
+
+    def _fetch_campaign_messages(self, campaign_id: str) -> List[Dict]:
+        fields = self._get_sparse_fieldset("campaign_message")
+        return [item for batch in self.client.get_campaign_messages(campaign_id=campaign_id, fields=fields)
+                for item in batch]
+
+    def _write_campaign_messages(self, campaign_id: str, messages: List[Dict]) -> None:
         self._initialize_result_writer("campaign_message")
-        parser = FlattenJsonParser()
+        parser = self._create_parser(store_nested_attributes=False)
 
-        for batch in self.client.get_campaign_messages(campaign_id=campaign_id):
-            for item in batch:
-                parsed_attributes = parser.parse_row(item["attributes"])
-                self._get_result_writer("campaign_message").writerow({"campaign_id": campaign_id, **parsed_attributes})
+        for item in messages:
+            parsed_attributes = parser.parse_row(item["attributes"])
+            self._get_result_writer("campaign_message").writerow({"campaign_id": campaign_id, **parsed_attributes})
 
     def get_events(self) -> None:
         params = self.configuration.parameters
@@ -220,34 +760,155 @@ class Component(ComponentBase):
             from_timestamp = self._parse_date(event_settings.get(KEY_DATE_FROM))
             to_timestamp = self._parse_date(event_settings.get(KEY_DATE_TO))
 
-        self.fetch_and_write_object_data("event", self.client.get_events,
-                                         from_timestamp_value=from_timestamp,
-                                         to_timestamp_value=to_timestamp)
+        checkpoint_timestamp = self._get_checkpoint("event").get("resume_from", {}).get("from_timestamp_value")
+        if checkpoint_timestamp and from_timestamp < checkpoint_timestamp <= to_timestamp:
+            logging.info("Resuming events from the checkpoint of the previous run")
+            from_timestamp = checkpoint_timestamp
+
+        performance_settings = params.get(KEY_PERFORMANCE_SETTINGS, {})
+        window_workers = performance_settings.get(KEY_PERFORMANCE_SETTINGS_EVENT_WINDOW_WORKERS,
+                                                  DEFAULT_EVENT_WINDOW_WORKERS)
+
+        fields = self._get_sparse_fieldset("event")
+
+        # the metrics and profiles of the events are sideloaded and written only once into their own tables
+        include_settings = {"metric": KEY_EVENTS_SETTINGS_INCLUDE_METRICS,
+                            "profile": KEY_EVENTS_SETTINGS_INCLUDE_PROFILES}
+        include = [resource_type for resource_type, key in include_settings.items()
+                   if (event_settings or {}).get(key)]
+        include_kwargs = {}
+        if include:
+            logging.info(f"Fetching events with their {' and '.join(f'{t}s' for t in include)}")
+            include_kwargs = {"include": include, "metric_fields": self._get_sparse_fieldset("metric"),
+                              "profile_fields": self._get_sparse_fieldset("profile"),
+                              "sideloaded_tables": {t: SIDELOADED_EVENT_TABLES[t] for t in include}}
+
+        if window_workers > 1:
+            logging.info(f"Fetching events in time windows using {window_workers} workers")
+            self.fetch_and_write_object_data("event", self.client.get_events_time_sliced,
+                                             checkpoint_key="event",
+                                             from_timestamp_value=from_timestamp,
+                                             to_timestamp_value=to_timestamp,
+                                             workers=window_workers,
+                                             fields=fields,
+                                             **include_kwargs)
+        else:
+            self.fetch_and_write_object_data("event", self.client.get_events,
+                                             checkpoint_key="event",
+                                             from_timestamp_value=from_timestamp,
+                                             to_timestamp_value=to_timestamp,
+                                             fields=fields,
+                                             **include_kwargs)
 
     def get_profiles(self) -> None:
         params = self.configuration.parameters
         profile_settings = params.get(KEY_PROFILES_SETTINGS)
         fetch_profiles_mode = profile_settings.get(KEY_PROFILES_SETTINGS_FETCH_PROFILES_MODE)
+        fields = self._get_sparse_fieldset("profile")
+        page_size = self._get_page_size("profile")
 
         if fetch_profiles_mode == "fetch_all":
-            self.fetch_and_write_object_data("profile", self.client.get_profiles)
+            # the run extracting all profiles is tracked separately, the last run may have extracted other objects
+            profiles_last_run_key = self._get_account_checkpoint_key(STATE_PROFILES_LAST_RUN)
+            updated_since = None
+            if profile_settings.get(KEY_PROFILES_SETTINGS_INCREMENTAL):
+                if profiles_last_run_key in self.state:
+                    updated_since = int(self.state[profiles_last_run_key]) - LAST_RUN_OVERLAP_SECONDS
+                    updated_since_date = datetime.fromtimestamp(updated_since, tz=timezone.utc).isoformat()
+                    logging.info(f"Fetching profiles updated since {updated_since_date}")
+                else:
+                    logging.info("No previous extraction of all profiles found in the state, fetching all profiles")
+            fetched = self._fetch_resumable_object_data("profile", "profile", self.client.get_profiles,
+                                                        fields=fields, page_size=page_size,
+                                                        updated_since=updated_since)
+            # profiles completed by the previous incomplete run keep the last run of that run from the state
+            if fetched:
+                with self._state_lock:
+                    self.new_state[profiles_last_run_key] = self.new_state["last_run"]
 
         elif fetch_profiles_mode == "fetch_by_segment":
             segments = profile_settings.get(KEY_PROFILES_SETTINGS_FETCH_BY_SEGMENT, [])
+            if profile_settings.get(KEY_PROFILES_SETTINGS_DEDUPLICATE):
+                self._fetch_deduplicated_profiles("segment", segments, self.client.get_segment_profile_ids, fields)
+                return
             for segment_id in segments:
-                self.fetch_and_write_object_data("segment_profile", self.client.get_segment_profiles,
-                                                 segment_id=segment_id)
+                self._fetch_resumable_object_data("segment_profile", f"segment_profile:{segment_id}",
+                                                  self.client.get_segment_profiles, segment_id=segment_id,
+                                                  fields=fields, page_size=page_size)
 
         elif fetch_profiles_mode == "fetch_by_list":
             lists = profile_settings.get(KEY_PROFILES_SETTINGS_FETCH_BY_LIST, [])
+            if profile_settings.get(KEY_PROFILES_SETTINGS_DEDUPLICATE):
+                self._fetch_deduplicated_profiles("list", lists, self.client.get_list_profile_ids, fields)
+                return
             for list_id in lists:
-                self.fetch_and_write_object_data("list_profile", self.client.get_list_profiles, list_id=list_id)
+                self._fetch_resumable_object_data("list_profile", f"list_profile:{list_id}",
+                                                  self.client.get_list_profiles, list_id=list_id, fields=fields,
+                                                  page_size=page_size)
+
+    def _fetch_deduplicated_profiles(self, group_type: str, group_ids: List[str], profile_ids_generator: Callable,
+                                     fields: Optional[List[str]]) -> None:
+        """
+        Writes which profiles belong to the segments or lists into the membership table, fetching only the profile
+        IDs. The attributes of every profile found are fetched only once, by batches of IDs, and written into
+        the profile table.
+        """
+        membership_table = f"{group_type}_membership"
+        self._initialize_result_writer(membership_table)
+        self._initialize_result_writer("profile")
+        membership_writer = self._get_result_writer(membership_table)
+        parser = self._create_parser()
+
+        known_profile_ids = set()
+        pending_profile_ids = []
+        with ThreadPoolExecutor(max_workers=PROFILES_BY_ID_MAX_WORKERS, thread_name_prefix="profiles") as executor:
+            for group_id in group_ids:
+                fetch_start = time.perf_counter()
+                for page in profile_ids_generator(group_id):
+                    write_start = time.perf_counter()
+                    for item in page:
+                        membership_writer.writerow({"profile_id": item["id"], f"{group_type}_id": group_id})
+                        if item["id"] not in known_profile_ids:
+                            known_profile_ids.add(item["id"])
+                            pending_profile_ids.append(item["id"])
+                    self.telemetry.record_object(membership_table, 1, len(page), write_start - fetch_start, 0.0,
+                                                 time.perf_counter() - write_start)
+
+                    full_batches = len(pending_profile_ids) - len(pending_profile_ids) % PROFILES_BY_ID_BATCH_SIZE
+                    self._write_profiles_by_ids(executor, parser, pending_profile_ids[:full_batches], fields)
+                    del pending_profile_ids[:full_batches]
+                    fetch_start = time.perf_counter()
+
+            self._write_profiles_by_ids(executor, parser, pending_profile_ids, fields)
+
+        logging.info(f"Fetched {len(known_profile_ids)} unique profiles of {len(group_ids)} {group_type}s")
+
+    def _write_profiles_by_ids(self, executor: ThreadPoolExecutor, parser: FlattenJsonParser, profile_ids: List[str],
+                               fields: Optional[List[str]]) -> None:
+        batches = [profile_ids[i:i + PROFILES_BY_ID_BATCH_SIZE]
+                   for i in range(0, len(profile_ids), PROFILES_BY_ID_BATCH_SIZE)]
+        writer = self._get_result_writer("profile")
+        profiles_by_batch = executor.map(lambda batch: self._fetch_profiles_by_ids(batch, fields), batches)
+        for _ in batches:
+            fetch_start = time.perf_counter()
+            profiles = next(profiles_by_batch)
+            flatten_start = time.perf_counter()
+            rows = [{"id": item["id"], **parser.parse_row(item["attributes"])} for item in profiles]
+            write_start = time.perf_counter()
+            writer.writerows(rows)
+            self.telemetry.record_object("profile", 1, len(rows), flatten_start - fetch_start,
+                                         write_start - flatten_start, time.perf_counter() - write_start)
+
+    def _fetch_profiles_by_ids(self, profile_ids: List[str], fields: Optional[List[str]]) -> List[Dict]:
+        return [item for page in self.client.get_profiles_by_ids(profile_ids, fields=fields) for item in page]
 
     def get_flows(self) -> None:
-        self.fetch_and_write_object_data("flow", self.client.get_flows)
+        self.fetch_and_write_object_data("flow", self.client.get_flows, fields=self._get_sparse_fieldset("flow"),
+                                         page_size=self._get_page_size("flow"))
 
     def get_templates(self) -> None:
-        self.fetch_and_write_object_data("template", self.client.get_templates)
+        self.fetch_and_write_object_data("template", self.client.get_templates,
+                                         fields=self._get_sparse_fieldset("template"))
 
     def get_metric_aggregates(self) -> None:
         params = self.configuration.parameters
@@ -260,47 +921,116 @@ class Component(ComponentBase):
         ids = metric_aggregates_settings.get(KEY_METRIC_AGGREGATES_SETTINGS_METRIC_IDS)
         by = metric_aggregates_settings.get(KEY_METRIC_AGGREGATES_SETTING_BY)
 
-        for id in ids:
-            self.fetch_and_write_object_data(
-                "metric_aggregates",
-                self.client.query_metric_aggregates,
-                metric_id=id,
-                interval=interval,
-                from_timestamp=from_timestamp,
-                to_timestamp=to_timestamp,
-                by=by
-            )
+        self.fetch_and_write_object_data(
+            "metric_aggregates",
+            self.client.query_metric_aggregates_concurrently,
+            metrics=ids,
+            interval=interval,
+            from_timestamp=from_timestamp,
+            to_timestamp=to_timestamp,
+            by=by,
+            workers=METRIC_AGGREGATES_MAX_WORKERS
+        )
 
     def _parse_date(self, date_to_parse: str) -> int:
         if date_to_parse.lower() in {"last", "lastrun", "last run"}:
-            # remove 1 hour / 3600s so there is no issue if data is being downloaded at the same time an object is
-            # being inserted/ being updated
-            return int(self.state.get("last_run", int(dateparser.parse(DEFAULT_DATE_FROM).timestamp()))) - 3600
+            return int(self.state.get("last_run", self._parse_date(DEFAULT_DATE_FROM))) - LAST_RUN_OVERLAP_SECONDS
+        parsed_timestamp = self._parse_common_date(date_to_parse)
+        if parsed_timestamp is not None:
+            return parsed_timestamp
+
+        # dateparser takes a noticeable time to import, it is imported only for relative dates
+        import dateparser
         try:
-            parsed_timestamp = int(dateparser.parse(date_to_parse).timestamp())
+            settings = {"RELATIVE_BASE": self._relative_base} if self._relative_base else None
+            parsed_timestamp = int(dateparser.parse(date_to_parse, settings=settings).timestamp())
         except (AttributeError, TypeError) as err:
             raise UserException(f"Failed to parse date '{date_to_parse}', make sure the date is either in YYYY-MM-DD "
                                 f"format or relative date i.e. 5 days ago, 1 month ago, yesterday, etc.") from err
         return parsed_timestamp
 
-    def _initialize_result_writer(self, object_name: str) -> None:
-        if object_name not in self.result_writers:
-            table_schema = self.get_table_schema_by_name(object_name)
-            table_definition = self.create_out_table_definition_from_schema(table_schema, incremental=True)
-            table_definition = self._add_columns_from_state_to_table_definition(object_name, table_definition)
-            writer = ElasticDictWriter(table_definition.full_path, table_definition.column_names)
-            self.result_writers[object_name] = {"table_definition": table_definition, "writer": writer}
+    def _parse_common_date(self, date_to_parse: str) -> Optional[int]:
+        """
+        Parses the dates in the YYYY-MM-DD or another ISO 8601 format, epoch timestamps and "now" the same way as
+        dateparser, returns None for the dates that have to be parsed by dateparser.
+        """
+        value = date_to_parse.strip()
+        if value.lower() == "now":
+            return int((self._relative_base or datetime.now()).timestamp())
+        if EPOCH_TIMESTAMP_PATTERN.fullmatch(value):
+            return int(value)
+        if ISO_DATE_PATTERN.match(value):
+            try:
+                return int(datetime.fromisoformat(value).timestamp())
+            except ValueError:
+                return None
+        return None
 
-    def _get_result_writer(self, object_name: str) -> ElasticDictWriter:
-        return self.result_writers.get(object_name).get("writer")
+    def _initialize_result_writer(self, object_name: str) -> None:
+        with self._result_writers_lock:
+            if object_name not in self.result_writers:
+                table_schema = self.get_table_schema_by_name(object_name)
+                if self.account_id is not None:
+                    table_schema.fields.insert(0, FieldSchema(ACCOUNT_ID_COLUMN, base_type="STRING"))
+                    if table_schema.primary_keys:
+                        table_schema.primary_keys = [ACCOUNT_ID_COLUMN, *table_schema.primary_keys]
+                table_definition = self.create_out_table_definition_from_schema(table_schema, is_sliced=True,
+                                                                                incremental=True)
+                table_definition = self._add_columns_from_state_to_table_definition(object_name, table_definition)
+                writer = self._create_result_writer(object_name, table_definition)
+                self.result_writers[object_name] = {"table_definition": table_definition, "writer": writer,
+                                                    "lock": threading.Lock()}
+
+    def _create_result_writer(self, object_name: str, table_definition: TableDefinition):
+        if self.output_format == OUTPUT_FORMAT_PARQUET:
+            return ParquetWriter(self.files_out_path, object_name, table_definition.column_names)
+
+        performance_settings = self.configuration.parameters.get(KEY_PERFORMANCE_SETTINGS, {})
+        max_megabytes = performance_settings.get(KEY_PERFORMANCE_SETTINGS_SLICE_MAX_MEGABYTES)
+        compress = self.output_format == OUTPUT_FORMAT_CSV_GZIP
+        return SlicedCsvWriter(table_definition.full_path, table_definition.column_names, compress=compress,
+                               max_rows_per_slice=performance_settings.get(KEY_PERFORMANCE_SETTINGS_SLICE_MAX_ROWS),
+                               max_bytes_per_slice=max_megabytes * 1024 ** 2 if max_megabytes else None,
+                               compression_executor=self._get_compression_executor() if compress else None)
+
+    def _get_compression_executor(self) -> Optional[ThreadPoolExecutor]:
+        """
+        Returns the thread pool compressing the CSV tables, None if the tables are compressed by the threads
+        writing them. It is called under the result writers lock, or before the accounts are extracted.
+        """
+        if self._compression_executor is None:
+            performance_settings = self.configuration.parameters.get(KEY_PERFORMANCE_SETTINGS, {})
+            workers = performance_settings.get(KEY_PERFORMANCE_SETTINGS_COMPRESSION_WORKERS,
+                                               DEFAULT_COMPRESSION_WORKERS)
+            if workers > 0:
+                self._compression_executor = ThreadPoolExecutor(max_workers=workers,
+                                                                thread_name_prefix="compression")
+        return self._compression_executor
+
+    def _get_result_writer(self, object_name: str) -> SlicedCsvWriter:
+        if self.account_id is None:
+            return self.result_writers.get(object_name).get("writer")
+        # the accounts extracted concurrently write into the same tables
+        writer = self._account_writers.get(object_name)
+        if writer is None:
+            result_writer = self.result_writers.get(object_name)
+            writer = self._account_writers[object_name] = SharedRowWriter(
+                result_writer.get("writer"), result_writer.get("lock"), {ACCOUNT_ID_COLUMN: self.account_id})
+        return writer
 
     def _close_all_result_writers(self) -> None:
-        for object_name in self.result_writers:
-            writer = self._get_result_writer(object_name)
+        # writers are created in the order the endpoints happen to reach them, which is not deterministic when
+        # endpoints run concurrently, so the columns are merged into the state in a stable order
+        for object_name in sorted(self.result_writers):
+            writer = self.result_writers.get(object_name).get("writer")
             table_definition = self.result_writers.get(object_name).get("table_definition")
             writer.close()
             self.new_state[object_name] = copy.deepcopy(writer.fieldnames)
 
+            if isinstance(writer, ParquetWriter):
+                self._write_parquet_file_manifests(object_name, writer)
+                continue
+
             writer_columns = copy.deepcopy(writer.fieldnames)
             table_definition = self._deduplicate_column_names_and_metadata(table_definition, writer_columns)
 
@@ -310,6 +1040,16 @@ class Component(ComponentBase):
 
             self.write_manifest(table_definition)
 
+        if self._compression_executor is not None:
+            self._compression_executor.shutdown()
+            self._compression_executor = None
+
+    def _write_parquet_file_manifests(self, object_name: str, writer: ParquetWriter) -> None:
+        for file_path in writer.file_paths:
+            file_definition = self.create_out_file_definition(os.path.basename(file_path),
+                                                              tags=["klaviyo", object_name, OUTPUT_FORMAT_PARQUET])
+            self.write_manifest(file_definition)
+
     @staticmethod
     def _add_missing_metadata(table_definition: TableDefinition) -> TableDefinition:
         """
@@ -327,6 +1067,8 @@ class Component(ComponentBase):
 
     @staticmethod
     def _normalize_headers(columns: List[str]) -> List[str]:
+        from keboola.utils import header_normalizer
+
         head_norm = header_normalizer.get_normalizer(strategy=header_normalizer.NormalizerStrategy.ENCODER,
                                                      char_encoder="unicode")
         return head_norm.normalize_header(columns)
@@ -375,7 +1117,7 @@ class Component(ComponentBase):
         # Old version of time range, kept for backward compatibility
         # Validate Date From and Date for events, if events are to be downloaded
         event_settings = params.get(KEY_EVENTS_SETTINGS)
-        if event_settings and events:
+        if event_settings and KEY_DATE_FROM in event_settings and events:
             logging.info("Validating Event parameters...")
             self._parse_date(event_settings.get(KEY_DATE_FROM))
             self._parse_date(event_settings.get(KEY_DATE_TO))
@@ -395,19 +1137,21 @@ class Component(ComponentBase):
         if profile_mode == "fetch_by_segment" and objects.get("profiles"):
             logging.info("Validating Profile fetching parameters...")
             segments = profile_settings.get(KEY_PROFILES_SETTINGS_FETCH_BY_SEGMENT, [])
+            existing_segments = self._get_existing_ids(self.client.get_segments_by_ids, segments)
             for segment_id in segments:
-                try:
-                    self.client.get_segment(segment_id)
-                except KlaviyoClientException as e:
-                    raise UserException(f"Segment with ID {segment_id} not found.") from e
+                if segment_id not in existing_segments:
+                    raise UserException(f"Segment with ID {segment_id} not found.")
             logging.info("Profile fetching parameters are valid")
 
         # Validate if list ids for profile fetching are valid
         if profile_mode == "fetch_by_list" and objects.get("profiles"):
             logging.info("Validating Profile fetching parameters...")
             lists = profile_settings.get(KEY_PROFILES_SETTINGS_FETCH_BY_LIST, [])
+            existing_lists = self._get_existing_ids(self.client.get_lists_by_ids, lists)
             for list_id in lists:
-                self.client.get_list(list_id)
+                if list_id not in existing_lists:
+                    # the list is requested on its own, so the run fails with the error returned by the API
+                    self.client.get_list(list_id)
             logging.info("Profile fetching parameters are valid")
 
         # Validate if list ids for metric aggregates are valid
@@ -415,18 +1159,38 @@ class Component(ComponentBase):
         if metric_aggregates_settings and metric_aggregates:
             metric_aggregates_ids = metric_aggregates_settings.get(KEY_METRIC_AGGREGATES_SETTINGS_METRIC_IDS)
             logging.info("Validating metric aggregates parametrs...")
-            for metric_id in metric_aggregates_ids:
-                try:
-                    self.client.get_metric(metric_id)
-                except KlaviyoClientException as e:
-                    raise UserException(f"Metric with ID {metric_id} not found.") from e
+            with ThreadPoolExecutor(max_workers=VALIDATION_METRIC_MAX_WORKERS,
+                                    thread_name_prefix="validation") as executor:
+                errors = list(executor.map(self._get_metric_error, metric_aggregates_ids))
+            for metric_id, error in zip(metric_aggregates_ids, errors):
+                if error is not None:
+                    raise UserException(f"Metric with ID {metric_id} not found.") from error
             logging.info("Metric aggregates parameters are valid")
-        # sync action that is executed when configuration.json "action":"testConnection" parameter is present.
 
+    @staticmethod
+    def _get_existing_ids(ids_generator: Callable, ids: List[str]) -> set:
+        """
+        Returns the IDs that exist in the account, the IDs are requested in batches filtered by the API.
+        """
+        unique_ids = list(dict.fromkeys(ids))
+        existing_ids = set()
+        for i in range(0, len(unique_ids), VALIDATION_ID_BATCH_SIZE):
+            for page in ids_generator(unique_ids[i:i + VALIDATION_ID_BATCH_SIZE]):
+                existing_ids.update(item["id"] for item in page)
+        return existing_ids
+
+    def _get_metric_error(self, metric_id: str) -> Optional[KlaviyoClientException]:
+        try:
+            self.client.get_metric(metric_id)
+        except KlaviyoClientException as e:
+            return e
+        return None
+
+    # sync action that is executed when configuration.json "action":"testConnection" parameter is present.
     @sync_action('validate_connection')
     def test_connection(self) -> ValidationResult:
-        self._init_client()
-        credentials_valid, missing_scopes, last_exception = self.client.test_credentials()
+        sync_client = SyncActionClient(self._get_api_token())
+        credentials_valid, missing_scopes, last_exception = sync_client.test_credentials()
 
         result = ValidationResult("Credentials are valid!", MessageType.SUCCESS)
 
@@ -451,9 +1215,9 @@ class Component(ComponentBase):
 
     @sync_action("loadListIds")
     def load_list_ids(self) -> List[SelectElement]:
-        self._init_client()
+        sync_client = SyncActionClient(self._get_api_token())
         try:
-            list_ids = self.client.get_list_ids()
+            list_ids = sync_client.get_list_ids()
             r = [SelectElement(value=list_id.get("id"), label=json.dumps(list_id.get("name"))) for list_id in list_ids]
         except Exception as e:
             raise UserException(e) from e
@@ -461,9 +1225,9 @@ class Component(ComponentBase):
 
     @sync_action("loadSegmentIds")
     def load_segment_ids(self) -> List[SelectElement]:
-        self._init_client()
+        sync_client = SyncActionClient(self._get_api_token())
         try:
-            segment_ids = self.client.get_segment_ids()
+            segment_ids = sync_client.get_segment_ids()
             r = [SelectElement(value=segment_id.get("id"), label=json.dumps(segment_id.get("name")))
                  for segment_id in segment_ids]
         except Exception as e:
@@ -472,9 +1236,9 @@ class Component(ComponentBase):
 
     @sync_action("loadMetricIds")
     def load_metric_ids(self) -> List[SelectElement]:
-        self._init_client()
+        sync_client = SyncActionClient(self._get_api_token())
         try:
-            metric_ids = self.client.get_metric_ids()
+            metric_ids = sync_client.get_metric_ids()
             r = [SelectElement(value=metric_id.get("id"), label=json.dumps(metric_id.get("name")))
                  for metric_id in metric_ids]
         except Exception as e:
@@ -1,6 +1,38 @@
+from typing import Dict, List, Optional, Tuple
+
+try:
+    from orjson import dumps as _orjson_dumps
+
+    def json_dumps(value) -> str:
+        return _orjson_dumps(value, default=str).decode("utf-8")
+except ImportError:
+    import json
+
+    def json_dumps(value) -> str:
+        return json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=str)
+
+# maximum number of dictionary shapes whose flattened key names are cached
+MAX_CACHED_SHAPES = 10000
+
+
 class FlattenJsonParser:
-    def __init__(self, child_separator: str = '_'):
+    """
+    Flattens nested dictionaries into a single level, the keys of nested values are joined by the child separator.
+
+    With max_depth set, only dictionaries nested at most max_depth levels deep are flattened, deeper values are
+    serialized as JSON into a single column, e.g. with max_depth 1 {"a": {"b": {"c": 1}}} becomes {"a_b": '{"c":1}'}
+    and with max_depth 0 every nested value is serialized. Columns listed in flatten_columns are flattened
+    regardless of their depth, together with the dictionaries containing them. When either option is set,
+    lists are serialized as JSON as well.
+    """
+
+    def __init__(self, child_separator: str = '_', max_depth: Optional[int] = None,
+                 flatten_columns: Optional[List[str]] = None):
         self.child_separator = child_separator
+        self.flatten_columns = list(flatten_columns or [])
+        self.max_depth = max_depth if max_depth is not None or not self.flatten_columns else 0
+        self._shape_cache: Dict[Tuple[str, Tuple[str, ...]], Tuple[str, ...]] = {}
+        self._flattened_keys: Dict[str, bool] = {}
 
     def parse_data(self, data):
         for i, row in enumerate(data):
@@ -8,24 +40,80 @@ class FlattenJsonParser:
         return data
 
     def parse_row(self, row: dict):
+        if self.max_depth is not None:
+            return self._flatten_row_to_depth(row)
         return self._flatten_row(row)
 
     @staticmethod
     def _construct_key(parent_key, separator, child_key):
         return "".join([parent_key, separator, child_key]) if parent_key else child_key
 
+    def _get_child_keys(self, parent_key: str, dict_object: dict) -> Tuple[str, ...]:
+        """
+        Returns the flattened keys of the children of a dictionary. Rows of one object mostly share their shapes,
+        so the keys are constructed once per parent key and set of child keys and then taken from the cache.
+        """
+        shape = (parent_key, tuple(dict_object))
+        child_keys = self._shape_cache.get(shape)
+        if child_keys is None:
+            child_keys = tuple(self._construct_key(parent_key, self.child_separator, key) for key in shape[1])
+            if len(self._shape_cache) >= MAX_CACHED_SHAPES:
+                self._shape_cache.clear()
+            self._shape_cache[shape] = child_keys
+        return child_keys
+
     def _flatten_row(self, nested_dict):
         if len(nested_dict) == 0:
             return {}
         flattened_dict = {}
+        shape_cache = self._shape_cache
 
-        def _flatten(dict_object, name_with_parent=''):
-            if isinstance(dict_object, dict):
-                for key in dict_object:
-                    new_parent_name = self._construct_key(name_with_parent, self.child_separator, key)
-                    _flatten(dict_object[key], name_with_parent=new_parent_name)
+        # depth first traversal with a stack of partially consumed children iterators, so the keys are
+        # inserted in the same order as by a recursive traversal
+        stack = [zip(self._get_child_keys('', nested_dict), nested_dict.values())]
+        while stack:
+            for key, value in stack[-1]:
+                if isinstance(value, dict):
+                    child_keys = shape_cache.get((key, tuple(value))) or self._get_child_keys(key, value)
+                    stack.append(zip(child_keys, value.values()))
+                    break
+                flattened_dict[key] = value
             else:
-                flattened_dict[name_with_parent] = dict_object
+                stack.pop()
+        return flattened_dict
 
-        _flatten(nested_dict)
+    def _flatten_row_to_depth(self, nested_dict):
+        flattened_dict = {}
+        max_depth = self.max_depth
+
+        stack = [(zip(self._get_child_keys('', nested_dict), nested_dict.values()), 0)]
+        while stack:
+            children, depth = stack[-1]
+            for key, value in children:
+                if isinstance(value, dict):
+                    if depth < max_depth or self._is_flattened_key(key):
+                        stack.append((zip(self._get_child_keys(key, value), value.values()), depth + 1))
+                        break
+                    flattened_dict[key] = json_dumps(value)
+                elif isinstance(value, list):
+                    flattened_dict[key] = json_dumps(value)
+                else:
+                    flattened_dict[key] = value
+            else:
+                stack.pop()
         return flattened_dict
+
+    def _is_flattened_key(self, key: str) -> bool:
+        """
+        Returns whether the dictionary under the key is flattened beyond the max depth, i.e. it is one of
+        the flatten columns, it is nested in one of them or one of them is nested in it.
+        """
+        flattened = self._flattened_keys.get(key)
+        if flattened is None:
+            separator = self.child_separator
+            flattened = any(column == key or column.startswith(key + separator) or key.startswith(column + separator)
+                            for column in self.flatten_columns)
+            if len(self._flattened_keys) >= MAX_CACHED_SHAPES:
+                self._flattened_keys.clear()
+            self._flattened_keys[key] = flattened
+        return flattened
@@ -0,0 +1,312 @@
+import csv
+import gzip
+import os
+import threading
+from collections import deque
+from concurrent.futures import Executor
+from typing import Dict, List, Optional, Tuple
+
+# the first rows of a table are kept in memory until this many rows are collected, the columns discovered in them
+# are then known before anything is written
+COLUMN_DISCOVERY_ROWS = 1000
+# uncompressed CSV data in a slice when no limit is set, slices padded with the columns appearing later are
+# rewritten one at a time, so a late column never rewrites more than this at once
+DEFAULT_MAX_BYTES_PER_SLICE = 128 * 1024 ** 2
+
+# uncompressed CSV data compressed at once into an independent gzip member, the members of a slice are
+# concatenated in order, which is a valid gzip file
+COMPRESSION_BLOCK_SIZE = 1024 * 1024
+# compressed blocks waiting for a compression thread, the writer waits for the oldest one above this limit
+MAX_PENDING_COMPRESSION_BLOCKS = 8
+GZIP_COMPRESSION_LEVEL = 6
+
+PARQUET_ROW_GROUP_SIZE = 50000
+PARQUET_COMPRESSION = "zstd"
+
+
+def parquet_available() -> bool:
+    try:
+        import pyarrow  # noqa: F401
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class GzipBlockFile:
+    """
+    Text file writing gzip compressed data, the data is compressed in blocks by the threads of the executor,
+    so the writing thread only formats the rows. The compressed blocks are written into the file in order.
+    Without an executor the blocks are compressed by the writing thread.
+    """
+
+    def __init__(self, path: str, executor: Optional[Executor] = None):
+        self.executor = executor
+        self._file = open(path, "wb")
+        self._block = []
+        self._block_length = 0
+        self._pending = deque()
+
+    def write(self, data: str) -> int:
+        self._block.append(data)
+        self._block_length += len(data)
+        if self._block_length >= COMPRESSION_BLOCK_SIZE:
+            self._compress_block()
+        return len(data)
+
+    def close(self) -> None:
+        if self._file is None:
+            return
+        try:
+            self._compress_block()
+            while self._pending:
+                self._file.write(self._pending.popleft().result())
+        finally:
+            self._file.close()
+            self._file = None
+
+    def _compress_block(self) -> None:
+        if not self._block:
+            return
+        block = "".join(self._block).encode("utf-8")
+        self._block = []
+        self._block_length = 0
+        if self.executor is None:
+            self._file.write(gzip.compress(block, compresslevel=GZIP_COMPRESSION_LEVEL))
+            return
+
+        self._pending.append(self.executor.submit(gzip.compress, block, compresslevel=GZIP_COMPRESSION_LEVEL))
+        while self._pending and (self._pending[0].done() or len(self._pending) > MAX_PENDING_COMPRESSION_BLOCKS):
+            self._file.write(self._pending.popleft().result())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class SlicedCsvWriter:
+    """
+    Writes rows into a sliced headerless CSV table, the columns are listed only in the manifest. All slices of
+    a table must have the same columns, so when a row brings new columns they are appended to the end of the
+    columns and the following rows are written into a new slice.
+
+    The data is written directly into the slices, when all columns are known upfront (e.g. from the state of
+    the previous run) nothing is rewritten on close. Otherwise only the slices finished before the last columns
+    appeared are padded with empty values of the new columns, the rows written after them are never rewritten.
+    The first rows of the table are buffered, so columns appearing only among them do not cause any padding.
+
+    A new slice is also started when the current one reaches max_rows_per_slice rows or max_bytes_per_slice bytes
+    of uncompressed CSV (DEFAULT_MAX_BYTES_PER_SLICE if not set), so Storage can import the slices in parallel
+    and padding rewrites bounded slices. Compressed slices are compressed by the threads of the compression
+    executor if it is set.
+    """
+
+    def __init__(self, directory: str, fieldnames: List[str], compress: bool = False,
+                 max_rows_per_slice: Optional[int] = None, max_bytes_per_slice: Optional[int] = None,
+                 compression_executor: Optional[Executor] = None):
+        self.directory = directory
+        self.fieldnames = list(fieldnames)
+        self.compress = compress
+        self.max_rows_per_slice = max_rows_per_slice
+        self.max_bytes_per_slice = max_bytes_per_slice or DEFAULT_MAX_BYTES_PER_SLICE
+        self.compression_executor = compression_executor
+        self._known_columns = set(self.fieldnames)
+        # path of each slice and the number of columns of its narrowest rows
+        self._slices: List[Tuple[str, int]] = []
+        self._file = None
+        self._writer = None
+        self._rows_in_slice = 0
+        self._bytes_in_slice = 0
+        self._buffered_rows = []
+        os.makedirs(directory, exist_ok=True)
+        self._open_slice()
+
+    def writerow(self, row_dict: Dict) -> None:
+        if self._buffered_rows is not None:
+            self._add_columns(row_dict)
+            self._buffered_rows.append(row_dict)
+            if len(self._buffered_rows) >= COLUMN_DISCOVERY_ROWS:
+                self._write_buffered_rows()
+            return
+
+        if self._slice_full():
+            self._open_slice()
+        if not self._known_columns.issuperset(row_dict):
+            self._add_columns(row_dict)
+            if self._rows_in_slice:
+                # only the rows written so far are padded on close, the wider rows go into a new slice
+                self._open_slice()
+            else:
+                self._slices[-1] = (self._slices[-1][0], len(self.fieldnames))
+        # csv writer returns the number of characters written by the file
+        self._bytes_in_slice += self._writer.writerow([row_dict.get(column) for column in self.fieldnames])
+        self._rows_in_slice += 1
+
+    def writerows(self, row_dicts: List[Dict]) -> None:
+        for row_dict in row_dicts:
+            self.writerow(row_dict)
+
+    def close(self) -> None:
+        if self._buffered_rows is not None:
+            self._write_buffered_rows()
+        self._close_slice()
+        for slice_path, columns in self._slices:
+            if columns < len(self.fieldnames):
+                self._pad_slice(slice_path, len(self.fieldnames))
+
+    @property
+    def slice_paths(self) -> List[str]:
+        return [slice_path for slice_path, _ in self._slices]
+
+    def _slice_full(self) -> bool:
+        if not self._rows_in_slice:
+            return False
+        return ((self.max_rows_per_slice is not None and self._rows_in_slice >= self.max_rows_per_slice)
+                or self._bytes_in_slice >= self.max_bytes_per_slice)
+
+    def _add_columns(self, row_dict: Dict) -> None:
+        for column in row_dict:
+            if column not in self._known_columns:
+                self._known_columns.add(column)
+                self.fieldnames.append(column)
+
+    def _write_buffered_rows(self) -> None:
+        buffered_rows = self._buffered_rows
+        self._buffered_rows = None
+        self._slices[-1] = (self._slices[-1][0], len(self.fieldnames))
+        for row_dict in buffered_rows:
+            self.writerow(row_dict)
+
+    def _open_slice(self) -> None:
+        self._close_slice()
+        extension = ".csv.gz" if self.compress else ".csv"
+        slice_path = os.path.join(self.directory, f"part_{len(self._slices):04d}{extension}")
+        self._file = self._open(slice_path, "wt")
+        self._writer = csv.writer(self._file)
+        self._slices.append((slice_path, len(self.fieldnames)))
+        self._rows_in_slice = 0
+        self._bytes_in_slice = 0
+
+    def _close_slice(self) -> None:
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+
+    def _pad_slice(self, slice_path: str, columns: int) -> None:
+        padded_path = f"{slice_path}.padded"
+        with self._open(slice_path, "rt") as source_file, self._open(padded_path, "wt") as target_file:
+            writer = csv.writer(target_file)
+            for row in csv.reader(source_file):
+                writer.writerow(row + [None] * (columns - len(row)))
+        os.replace(padded_path, slice_path)
+
+    def _open(self, path: str, mode: str):
+        if self.compress and mode == "wt":
+            return GzipBlockFile(path, self.compression_executor)
+        if self.compress:
+            return gzip.open(path, mode, encoding="utf-8", newline="")
+        return open(path, mode, encoding="utf-8", newline="")
+
+
+class SharedRowWriter:
+    """
+    Writes the rows of one of several threads sharing a result writer, the same values (e.g. the ID of the account
+    the rows come from) are added to every row. Each row is written under the lock of the shared writer.
+    """
+
+    def __init__(self, writer, lock: threading.Lock, extra_values: Dict):
+        self.writer = writer
+        self.extra_values = extra_values
+        self._lock = lock
+
+    @property
+    def fieldnames(self) -> List[str]:
+        return self.writer.fieldnames
+
+    def writerow(self, row_dict: Dict) -> None:
+        row = {**row_dict, **self.extra_values}
+        with self._lock:
+            self.writer.writerow(row)
+
+    def writerows(self, row_dicts: List[Dict]) -> None:
+        for row_dict in row_dicts:
+            self.writerow(row_dict)
+
+
+class ParquetWriter:
+    """
+    Writes rows into Parquet files in row groups, all columns are stored as strings the same way as in CSV and
+    columns missing in a row are stored as nulls.
+
+    When rows bring new columns, the current file is finished and the following row groups are written into a new
+    file with the extended schema, so no data is rewritten. Readers merging the schemas of the files
+    (e.g. pyarrow datasets or DuckDB union_by_name) read the files as a single table.
+    """
+
+    def __init__(self, directory: str, file_prefix: str, fieldnames: List[str],
+                 row_group_size: int = PARQUET_ROW_GROUP_SIZE):
+        import pyarrow
+        import pyarrow.parquet
+
+        self._pyarrow = pyarrow
+        self._parquet = pyarrow.parquet
+        self.directory = directory
+        self.file_prefix = file_prefix
+        self.fieldnames = list(fieldnames)
+        self.file_paths = []
+        self.row_group_size = row_group_size
+        self._known_columns = set(self.fieldnames)
+        self._rows = []
+        self._writer = None
+        self._writer_columns = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def writerow(self, row_dict: Dict) -> None:
+        if not self._known_columns.issuperset(row_dict):
+            for column in row_dict:
+                if column not in self._known_columns:
+                    self._known_columns.add(column)
+                    self.fieldnames.append(column)
+        self._rows.append(row_dict)
+        if len(self._rows) >= self.row_group_size:
+            self._write_row_group()
+
+    def writerows(self, row_dicts: List[Dict]) -> None:
+        for row_dict in row_dicts:
+            self.writerow(row_dict)
+
+    def close(self) -> None:
+        self._write_row_group()
+        if self._writer is None:
+            # the table is written even if empty, so its columns are available
+            self._open_file()
+        self._writer.close()
+
+    def _open_file(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+        file_path = os.path.join(self.directory, f"{self.file_prefix}_{len(self.file_paths):04d}.parquet")
+        schema = self._pyarrow.schema([(column, self._pyarrow.string()) for column in self.fieldnames])
+        self._writer = self._parquet.ParquetWriter(file_path, schema, compression=PARQUET_COMPRESSION)
+        self._writer_columns = len(self.fieldnames)
+        self.file_paths.append(file_path)
+
+    def _write_row_group(self) -> None:
+        if not self._rows:
+            return
+        if self._writer is None or self._writer_columns != len(self.fieldnames):
+            self._open_file()
+
+        to_string = self._to_string
+        columns = {column: [to_string(row.get(column)) for row in self._rows] for column in self.fieldnames}
+        self._writer.write_table(self._pyarrow.table(columns, schema=self._writer.schema))
+        self._rows = []
+
+    @staticmethod
+    def _to_string(value):
+        if value is None or isinstance(value, str):
+            return value
+        return str(value)
@@ -0,0 +1,74 @@
+"""
+Import time benchmark of the component. Every action, including the sync actions backing the configuration UI,
+starts a new process that imports the component first, so its import time adds to the latency of each action.
+
+Run from the repository root:
+
+    python -m tests.benchmarks.import_time --repeat 5 --max-seconds 1
+
+Each repetition imports the modules in a new Python process, the fastest import is reported together with
+the modules taking the longest to import themselves (without their imports, as reported by -X importtime) and
+the heavy modules that were imported. The run fails if the import takes longer than --max-seconds.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+from typing import Dict, List
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..", "src")
+
+# modules that should be imported only by the actions needing them
+HEAVY_MODULES = ["klaviyo_api", "openapi_client", "dateparser", "keboola.utils.header_normalizer", "pyarrow"]
+
+
+def measure_import(module: str) -> Dict:
+    """
+    Imports the module in a new process, returns its import time and the self time of every imported module.
+    """
+    code = f"import json, sys, {module}; print(json.dumps([m for m in {HEAVY_MODULES} if m in sys.modules]))"
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=SRC_PATH, capture_output=True,
+                             text=True, check=True)
+    self_times = {}
+    total_microseconds = 0
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_time, cumulative_time, name = line[len("import time:"):].split("|")
+        self_times[name.strip()] = int(self_time)
+        # nested imports are indented, the cumulative time of the module includes all modules it imports
+        if name.strip() == module and not name[1:].startswith(" "):
+            total_microseconds = int(cumulative_time)
+    return {"seconds": total_microseconds / 1e6, "self_times": self_times,
+            "heavy_modules": json.loads(process.stdout)}
+
+
+def main(argv: List[str] = None) -> Dict:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--module", default="component", help="module to import")
+    parser.add_argument("--repeat", type=int, default=5, help="number of imports, the fastest one is reported")
+    parser.add_argument("--top", type=int, default=10, help="number of the slowest modules to list")
+    parser.add_argument("--max-seconds", type=float, help="fail if the import takes longer")
+    parser.add_argument("--output", help="path of a JSON file the result is written to")
+    args = parser.parse_args(argv)
+
+    result = min((measure_import(args.module) for _ in range(args.repeat)), key=lambda measured: measured["seconds"])
+    print(f"import {args.module}: {result['seconds']:.3f} s")
+    print(f"heavy modules imported: {', '.join(result['heavy_modules']) or 'none'}")
+    slowest = sorted(result["self_times"].items(), key=lambda item: item[1], reverse=True)[:args.top]
+    for name, microseconds in slowest:
+        print(f"{name:<60}{microseconds / 1000:>10.1f} ms")
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump({"python": sys.version, "module": args.module, "seconds": result["seconds"],
+                       "heavy_modules": result["heavy_modules"], "slowest_modules": dict(slowest)},
+                      output_file, indent=2)
+    if args.max_seconds is not None and result["seconds"] > args.max_seconds:
+        sys.exit(f"import {args.module} took {result['seconds']:.3f} s, more than {args.max_seconds} s")
+    return result
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Synthetic Klaviyo shaped payloads for the benchmarks. The payloads are generated from a seeded random generator,
+so every run of the benchmarks processes the same data.
+"""
+import random
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, List
+
+START_TIMESTAMP = 1700000000
+
+EVENT_NAMES = ["Placed Order", "Ordered Product", "Viewed Product", "Opened Email", "Clicked Email"]
+PRODUCT_CATEGORIES = ["Shoes", "Shirts", "Accessories", "Sale", "New Arrivals"]
+
+
+def make_event(rng: random.Random, index: int) -> Dict:
+    """
+    Event with deeply nested event properties, the shape of the properties depends on the event name.
+    """
+    timestamp = START_TIMESTAMP + index
+    event_name = rng.choice(EVENT_NAMES)
+    event_properties = {
+        "$event_id": f"{event_name}:{index}",
+        "$value": round(rng.uniform(1, 500), 2),
+        "$extra": {
+            "Source": rng.choice(["web", "api", "shopify"]),
+            "Session": {"Id": f"session-{rng.randint(1, 10000)}", "Device": {"Type": "mobile", "Os": "ios"}},
+        },
+    }
+    if event_name in ("Placed Order", "Ordered Product"):
+        event_properties["Items"] = [f"SKU-{rng.randint(1, 999)}" for _ in range(rng.randint(1, 5))]
+        event_properties["Product"] = {
+            "Name": f"Product {rng.randint(1, 999)}",
+            "Categories": rng.sample(PRODUCT_CATEGORIES, 2),
+            "Price": {"Amount": round(rng.uniform(1, 200), 2), "Currency": "USD"},
+            "Brand": {"Name": "Brand", "Url": "https://example.com/brand"},
+        }
+    else:
+        event_properties["Campaign Name"] = f"Campaign {rng.randint(1, 50)}"
+        event_properties["Subject"] = "Our newest arrivals"
+
+    return {
+        "type": "event",
+        "id": f"event-{index}",
+        "attributes": {
+            "timestamp": timestamp,
+            "event_properties": event_properties,
+            "datetime": datetime.fromtimestamp(timestamp, tz=timezone.utc).isoformat(),
+            "uuid": f"00000000-0000-0000-0000-{index:012d}",
+        },
+        "relationships": {
+            "metric": {"data": {"type": "metric", "id": f"metric-{EVENT_NAMES.index(event_name)}"}},
+            "profile": {"data": {"type": "profile", "id": f"profile-{rng.randint(1, 100000)}"}},
+        },
+    }
+
+
+def make_profile(rng: random.Random, index: int, custom_properties: int = 40) -> Dict:
+    """
+    Profile with the standard attributes and a wide set of custom properties.
+    """
+    created = datetime(2020, 1, 1, tzinfo=timezone.utc) + timedelta(minutes=index)
+    return {
+        "type": "profile",
+        "id": f"profile-{index}",
+        "attributes": {
+            "email": f"user{index}@example.com",
+            "phone_number": f"+1555{index:07d}",
+            "external_id": None,
+            "anonymous_id": None,
+            "first_name": "First",
+            "last_name": "Last",
+            "organization": None,
+            "locale": "en-US",
+            "title": None,
+            "image": None,
+            "created": created.isoformat(),
+            "updated": created.isoformat(),
+            "last_event_date": created.isoformat(),
+            "location": {
+                "address1": f"{rng.randint(1, 999)} Main St",
+                "address2": None,
+                "city": "Boston",
+                "country": "United States",
+                "latitude": rng.uniform(-90, 90),
+                "longitude": rng.uniform(-180, 180),
+                "region": "MA",
+                "zip": "02110",
+                "timezone": "America/New_York",
+                "ip": "127.0.0.1",
+            },
+            "properties": {f"Custom Property {i}": rng.choice([None, "value", 1, True]) for i in
+                           range(custom_properties)},
+        },
+    }
+
+
+def make_metric_aggregate_response(rng: random.Random, dates: int, partitions: int) -> Dict:
+    """
+    Query metric aggregates response with daily values of all measurements for each partition.
+    """
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    return {
+        "type": "metric-aggregate",
+        "id": "aggregate",
+        "attributes": {
+            "dates": [(start + timedelta(days=i)).isoformat() for i in range(dates)],
+            "data": [
+                {
+                    "dimensions": [f"Campaign {i}", "" if i % 3 == 0 else "email"],
+                    "measurements": {
+                        "count": [float(rng.randint(0, 100)) for _ in range(dates)],
+                        "unique": [float(rng.randint(0, 100)) for _ in range(dates)],
+                        "sum_value": [rng.uniform(0, 1000) for _ in range(dates)],
+                    },
+                }
+                for i in range(partitions)
+            ],
+        },
+    }
+
+
+def make_rows(kind: str, rows: int, seed: int = 0) -> List[Dict]:
+    rng = random.Random(seed)
+    factory = {"event": make_event, "profile": make_profile}[kind]
+    return [factory(rng, index) for index in range(rows)]
+
+
+def paginate(rows: List[Dict], page_size: int) -> Iterator[List[Dict]]:
+    for start in range(0, len(rows), page_size):
+        yield rows[start:start + page_size]
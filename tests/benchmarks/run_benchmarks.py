@@ -0,0 +1,201 @@
+"""
+Offline benchmarks of the flatten and write hot path on synthetic Klaviyo shaped payloads.
+
+Run from the repository root:
+
+    python -m tests.benchmarks.run_benchmarks --rows 20000 --output benchmark.json
+
+A page cache recorded by the component (page_cache_mode "record") can be benchmarked as well, its resources are
+flattened the same way as the synthetic payloads:
+
+    python -m tests.benchmarks.run_benchmarks --page-cache klaviyo_page_cache.ndjson.gz --only flatten_page_cache
+
+Each benchmark is timed the given number of times and the fastest run is reported. Memory is measured in a separate
+run with tracemalloc, which slows the code down, so it does not affect the timing. The peak memory is the largest
+amount of memory allocated during the run on top of its input, the retained blocks are the memory blocks allocated
+by the run that are still alive after it finished.
+"""
+import argparse
+import gc
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from dataclasses import dataclass, asdict
+from typing import Callable, Dict, List, Tuple
+from unittest import mock
+
+from client import KlaviyoClient, PageCache, PAGE_CACHE_REPLAY
+from component import Component
+from json_parser import FlattenJsonParser
+from tests.benchmarks.payloads import make_metric_aggregate_response, make_rows, paginate
+
+PAGE_SIZE = 100
+METRIC_AGGREGATE_DATES = 365
+
+
+@dataclass
+class BenchmarkResult:
+    name: str
+    rows: int
+    seconds: float
+    rows_per_second: float
+    peak_memory_mb: float
+    retained_blocks: int
+
+
+@dataclass
+class Benchmark:
+    """
+    The setup prepares the input of a single run outside of the measurement, run processes it and returns
+    the number of processed rows.
+    """
+    name: str
+    setup: Callable[[], Tuple]
+    run: Callable[..., int]
+    teardown: Callable[..., None] = None
+
+
+def measure(benchmark: Benchmark, repeat: int) -> BenchmarkResult:
+    best = None
+    rows = 0
+    for _ in range(repeat):
+        args = benchmark.setup()
+        gc.collect()
+        start = time.perf_counter()
+        rows = benchmark.run(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+        if benchmark.teardown:
+            benchmark.teardown(*args)
+
+    args = benchmark.setup()
+    gc.collect()
+    blocks_before = sys.getallocatedblocks()
+    tracemalloc.start()
+    benchmark.run(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    gc.collect()
+    retained_blocks = sys.getallocatedblocks() - blocks_before
+    if benchmark.teardown:
+        benchmark.teardown(*args)
+
+    return BenchmarkResult(name=benchmark.name, rows=rows, seconds=round(best, 4),
+                           rows_per_second=round(rows / best) if best else 0,
+                           peak_memory_mb=round(peak / 1024 ** 2, 2), retained_blocks=retained_blocks)
+
+
+def flatten_benchmark(kind: str, rows: int) -> Benchmark:
+    def setup():
+        return FlattenJsonParser(), [row["attributes"] for row in make_rows(kind, rows)]
+
+    def run(parser: FlattenJsonParser, attributes: List[Dict]) -> int:
+        for row in attributes:
+            parser.parse_row(row)
+        return len(attributes)
+
+    return Benchmark(f"flatten_{kind}", setup, run)
+
+
+def page_cache_benchmark(page_cache_path: str) -> Benchmark:
+    def setup():
+        page_cache = PageCache(page_cache_path, PAGE_CACHE_REPLAY)
+        attributes = [item["attributes"] for response in page_cache.responses()
+                      if isinstance(response.get("data"), list) for item in response["data"]]
+        return FlattenJsonParser(), attributes
+
+    def run(parser: FlattenJsonParser, attributes: List[Dict]) -> int:
+        for row in attributes:
+            parser.parse_row(row)
+        return len(attributes)
+
+    return Benchmark("flatten_page_cache", setup, run)
+
+
+def normalize_metric_aggregates_benchmark(rows: int) -> Benchmark:
+    partitions = max(rows // METRIC_AGGREGATE_DATES, 1)
+
+    def setup():
+        client = KlaviyoClient(api_token="benchmark")
+        return client, make_metric_aggregate_response(random.Random(0), METRIC_AGGREGATE_DATES, partitions)
+
+    def run(client: KlaviyoClient, response: Dict) -> int:
+        return sum(1 for _ in client._normalize_aggregated_response(response, "metric"))
+
+    return Benchmark("normalize_metric_aggregates", setup, run)
+
+
+def fetch_and_write_benchmark(kind: str, rows: int, output_format: str) -> Benchmark:
+    def setup():
+        data_dir = tempfile.mkdtemp(prefix="klaviyo-benchmark-")
+        os.makedirs(os.path.join(data_dir, "out", "tables"))
+        os.makedirs(os.path.join(data_dir, "out", "files"))
+        with open(os.path.join(data_dir, "config.json"), "w") as config_file:
+            json.dump({"parameters": {"#api_token": "benchmark", "objects": {}}}, config_file)
+        with mock.patch.dict(os.environ, {"KBC_DATADIR": data_dir}):
+            component = Component()
+        component.output_format = output_format
+        return component, list(paginate(make_rows(kind, rows), PAGE_SIZE)), data_dir
+
+    def run(component: Component, pages: List[List[Dict]], data_dir: str) -> int:
+        component.fetch_and_write_object_data(kind, lambda: iter(pages))
+        component._close_all_result_writers()
+        return sum(len(page) for page in pages)
+
+    def teardown(component: Component, pages: List[List[Dict]], data_dir: str) -> None:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    return Benchmark(f"fetch_and_write_{kind}", setup, run, teardown)
+
+
+def get_benchmarks(rows: int, output_format: str, page_cache_path: str = None) -> List[Benchmark]:
+    benchmarks = [
+        flatten_benchmark("event", rows),
+        flatten_benchmark("profile", rows),
+        normalize_metric_aggregates_benchmark(rows),
+        fetch_and_write_benchmark("event", rows, output_format),
+        fetch_and_write_benchmark("profile", rows, output_format),
+    ]
+    if page_cache_path:
+        benchmarks.append(page_cache_benchmark(page_cache_path))
+    return benchmarks
+
+
+def main(argv: List[str] = None) -> List[BenchmarkResult]:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=20000, help="number of rows processed by each benchmark")
+    parser.add_argument("--repeat", type=int, default=3, help="number of timed runs of each benchmark")
+    parser.add_argument("--output-format", default="csv", choices=["csv", "csv_gzip", "parquet"],
+                        help="output format of the fetch and write benchmarks")
+    parser.add_argument("--page-cache", help="path of a page cache recorded by the component to benchmark")
+    parser.add_argument("--only", nargs="*", help="names of the benchmarks to run, all by default")
+    parser.add_argument("--output", help="path of a JSON file the results are written to")
+    args = parser.parse_args(argv)
+    # the progress logs of the component would be measured together with the code
+    logging.disable(logging.INFO)
+
+    results = []
+    print(f"{'benchmark':<30}{'rows':>10}{'seconds':>10}{'rows/s':>12}{'peak MB':>10}{'blocks':>10}")
+    for benchmark in get_benchmarks(args.rows, args.output_format, args.page_cache):
+        if args.only and benchmark.name not in args.only:
+            continue
+        result = measure(benchmark, args.repeat)
+        results.append(result)
+        print(f"{result.name:<30}{result.rows:>10}{result.seconds:>10.3f}{result.rows_per_second:>12}"
+              f"{result.peak_memory_mb:>10.2f}{result.retained_blocks:>10}")
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump({"python": sys.version, "rows": args.rows, "results": [asdict(r) for r in results]},
+                      output_file, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main()
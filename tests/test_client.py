@@ -0,0 +1,303 @@
+import io
+import re
+import unittest
+from datetime import date, datetime
+from unittest import mock
+
+from openapi_client.exceptions import ApiException
+from urllib3 import HTTPResponse
+
+from client import KlaviyoClient, KlaviyoClientException, SyncActionClient
+from client.rate_limiter import RATE_LIMIT_TIERS, RequestScheduler
+from client.sync_action_client import API_REVISION
+from client.transport import HttpTransport
+from client.time_slicing import TimeWindow, TimeWindowPlanner
+
+
+class TestKlaviyoClient(unittest.TestCase):
+
+    def setUp(self):
+        self.client = KlaviyoClient(api_token="test-token")
+
+    def test_read_ahead_keeps_page_order(self):
+        pages = ([i] for i in range(10))
+        self.assertEqual(list(self.client._read_ahead(pages, 2)), [[i] for i in range(10)])
+
+    def test_read_ahead_reraises_fetch_error(self):
+        def failing_pages():
+            yield [1]
+            raise KlaviyoClientException("fetch failed")
+
+        fetched = []
+        with self.assertRaises(KlaviyoClientException):
+            for page in self.client._read_ahead(failing_pages(), 2):
+                fetched.append(page)
+        self.assertEqual(fetched, [[1]])
+
+    def test_query_metric_aggregates_reads_single_resource_response(self):
+        response = {"data": {"type": "metric-aggregate", "id": "aggregate",
+                             "attributes": {"dates": ["2024-01-01T00:00:00+00:00", "2024-01-02T00:00:00+00:00"],
+                                            "data": [{"dimensions": [],
+                                                      "measurements": {"count": [1, 2], "unique": [1, 1],
+                                                                       "sum_value": [1.0, 2.0]}}]}},
+                    "links": {"self": "https://a.klaviyo.com/api/metric-aggregates", "next": None}}
+        with mock.patch.object(self.client.client.Metrics, "query_metric_aggregates", return_value=response):
+            pages = list(self.client.query_metric_aggregates("metric", "day", 1704067200, 1704240000, []))
+
+        records = [record for page in pages for record in page]
+        self.assertEqual([record["attributes"]["count"] for record in records], [1, 2])
+        self.assertEqual([record["id"] for record in records],
+                         ["2024-01-01T00:00:00+00:00_metric", "2024-01-02T00:00:00+00:00_metric"])
+
+    @staticmethod
+    def _paged_events(events, page_size):
+        """
+        Serves the events matching the timestamp filter of the request sorted by timestamp, the page cursor is
+        the offset of the page.
+        """
+        def get_events(endpoint_func, filter, sort, page_cursor=None, **kwargs):
+            start, end_operator, end = re.fullmatch(
+                r"greater-or-equal\(timestamp,(\d+)\),(less-than|less-or-equal)\(timestamp,(\d+)\)", filter).groups()
+            matching = [event for event in events if int(start) <= event["attributes"]["timestamp"] < int(end)
+                        or end_operator == "less-or-equal" and event["attributes"]["timestamp"] == int(end)]
+            offset = int(page_cursor or 0)
+            following = str(offset + page_size) if offset + page_size < len(matching) else None
+            return {"data": matching[offset:offset + page_size], "links": {"next": following}}
+        return get_events
+
+    @mock.patch("client.client.MAX_PAGES_PER_EVENT_WINDOW", 2)
+    def test_time_sliced_events_are_fetched_once(self):
+        start, end = 1_700_000_000, 1_700_100_000
+        # sparse events, a busy hour and two dense seconds with more events than a window fetches before it splits
+        timestamps = [*range(start, end + 1, 997), *range(start + 30_000, start + 33_600, 37),
+                      *[start + 31_000] * 17, *[end - 500] * 9, end]
+        events = [{"type": "event", "id": f"e{i}", "attributes": {"timestamp": timestamp}}
+                  for i, timestamp in sorted(enumerate(timestamps), key=lambda item: (item[1], item[0]))]
+
+        with mock.patch.object(self.client, "_call", side_effect=self._paged_events(events, page_size=4)) as call:
+            pages = list(self.client.get_events_time_sliced(start, end, workers=4))
+
+        fetched_ids = [event["id"] for page in pages for event in page]
+        self.assertEqual(len(fetched_ids), len(set(fetched_ids)))
+        self.assertEqual(set(fetched_ids), {event["id"] for event in events})
+        # the windows split at the dense second continue from its timestamp
+        filters = [request.kwargs["filter"] for request in call.call_args_list]
+        self.assertTrue(any(request_filter.startswith(f"greater-or-equal(timestamp,{start + 31_000})")
+                            for request_filter in filters))
+        # a run resumed from the checkpoint of any page misses none of the events not yielded before it
+        yielded_ids = set()
+        for page in pages:
+            yielded_ids.update(event["id"] for event in page)
+            checkpoint = page.checkpoint["from_timestamp_value"]
+            self.assertTrue(all(event["id"] in yielded_ids for event in events
+                                if event["attributes"]["timestamp"] < checkpoint))
+
+    def test_get_page_size_is_limited_to_endpoint_maximum(self):
+        self.assertEqual(self.client._get_page_size("Profiles.get_profiles"), 100)
+        self.assertEqual(self.client._get_page_size("Profiles.get_profiles", 20), 20)
+        self.assertEqual(self.client._get_page_size("Flows.get_flows", 100), 50)
+
+    def test_get_profiles_filters_updated_since(self):
+        with mock.patch.object(self.client, "_call", return_value={"data": [], "links": {}}) as call:
+            list(self.client.get_profiles(updated_since=1700000000))
+        self.assertEqual(call.call_args.kwargs["filter"], "greater-than(updated,2023-11-14T22:13:20Z)")
+
+    def test_metric_aggregate_date_ranges_are_limited_by_interval(self):
+        from_timestamp = int(datetime(2024, 1, 1, 12).timestamp())
+        to_timestamp = int(datetime(2024, 3, 1, 12).timestamp())
+        self.assertEqual(self.client._metric_aggregate_date_ranges("hour", from_timestamp, to_timestamp), [
+            (date(2024, 1, 1), date(2024, 2, 1)), (date(2024, 2, 1), date(2024, 3, 1))])
+        self.assertEqual(self.client._metric_aggregate_date_ranges("day", from_timestamp, to_timestamp), [
+            (date(2024, 1, 1), date(2024, 3, 1))])
+
+    def test_metric_aggregate_date_ranges_are_split_at_start_of_month(self):
+        from_timestamp = int(datetime(2023, 1, 15, 12).timestamp())
+        to_timestamp = int(datetime(2025, 3, 10, 12).timestamp())
+        self.assertEqual(self.client._metric_aggregate_date_ranges("month", from_timestamp, to_timestamp), [
+            (date(2023, 1, 15), date(2024, 1, 1)), (date(2024, 1, 1), date(2024, 12, 1)),
+            (date(2024, 12, 1), date(2025, 3, 10))])
+
+    def test_metric_aggregate_date_ranges_are_split_at_start_of_week(self):
+        # 2024-01-03 is a Wednesday, the first range ends on the Monday before the 364 days limit
+        from_timestamp = int(datetime(2024, 1, 3, 12).timestamp())
+        to_timestamp = int(datetime(2025, 3, 1, 12).timestamp())
+        self.assertEqual(self.client._metric_aggregate_date_ranges("week", from_timestamp, to_timestamp), [
+            (date(2024, 1, 3), date(2024, 12, 30)), (date(2024, 12, 30), date(2025, 3, 1))])
+
+    def test_query_metric_aggregates_concurrently_normalizes_all_queries(self):
+        response = {"attributes": {"dates": ["2024-01-01", "2024-01-02"], "data": [
+            {"dimensions": ["", "email"], "measurements": {"count": [1, 2], "unique": [1, 1], "sum_value": [5, 6]}}]}}
+        with mock.patch.object(self.client, "_query_metric_aggregate_range", return_value=iter([response])):
+            pages = list(self.client.query_metric_aggregates_concurrently(["m1"], "day", 1704067200, 1704240000,
+                                                                          ["$message"], workers=2))
+        records = [record for page in pages for record in page]
+        self.assertEqual([record["id"] for record in records], ["2024-01-01_m1_email", "2024-01-02_m1_email"])
+        self.assertEqual(records[1]["attributes"]["dimensions"], ["DIMENSION NOT AVAILABLE", "email"])
+        self.assertEqual(records[1]["attributes"]["sum_value"], 6)
+
+    def test_transport_sizes_pool_and_requests_compressed_responses(self):
+        client = KlaviyoClient(api_token="token", transport=HttpTransport(pool_size=12))
+        self.assertEqual(client.client.api_client.rest_client.pool_manager.connection_pool_kw["maxsize"], 12)
+        self.assertIn("gzip", client.client.api_client.default_headers["accept-encoding"])
+
+    def test_raw_responses_are_decoded_without_sdk(self):
+        client = KlaviyoClient(api_token="token", raw_responses=True)
+        body = b'{"data": [{"type": "metric", "id": "m1", "attributes": {"name": null}}], "links": {"next": null}}'
+        raw_endpoint = mock.Mock(return_value=HTTPResponse(body=io.BytesIO(body), status=200, preload_content=False))
+        client._raw_endpoints[client.client.Metrics.get_metrics] = raw_endpoint
+
+        pages = list(client.get_metrics(fields=["name"]))
+
+        self.assertEqual(pages, [[{"type": "metric", "id": "m1", "attributes": {"name": None}}]])
+        raw_endpoint.assert_called_once_with(fields_metric=["name"])
+
+    def test_raw_response_error_raises_api_exception(self):
+        response = HTTPResponse(body=io.BytesIO(b'{"errors": []}'), status=429, headers={"Retry-After": "3"},
+                                preload_content=False)
+        with self.assertRaises(ApiException) as context:
+            KlaviyoClient._call_raw(mock.Mock(return_value=response))
+        self.assertEqual(context.exception.status, 429)
+        self.assertEqual(context.exception.headers["Retry-After"], "3")
+
+
+class TestRequestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = RequestScheduler()
+
+    @staticmethod
+    def _api_exception(status: int, headers: dict = None) -> ApiException:
+        exception = ApiException(status=status, reason="error")
+        exception.headers = headers or {}
+        return exception
+
+    @mock.patch("client.rate_limiter.time.sleep")
+    def test_client_error_is_not_retried(self, sleep):
+        endpoint = mock.Mock(side_effect=self._api_exception(404))
+        with self.assertRaises(ApiException):
+            self.scheduler.call("Lists.get_list", endpoint, id="missing")
+        self.assertEqual(endpoint.call_count, 1)
+
+    @mock.patch("client.rate_limiter.time.sleep")
+    def test_throttled_request_waits_for_retry_after(self, sleep):
+        endpoint = mock.Mock(side_effect=[self._api_exception(429, {"Retry-After": "7"}), {"data": []}])
+        self.assertEqual(self.scheduler.call("Events.get_events", endpoint), {"data": []})
+        self.assertEqual(endpoint.call_count, 2)
+        self.assertIn(mock.call(7), sleep.call_args_list)
+        stats = self.scheduler.telemetry.endpoints["Events.get_events"]
+        self.assertEqual((stats.retries, stats.throttled, stats.backoff_seconds), (1, 1, 7))
+
+    @mock.patch("client.rate_limiter.time.sleep")
+    def test_endpoints_of_same_tier_are_throttled_independently(self, sleep):
+        burst, _ = RATE_LIMIT_TIERS["M"]
+        for _ in range(burst + 1):
+            self.scheduler.call("Metrics.get_metrics", mock.Mock())
+        self.scheduler.call("Flows.get_flows", mock.Mock(side_effect=[self._api_exception(429), {"data": []}]))
+        self.scheduler.call("Templates.get_templates", mock.Mock())
+
+        endpoints = self.scheduler.telemetry.endpoints
+        self.assertGreater(endpoints["Metrics.get_metrics"].rate_limit_wait_seconds, 0)
+        self.assertGreater(endpoints["Flows.get_flows"].throttled, 0)
+        self.assertNotIn("Templates.get_templates", endpoints)
+
+    @mock.patch("client.rate_limiter.time.sleep")
+    def test_server_error_is_retried_until_max_attempts(self, sleep):
+        endpoint = mock.Mock(side_effect=self._api_exception(503))
+        with self.assertRaises(ApiException):
+            self.scheduler.call("Profiles.get_profiles", endpoint)
+        self.assertEqual(endpoint.call_count, self.scheduler.max_attempts)
+
+
+class TestTimeWindowPlanner(unittest.TestCase):
+
+    def test_windows_cover_whole_range(self):
+        planner = TimeWindowPlanner(start=0, end=100_000, workers=4, max_pages_per_window=40)
+        windows = []
+        while window := planner.next_window():
+            windows.append(window)
+
+        self.assertEqual(windows[0].start, 0)
+        self.assertEqual(windows[-1].end, 100_000)
+        self.assertTrue(windows[-1].include_end)
+        for previous, following in zip(windows, windows[1:]):
+            self.assertEqual(previous.end, following.start)
+            self.assertFalse(previous.include_end)
+
+    def test_split_remainder_keeps_skipped_ids_in_first_half(self):
+        planner = TimeWindowPlanner(start=0, end=0, workers=1, max_pages_per_window=40)
+        planner.next_window()
+        planner.split(TimeWindow(1_000, 11_000, include_end=True, skip_ids=frozenset({"a"})))
+
+        self.assertEqual(planner.next_window(), TimeWindow(1_000, 6_000, skip_ids=frozenset({"a"})))
+        self.assertEqual(planner.next_window(), TimeWindow(6_000, 11_000, include_end=True))
+        self.assertIsNone(planner.next_window())
+
+    def test_earliest_unfinished_start_includes_queued_split_windows(self):
+        planner = TimeWindowPlanner(start=0, end=40_000, workers=2, max_pages_per_window=40)
+        earlier, later = planner.next_window(), planner.next_window()
+        self.assertEqual((earlier.start, later.start), (0, 10_000))
+
+        # the later window splits first and its first half takes the free worker
+        planner.split(TimeWindow(15_000, later.end))
+        planner.mark_finished(later)
+        later_half = planner.next_window()
+        self.assertEqual(later_half.start, 15_000)
+        # the halves of the earlier window wait in the queue while the later half runs
+        planner.split(TimeWindow(5_000, earlier.end))
+        planner.mark_finished(earlier)
+
+        self.assertEqual(planner.earliest_unfinished_start(), 5_000)
+
+    def test_earliest_unfinished_start_is_none_when_range_is_finished(self):
+        planner = TimeWindowPlanner(start=0, end=50, workers=1, max_pages_per_window=40)
+        window = planner.next_window()
+        self.assertEqual(planner.earliest_unfinished_start(), 0)
+        planner.mark_finished(window)
+        self.assertIsNone(planner.earliest_unfinished_start())
+
+
+class TestSyncActionClient(unittest.TestCase):
+
+    def setUp(self):
+        self.client = SyncActionClient(api_token="test-token")
+
+    @staticmethod
+    def _response(status: int, body: bytes, reason: str = "OK") -> HTTPResponse:
+        return HTTPResponse(body=io.BytesIO(body), status=status, reason=reason, preload_content=True)
+
+    def test_revision_matches_sdk(self):
+        from klaviyo_api import KlaviyoAPI
+        self.assertEqual(API_REVISION, KlaviyoAPI._REVISION)
+
+    def test_get_list_ids_follows_next_links(self):
+        responses = [
+            self._response(200, b'{"data": [{"id": "l1", "attributes": {"name": "A"}}], '
+                                b'"links": {"next": "https://a.klaviyo.com/api/lists?page%5Bcursor%5D=2"}}'),
+            self._response(200, b'{"data": [{"id": "l2", "attributes": {"name": "B"}}], "links": {"next": null}}'),
+        ]
+        with mock.patch.object(self.client._pool_manager, "request", side_effect=responses) as request:
+            list_ids = self.client.get_list_ids()
+
+        self.assertEqual(list_ids, [{"id": "l1", "name": "A"}, {"id": "l2", "name": "B"}])
+        self.assertEqual(request.call_args_list[0].kwargs["fields"], {"fields[list]": "name"})
+        self.assertEqual(request.call_args_list[1].args[1], "https://a.klaviyo.com/api/lists?page%5Bcursor%5D=2")
+        self.assertIsNone(request.call_args_list[1].kwargs["fields"])
+
+    def test_test_credentials_reports_missing_scopes(self):
+        forbidden = b'{"errors": [{"status": 403, "detail": "You do not have permission."}]}'
+
+        def respond(method, url, fields=None, headers=None):
+            if url.endswith("/api/profiles"):
+                return self._response(403, forbidden, "Forbidden")
+            return self._response(200, b'{"data": [], "links": {"next": null}}')
+
+        with mock.patch.object(self.client._pool_manager, "request", side_effect=respond):
+            valid_token, missing_scopes, last_exception = self.client.test_credentials()
+
+        self.assertTrue(valid_token)
+        self.assertEqual(missing_scopes, {"profiles": "Forbidden: You do not have permission."})
+        self.assertIsNone(last_exception)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,11 +3,22 @@ Created on 12. 11. 2018
 
 @author: esner
 '''
+import csv
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
+from datetime import datetime
+
 import mock
-import os
 from freezegun import freeze_time
+from keboola.component.exceptions import UserException
 
+from client import KlaviyoClientException, Page
 from component import Component
 
 
@@ -23,6 +34,463 @@ class TestComponent(unittest.TestCase):
             comp.run()
 
 
+class ComponentTestCase(unittest.TestCase):
+    """Runs the component in a temporary data folder which is removed after each test."""
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        for directory in ("in/files", "out/tables", "out/files"):
+            os.makedirs(os.path.join(self.data_dir, directory))
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+
+    def _write_config(self, parameters):
+        with open(os.path.join(self.data_dir, "config.json"), "w") as config_file:
+            json.dump({"parameters": parameters}, config_file)
+
+    def _component(self, parameters):
+        self._write_config(parameters)
+        with mock.patch.dict(os.environ, {"KBC_DATADIR": self.data_dir}):
+            component = Component()
+        component.client = mock.Mock()
+        return component
+
+    def _run(self, parameters, responses):
+        """Runs the component with the API responses returned by the request scheduler."""
+        self._write_config(parameters)
+        with mock.patch.dict(os.environ, {"KBC_DATADIR": self.data_dir}), \
+                mock.patch("client.client.RequestScheduler.call", side_effect=responses) as call:
+            component = Component()
+            component.run()
+        return component, call
+
+    def _read_output_table(self, table_name):
+        with open(os.path.join(self.data_dir, "out", "tables", f"{table_name}.csv", "part_0000.csv"),
+                  newline="") as table_file:
+            return list(csv.reader(table_file))
+
+
+class TestConcurrentEndpoints(ComponentTestCase):
+
+    def _endpoints_component(self, objects, max_workers):
+        return self._component({"#api_token": "token", "objects": {object_name: True for object_name in objects},
+                                "performance_settings": {"max_workers": max_workers}})
+
+    def test_concurrent_endpoints_keep_page_order_and_merge_columns_sorted(self):
+        component = self._endpoints_component(["flows", "templates", "metrics"], max_workers=3)
+        all_started = threading.Barrier(3, timeout=10)
+
+        def pages(prefix):
+            def get_pages(**kwargs):
+                # every endpoint writes its pages only once all endpoints run
+                all_started.wait()
+                for page in range(3):
+                    yield [{"id": f"{prefix}{page}-{row}", "attributes": {f"{prefix}_page_{page}": row}}
+                           for row in range(2)]
+            return get_pages
+
+        component.client.get_flows.side_effect = pages("f")
+        component.client.get_templates.side_effect = pages("t")
+        component.client.get_metrics.side_effect = pages("m")
+        component._fetch_objects()
+        component._close_all_result_writers()
+
+        for object_name, prefix in (("flow", "f"), ("template", "t"), ("metric", "m")):
+            writer = component._get_result_writer(object_name)
+            rows = []
+            for slice_path in writer.slice_paths:
+                with open(slice_path, newline="") as slice_file:
+                    rows.extend(row[0] for row in csv.reader(slice_file))
+            self.assertEqual(rows, [f"{prefix}{page}-{row}" for page in range(3) for row in range(2)])
+            self.assertEqual(component.new_state[object_name][-3:], [f"{prefix}_page_{page}" for page in range(3)])
+        self.assertEqual(list(component.new_state), ["flow", "metric", "template"])
+
+    def test_failed_endpoint_cancels_endpoints_not_started(self):
+        component = self._endpoints_component(["flows", "templates", "metrics", "lists"], max_workers=2)
+
+        def blocked_pages(**kwargs):
+            # keeps the worker busy until the failure cancels the endpoints left in the queue
+            threading.Event().wait(1)
+            return iter([])
+
+        component.client.get_flows.side_effect = KlaviyoClientException("flows failed")
+        component.client.get_templates.side_effect = blocked_pages
+        component.client.get_metrics.side_effect = blocked_pages
+
+        with self.assertRaisesRegex(KlaviyoClientException, "flows failed"):
+            component._fetch_objects()
+        component.client.get_lists.assert_not_called()
+
+
+class TestCheckpoints(ComponentTestCase):
+
+    def _component(self, parameters, checkpoints=None):
+        component = super()._component({"#api_token": "token",
+                                        "performance_settings": {"resume_from_checkpoint": True}, **parameters})
+        component.resume_mode = True
+        component.state = {"checkpoints": checkpoints or {}}
+        component.new_state = {**json.loads(json.dumps(component.state)), "last_run": 1_700_000_000}
+        return component
+
+    @staticmethod
+    def _profiles(*profile_ids):
+        return iter([Page([{"id": profile_id, "attributes": {"email": f"{profile_id}@example.com"}}
+                           for profile_id in profile_ids])])
+
+    def test_profiles_resume_from_saved_cursor(self):
+        component = self._component({"objects": {"profiles": True},
+                                     "profiles_settings": {"fetch_profiles_mode": "fetch_all"}},
+                                    {"profile": {"resume_from": {"page_cursor": "cursor-2"}}})
+        component.client.get_profiles.return_value = self._profiles("p3")
+
+        component.get_profiles()
+
+        self.assertEqual(component.client.get_profiles.call_args.kwargs["page_cursor"], "cursor-2")
+        self.assertEqual(component.new_state["checkpoints"]["profile"],
+                         {"resume_from": {"page_cursor": "cursor-2"}, "completed": True})
+
+    def test_events_resume_from_checkpoint_timestamp(self):
+        date_from, checkpoint, date_to = (int(datetime(2024, 1, day).timestamp()) for day in (1, 15, 31))
+        component = self._component({"objects": {"events": True},
+                                     "time_range_settings": {"date_from": str(date_from), "date_to": str(date_to)}},
+                                    {"event": {"resume_from": {"from_timestamp_value": checkpoint}}})
+        component.client.get_events.return_value = iter([])
+
+        component.get_events()
+
+        self.assertEqual(component.client.get_events.call_args.kwargs["from_timestamp_value"], checkpoint)
+        self.assertEqual(component.client.get_events.call_args.kwargs["to_timestamp_value"], date_to)
+
+    def test_completed_segments_are_skipped(self):
+        component = self._component({"objects": {"profiles": True}, "profiles_settings": {
+            "fetch_profiles_mode": "fetch_by_segment", "fetch_profiles_by_segment": ["s1", "s2"]}},
+            {"segment_profile:s1": {"completed": True}})
+        component.client.get_segment_profiles.return_value = self._profiles("p1")
+
+        component.get_profiles()
+
+        component.client.get_segment_profiles.assert_called_once()
+        self.assertEqual(component.client.get_segment_profiles.call_args.kwargs["segment_id"], "s2")
+
+    def test_stale_cursor_is_fetched_from_the_beginning(self):
+        component = self._component({"objects": {"profiles": True},
+                                     "profiles_settings": {"fetch_profiles_mode": "fetch_all"}},
+                                    {"profile": {"resume_from": {"page_cursor": "expired"}}})
+
+        def get_profiles(page_cursor=None, **kwargs):
+            if page_cursor:
+                raise KlaviyoClientException("Invalid cursor", status=400)
+            return self._profiles("p1", "p2")
+
+        component.client.get_profiles.side_effect = get_profiles
+        component.get_profiles()
+
+        self.assertEqual(component.client.get_profiles.call_count, 2)
+        self.assertNotIn("page_cursor", component.client.get_profiles.call_args.kwargs)
+        self.assertTrue(component.new_state["checkpoints"]["profile"]["completed"])
+
+    def test_failed_checkpointed_endpoint_is_left_incomplete(self):
+        component = self._component({"objects": {"profiles": True},
+                                     "profiles_settings": {"fetch_profiles_mode": "fetch_all"}})
+        component.client.get_profiles.side_effect = KlaviyoClientException("Service unavailable", status=503)
+
+        component._fetch_endpoint("profiles")
+
+        self.assertEqual(component._incomplete_endpoints, ["profiles"])
+
+    def test_permanent_error_is_raised(self):
+        component = self._component({"objects": {"profiles": True},
+                                     "profiles_settings": {"fetch_profiles_mode": "fetch_all"}})
+        component.client.get_profiles.side_effect = KlaviyoClientException("Forbidden", status=403)
+
+        with self.assertRaisesRegex(KlaviyoClientException, "Forbidden"):
+            component._fetch_endpoint("profiles")
+
+    def test_failure_of_endpoint_without_checkpoints_is_raised(self):
+        component = self._component({"objects": {"metrics": True}})
+        component.client.get_metrics.side_effect = KlaviyoClientException("Service unavailable", status=503)
+
+        with self.assertRaisesRegex(KlaviyoClientException, "Service unavailable"):
+            component._fetch_endpoint("metrics")
+
+    def _run_with_state(self, parameters, responses):
+        with open(os.path.join(self.data_dir, "in", "state.json"), "w") as state_file:
+            json.dump({"last_run": 1_600_000_000}, state_file)
+        self._run({"#api_token": "token", "performance_settings": {"resume_from_checkpoint": True}, **parameters},
+                  responses)
+
+    def test_run_with_failed_checkpointed_endpoint_writes_incomplete_state(self):
+        profiles = {"data": [{"type": "profile", "id": "p1", "attributes": {"email": "p1@example.com"}}],
+                    "links": {"next": "cursor-2"}}
+        self._run_with_state({"objects": {"profiles": True}, "profiles_settings": {"fetch_profiles_mode": "fetch_all"}},
+                             [profiles, KlaviyoClientException("Service unavailable", status=503)])
+
+        with open(os.path.join(self.data_dir, "out", "state.json")) as state_file:
+            state = json.load(state_file)
+        self.assertEqual(state["checkpoints"], {"profile": {"resume_from": {"page_cursor": "cursor-2"}}})
+        self.assertEqual(state["last_run"], 1_600_000_000)
+        self.assertEqual(self._read_output_table("profile")[0][0], "p1")
+
+    def test_run_with_failed_endpoint_without_checkpoints_fails(self):
+        with self.assertRaisesRegex(KlaviyoClientException, "Service unavailable"):
+            self._run_with_state({"objects": {"metrics": True}},
+                                 [KlaviyoClientException("Service unavailable", status=503)])
+        self.assertFalse(os.path.exists(os.path.join(self.data_dir, "out", "state.json")))
+
+    def test_run_with_permanent_error_of_checkpointed_endpoint_fails(self):
+        with self.assertRaisesRegex(KlaviyoClientException, "Forbidden"):
+            self._run_with_state({"objects": {"profiles": True},
+                                  "profiles_settings": {"fetch_profiles_mode": "fetch_all"}},
+                                 [KlaviyoClientException("Forbidden", status=403)])
+        self.assertFalse(os.path.exists(os.path.join(self.data_dir, "out", "state.json")))
+
+
+class TestDeduplicatedProfiles(ComponentTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.component = self._component({"#api_token": "token", "objects": {"profiles": True}, "profiles_settings": {
+            "fetch_profiles_mode": "fetch_by_segment", "fetch_profiles_by_segment": ["s1", "s2"],
+            "deduplicate_profiles": True}})
+        segment_members = {"s1": ["p1", "p2"], "s2": ["p2", "p3"]}
+        self.component.client.get_segment_profile_ids.side_effect = lambda segment_id: iter(
+            [[{"type": "profile", "id": profile_id} for profile_id in segment_members[segment_id]]])
+        self.component.client.get_profiles_by_ids.side_effect = lambda profile_ids, fields: iter(
+            [[{"id": profile_id, "attributes": {"email": f"{profile_id}@example.com"}} for profile_id in profile_ids]])
+
+    def _read_table(self, object_name):
+        writer = self.component._get_result_writer(object_name)
+        rows = []
+        for slice_path in writer.slice_paths:
+            with open(slice_path, newline="") as slice_file:
+                rows.extend(dict(zip(writer.fieldnames, row)) for row in csv.reader(slice_file))
+        return rows
+
+    def test_profiles_in_multiple_segments_are_fetched_once(self):
+        self.component.get_profiles()
+        self.component._close_all_result_writers()
+
+        self.assertEqual(self._read_table("segment_membership"), [
+            {"profile_id": "p1", "segment_id": "s1"}, {"profile_id": "p2", "segment_id": "s1"},
+            {"profile_id": "p2", "segment_id": "s2"}, {"profile_id": "p3", "segment_id": "s2"}])
+        self.assertEqual(sorted(row["id"] for row in self._read_table("profile")), ["p1", "p2", "p3"])
+        self.component.client.get_segment_profiles.assert_not_called()
+
+    def test_profiles_fetched_by_ids_are_counted_in_telemetry(self):
+        self.component.get_profiles()
+
+        objects = self.component.telemetry.objects
+        self.assertEqual((objects["segment_membership"].pages, objects["segment_membership"].rows), (2, 4))
+        self.assertEqual((objects["profile"].pages, objects["profile"].rows), (1, 3))
+
+
+class TestIncrementalProfiles(ComponentTestCase):
+
+    def _component(self, state):
+        component = super()._component({"#api_token": "token", "objects": {"profiles": True}, "profiles_settings": {
+            "fetch_profiles_mode": "fetch_all", "incremental_profiles": True}})
+        component.client.get_profiles.return_value = iter([])
+        component.state = state
+        component.new_state = {**state, "last_run": 1_700_100_000}
+        return component
+
+    def test_first_profile_run_fetches_all_profiles_after_other_objects_ran(self):
+        component = self._component({"last_run": 1_700_000_000, "metric": ["id", "name"]})
+
+        component.get_profiles()
+
+        self.assertIsNone(component.client.get_profiles.call_args.kwargs["updated_since"])
+        self.assertEqual(component.new_state["profiles_last_run"], 1_700_100_000)
+
+    def test_profiles_updated_since_last_profile_run_are_fetched(self):
+        component = self._component({"last_run": 1_700_050_000, "profiles_last_run": 1_700_000_000})
+
+        component.get_profiles()
+
+        self.assertEqual(component.client.get_profiles.call_args.kwargs["updated_since"], 1_700_000_000 - 3600)
+
+    def test_profiles_completed_by_previous_run_keep_its_profile_run(self):
+        component = self._component({"last_run": 500_000, "profiles_last_run": 1_000_000,
+                                     "checkpoints": {"profile": {"completed": True}}})
+        component.resume_mode = True
+
+        component.get_profiles()
+
+        component.client.get_profiles.assert_not_called()
+        self.assertEqual(component.new_state["profiles_last_run"], 1_000_000)
+
+
+class TestValidateUserParameters(ComponentTestCase):
+
+    def _component(self, parameters):
+        return super()._component({"#api_token": "token", **parameters})
+
+    def test_segments_are_validated_in_one_request(self):
+        component = self._component({"objects": {"profiles": True}, "profiles_settings": {
+            "fetch_profiles_mode": "fetch_by_segment", "fetch_profiles_by_segment": ["s1", "s2", "s3"]}})
+        component.client.get_segments_by_ids.return_value = iter([[{"id": "s1"}, {"id": "s3"}]])
+
+        with self.assertRaisesRegex(UserException, "Segment with ID s2 not found."):
+            component._validate_user_parameters()
+        component.client.get_segments_by_ids.assert_called_once_with(["s1", "s2", "s3"])
+        component.client.get_segment.assert_not_called()
+
+    def test_missing_metric_keeps_error_message(self):
+        component = self._component({"objects": {"metric_aggregates": True},
+                                     "metric_aggregates_settings": {"metric_aggregates_ids": ["m1", "m2"]}})
+        component.client.get_metric.side_effect = lambda metric_id: (
+            {"id": metric_id} if metric_id == "m1" else self._raise(KlaviyoClientException("Not Found")))
+
+        with self.assertRaisesRegex(UserException, "Metric with ID m2 not found."):
+            component._validate_user_parameters()
+
+    @staticmethod
+    def _raise(exception):
+        raise exception
+
+
+class TestPageCache(ComponentTestCase):
+
+    def _run_metrics(self, page_cache_mode, responses):
+        _, call = self._run({"#api_token": "token", "objects": {"metrics": True}, "page_cache_mode": page_cache_mode},
+                            responses)
+        return call, self._read_output_table("metric")
+
+    def test_replay_serves_recorded_responses(self):
+        metric = {"type": "metric", "id": "m1", "attributes": {"name": "Placed Order"}}
+        _, recorded_table = self._run_metrics("record", [{"data": [metric], "links": {"next": None}}])
+
+        os.rename(os.path.join(self.data_dir, "out", "files", "klaviyo_page_cache.ndjson.gz"),
+                  os.path.join(self.data_dir, "in", "files", "1_klaviyo_page_cache.ndjson.gz"))
+        call, replayed_table = self._run_metrics("replay", AssertionError("the API must not be called"))
+
+        call.assert_not_called()
+        self.assertEqual(replayed_table, recorded_table)
+        self.assertEqual(replayed_table[0][0], "m1")
+
+    def test_page_cache_can_not_be_used_with_concurrent_event_windows(self):
+        with self.assertRaisesRegex(UserException, "event window workers"):
+            self._run({"#api_token": "token", "objects": {"events": True}, "page_cache_mode": "record",
+                       "performance_settings": {"event_window_workers": 4}}, [])
+
+
+class TestAccounts(ComponentTestCase):
+
+    accounts = [{"account_id": "brand-a", "#api_token": "token-a"}, {"account_id": "brand-b", "#api_token": "token-b"}]
+
+    @staticmethod
+    def _metrics(*args, **kwargs):
+        return {"data": [{"type": "metric", "id": "m1", "attributes": {"name": "Placed Order"}}],
+                "links": {"next": None}}
+
+    def test_accounts_write_into_shared_tables(self):
+        component, _ = self._run({"accounts": self.accounts, "objects": {"metrics": True}}, self._metrics)
+
+        rows = sorted(row[:3] for row in self._read_output_table("metric"))
+        self.assertEqual(rows, [["brand-a", "m1", "Placed Order"], ["brand-b", "m1", "Placed Order"]])
+        self.assertEqual(component.new_state["metric"][:3], ["account_id", "id", "name"])
+        self.assertEqual(len({client.scheduler for client in component._account_clients}), 2)
+
+    def test_accounts_share_compression_executor(self):
+        compression_threads = {thread for thread in threading.enumerate() if thread.name.startswith("compression")}
+        self._run({"accounts": self.accounts, "objects": {"metrics": True}, "output_format": "csv_gzip"},
+                  self._metrics)
+
+        # the executor is shut down with the result writers, its threads do not outlive the run
+        self.assertEqual({thread for thread in threading.enumerate() if thread.name.startswith("compression")},
+                         compression_threads)
+
+    def test_accounts_can_not_use_page_cache(self):
+        with self.assertRaises(UserException):
+            self._run({"accounts": self.accounts[:1], "objects": {"metrics": True}, "page_cache_mode": "record"}, [])
+
+
+class TestStoreNestedAttributes(ComponentTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.component = self._component({"#api_token": "token", "objects": {"campaigns": True, "metrics": True},
+                                          "campaigns_settings": ["email"], "store_nested_attributes": True})
+        self.component.store_nested_attributes = True
+
+    def test_campaign_tables_are_flattened(self):
+        campaign = {"id": "c1", "attributes": {"name": "Sale", "audiences": {"included": ["l1"], "excluded": []},
+                                               "send_options": {"use_smart_sending": True}},
+                    "relationships": {"campaign-messages": {"data": [{"id": "cm1"}]}}}
+        message = {"type": "campaign-message", "id": "cm1",
+                   "attributes": {"label": "Sale", "content": {"subject": "Hello"}}}
+        self.component.client.get_campaigns.return_value = iter([Page([campaign], [message])])
+
+        self.component.get_campaigns()
+
+        self.assertIn("send_options_use_smart_sending",
+                      self.component._get_result_writer("campaign").fieldnames)
+        self.assertIn("content_subject", self.component._get_result_writer("campaign_message").fieldnames)
+
+    def test_object_attributes_are_stored_as_json(self):
+        self.component.client.get_metrics.return_value = iter([Page([
+            {"id": "m1", "attributes": {"name": "Placed Order", "integration": {"name": "Shopify"}}}])])
+
+        self.component.get_metrics()
+        writer = self.component._get_result_writer("metric")
+        writer.close()
+
+        with open(writer.slice_paths[0], newline="") as slice_file:
+            row = dict(zip(writer.fieldnames, next(csv.reader(slice_file))))
+        self.assertEqual(row["integration"], '{"name":"Shopify"}')
+        self.assertEqual(row["integration_name"], "")
+
+
+class TestSideloadedEvents(ComponentTestCase):
+
+    def test_included_metrics_and_profiles_are_written_once(self):
+        def event(event_id, profile_id):
+            return {"type": "event", "id": event_id, "attributes": {"timestamp": 1704067200},
+                    "relationships": {"metric": {"data": {"type": "metric", "id": "m1"}},
+                                      "profile": {"data": {"type": "profile", "id": profile_id}}}}
+
+        metric = {"type": "metric", "id": "m1", "attributes": {"name": "Placed Order"}}
+        profiles = [{"type": "profile", "id": profile_id, "attributes": {"email": f"{profile_id}@example.com"}}
+                    for profile_id in ("p1", "p2")]
+        responses = [{"data": [event("e1", "p1"), event("e2", "p2")], "included": [metric, *profiles],
+                      "links": {"next": "cursor"}},
+                     {"data": [event("e3", "p1")], "included": [metric, profiles[0]], "links": {"next": None}}]
+        component, call = self._run({"#api_token": "token", "objects": {"events": True},
+                                     "time_range_settings": {"date_from": "2024-01-01", "date_to": "2024-01-02"},
+                                     "events_settings": {"include_metrics": True, "include_profiles": True}},
+                                    responses)
+
+        self.assertEqual(call.call_args.kwargs["include"], ["metric", "profile"])
+        tables = {table_name: [dict(zip(component.new_state[table_name], row))
+                               for row in self._read_output_table(table_name)]
+                  for table_name in ("event", "event_metric", "event_profile")}
+        self.assertEqual([row["profile_id"] for row in tables["event"]], ["p1", "p2", "p1"])
+        self.assertEqual([row["id"] for row in tables["event_metric"]], ["m1"])
+        self.assertEqual([(row["id"], row["email"]) for row in tables["event_profile"]],
+                         [("p1", "p1@example.com"), ("p2", "p2@example.com")])
+
+
+class TestStartup(unittest.TestCase):
+
+    def test_component_import_does_not_load_heavy_modules(self):
+        heavy_modules = ["klaviyo_api", "openapi_client", "dateparser", "keboola.utils.header_normalizer"]
+        src_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "src")
+        output = subprocess.run(
+            [sys.executable, "-c", f"import sys, component; print([m for m in {heavy_modules} if m in sys.modules])"],
+            cwd=src_path, capture_output=True, text=True, check=True).stdout
+        self.assertEqual(output.strip(), "[]")
+
+    def test_common_dates_are_parsed_as_by_dateparser(self):
+        import dateparser
+        component = Component.__new__(Component)
+        component._relative_base = datetime(2024, 3, 1, 12, 30)
+        for value in ["2024-01-15", "2024-01-15 10:20", "2024-01-15T10:20:00+02:00", "1704067200", "now"]:
+            expected = int(dateparser.parse(value, settings={"RELATIVE_BASE": component._relative_base}).timestamp())
+            self.assertEqual(component._parse_common_date(value), expected, value)
+        self.assertIsNone(component._parse_common_date("5 days ago"))
+
+
 if __name__ == "__main__":
     # import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+
+from json_parser import FlattenJsonParser
+
+
+class TestFlattenJsonParser(unittest.TestCase):
+
+    def setUp(self):
+        self.parser = FlattenJsonParser()
+
+    def test_parse_row_flattens_nested_dicts_in_order(self):
+        row = {"a": 1, "b": {"c": {"d": 2}, "e": [3, {"f": 4}]}, "g": {}, "h": None}
+        for _ in range(2):
+            flattened = self.parser.parse_row(row)
+            self.assertEqual(list(flattened.items()), [("a", 1), ("b_c_d", 2), ("b_e", [3, {"f": 4}]), ("h", None)])
+
+    def test_parse_row_keeps_first_position_of_colliding_keys(self):
+        flattened = self.parser.parse_row({"a_b": 1, "c": 2, "a": {"b": 3}})
+        self.assertEqual(list(flattened.items()), [("a_b", 3), ("c", 2)])
+
+    def test_parse_row_handles_rows_of_different_shapes(self):
+        self.assertEqual(self.parser.parse_row({"a": {"b": 1}}), {"a_b": 1})
+        self.assertEqual(self.parser.parse_row({"a": {"c": 1}}), {"a_c": 1})
+        self.assertEqual(self.parser.parse_row({"a": 1}), {"a": 1})
+        self.assertEqual(self.parser.parse_row({}), {})
+
+    def test_parse_row_serializes_values_deeper_than_max_depth(self):
+        row = {"a": 1, "b": {"c": {"d": 2}, "e": [3, {"f": 4}], "g": {}}, "h": {"i": "j"}}
+        parser = FlattenJsonParser(max_depth=1)
+        self.assertEqual(parser.parse_row(row), {"a": 1, "b_c": '{"d":2}', "b_e": '[3,{"f":4}]', "b_g": "{}",
+                                                 "h_i": "j"})
+        parser = FlattenJsonParser(max_depth=0)
+        self.assertEqual(parser.parse_row(row), {"a": 1, "b": '{"c":{"d":2},"e":[3,{"f":4}],"g":{}}',
+                                                 "h": '{"i":"j"}'})
+
+    def test_parse_row_flattens_listed_columns_beyond_max_depth(self):
+        row = {"b": {"c": {"d": 2, "k": {"l": 5}}, "e": {"f": 4}}, "h": {"i": {"j": 1}}}
+        parser = FlattenJsonParser(flatten_columns=["b_c", "h_i_j"])
+        self.assertEqual(parser.parse_row(row), {"b_c_d": 2, "b_c_k_l": 5, "b_e": '{"f":4}', "h_i_j": 1})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+import csv
+import gzip
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import pyarrow.dataset
+import pyarrow.parquet
+
+from concurrent.futures import ThreadPoolExecutor
+
+from table_writers import ParquetWriter, SlicedCsvWriter
+
+
+class TestTableWriters(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def test_sliced_writer_writes_all_columns_upfront_into_single_slice(self):
+        writer = SlicedCsvWriter(os.path.join(self.directory, "table.csv"), ["id", "name"])
+        writer.writerows([{"id": "1", "name": "a"}, {"id": "2"}])
+        writer.close()
+
+        self.assertEqual(len(writer.slice_paths), 1)
+        with open(writer.slice_paths[0]) as file:
+            self.assertEqual(file.read().splitlines(), ["1,a", "2,"])
+
+    @mock.patch("table_writers.COLUMN_DISCOVERY_ROWS", 1)
+    def test_sliced_writer_pads_slices_written_before_new_columns(self):
+        writer = SlicedCsvWriter(os.path.join(self.directory, "table.csv"), ["id"], compress=True)
+        writer.writerows([{"id": "1"}, {"id": "2", "text": "multi\nline"}, {"id": "3", "value": 3},
+                          {"id": "4"}])
+        writer.close()
+
+        self.assertEqual(writer.fieldnames, ["id", "text", "value"])
+        self.assertEqual(len(writer.slice_paths), 3)
+        rows = []
+        for slice_path in writer.slice_paths:
+            with gzip.open(slice_path, "rt", newline="") as file:
+                rows.extend(csv.reader(file))
+        self.assertEqual(rows, [["1", "", ""], ["2", "multi\nline", ""], ["3", "", "3"], ["4", "", ""]])
+
+    @mock.patch("table_writers.COLUMN_DISCOVERY_ROWS", 10)
+    def test_sliced_writer_does_not_pad_rows_written_after_new_columns(self):
+        writer = SlicedCsvWriter(os.path.join(self.directory, "table.csv"), ["id"])
+        writer.writerows([{"id": str(i)} for i in range(50)])
+        writer.writerows([{"id": str(i), "name": f"name {i}"} for i in range(50, 5050)])
+        with mock.patch.object(SlicedCsvWriter, "_pad_slice", autospec=True,
+                               side_effect=SlicedCsvWriter._pad_slice) as pad_slice:
+            writer.close()
+
+        self.assertEqual(len(writer.slice_paths), 2)
+        pad_slice.assert_called_once_with(writer, writer.slice_paths[0], 2)
+        with open(writer.slice_paths[0]) as file:
+            self.assertEqual(file.read().splitlines(), [f"{i}," for i in range(50)])
+        with open(writer.slice_paths[1]) as file:
+            self.assertEqual(len(file.read().splitlines()), 5000)
+
+    @mock.patch("table_writers.COLUMN_DISCOVERY_ROWS", 10)
+    @mock.patch("table_writers.DEFAULT_MAX_BYTES_PER_SLICE", 1000)
+    def test_sliced_writer_pads_slices_of_bounded_size(self):
+        writer = SlicedCsvWriter(os.path.join(self.directory, "table.csv"), ["id"])
+        writer.writerows([{"id": f"{i:05d}"} for i in range(1000)])
+        writer.writerows([{"id": f"{i:05d}", "name": f"name {i}"} for i in range(1000, 1100)])
+        padded_bytes = []
+        pad = SlicedCsvWriter._pad_slice
+
+        def pad_slice(writer, slice_path, columns):
+            padded_bytes.append(os.path.getsize(slice_path))
+            pad(writer, slice_path, columns)
+
+        with mock.patch.object(SlicedCsvWriter, "_pad_slice", autospec=True, side_effect=pad_slice):
+            writer.close()
+
+        # only the 1000 rows of 7 bytes written before the new column are rewritten, in slices finished by the row
+        # that reaches the limit
+        self.assertEqual(sum(padded_bytes), 7000)
+        self.assertEqual(len(padded_bytes), 7)
+        self.assertTrue(all(size <= 1000 + 7 for size in padded_bytes))
+        self.assertEqual(len(writer.slice_paths), 9)
+
+    @mock.patch("table_writers.COMPRESSION_BLOCK_SIZE", 16)
+    def test_sliced_writer_rotates_compressed_slices_by_rows(self):
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            writer = SlicedCsvWriter(os.path.join(self.directory, "table.csv"), ["id", "name"], compress=True,
+                                     max_rows_per_slice=40, compression_executor=executor)
+            writer.writerows([{"id": str(i), "name": f"name {i}"} for i in range(100)])
+            writer.close()
+
+        self.assertEqual(len(writer.slice_paths), 3)
+        rows = []
+        for slice_path in writer.slice_paths:
+            with gzip.open(slice_path, "rt", newline="") as file:
+                rows.extend(csv.reader(file))
+        self.assertEqual(rows, [[str(i), f"name {i}"] for i in range(100)])
+
+    def test_parquet_writer_starts_new_file_when_columns_are_added(self):
+        writer = ParquetWriter(self.directory, "table", ["id"], row_group_size=2)
+        writer.writerows([{"id": "1"}, {"id": "2", "value": 1}, {"id": "3", "extra": None}])
+        writer.close()
+
+        self.assertEqual(writer.fieldnames, ["id", "value", "extra"])
+        self.assertEqual(len(writer.file_paths), 2)
+        dataset = pyarrow.dataset.dataset(writer.file_paths, schema=pyarrow.unify_schemas(
+            [pyarrow.parquet.read_schema(path) for path in writer.file_paths]))
+        self.assertEqual(dataset.to_table().sort_by("id").to_pylist(), [
+            {"id": "1", "value": None, "extra": None},
+            {"id": "2", "value": "1", "extra": None},
+            {"id": "3", "value": None, "extra": None},
+        ])
+
+
+if __name__ == "__main__":
+    unittest.main()